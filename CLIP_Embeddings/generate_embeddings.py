@@ -3,10 +3,16 @@ import torch
 import pandas as pd
 import sys
 sys.path.append('.')
-import PIL
 import os
+import hashlib
+import subprocess
 import numpy as np
 from utils import load_dataset
+from utils import backbones
+from utils import embedding_shards
+from utils import features
+from utils.embedding_writer import EmbeddingWriter, run_pipeline
+from utils.embedding_client import EmbeddingClient
 import argparse
 import ast
 from sklearn.metrics.pairwise import cosine_similarity
@@ -43,53 +49,193 @@ def calculate_distances(image_embedding, prompt_embeddings: list):
     return model_input.tobytes()
 
 
-def generate_embeddings(REPO_PATH,DATA_PATH):
+def encode_batches(model, preprocessor, device, df, batch_size):
+    """
+    Encodes the images of a dataset in batches
+
+    Args:
+        model (torch.nn.Module): The CLIP model
+        preprocessor (Callable): The CLIP preprocessor
+        device (str): The device of the model
+        df (pd.DataFrame): The images
+        batch_size (int): The number of images per batch
+
+    Yields:
+        tuple: the rows of the batch and their image embeddings as tensor of shape (images, dim)
+    """
+    images = load_dataset.ImageDataset_from_df(df, preprocessor)
+    for start in range(0, len(df), batch_size):
+        batch = torch.stack([images[i][0] for i in range(start, min(start + batch_size, len(df)))])
+        with torch.no_grad():
+            yield df.iloc[start:start + batch_size], model.encode_image(batch.to(device))
+
+
+def encode_batches_on_server(client, df, batch_size):
+    """
+    Encodes the images of a dataset in batches on an embedding server
+
+    Yields:
+        tuple: the rows of the batch and their image embeddings as tensor of shape (images, dim)
+    """
+    for start in range(0, len(df), batch_size):
+        rows = df.iloc[start:start + batch_size]
+        yield rows, torch.from_numpy(client.encode_image(paths=rows["path"].tolist()))
+
+
+def embedding_rows(rows, image_embeddings, prompt_embedding):
+    """
+    Builds the csv rows of a batch: every embedding is stored as tensor of shape (1, dim) like the model output,
+    the model inputs are the embeddings with the distances to the prompt embeddings (same values as calculate_distances)
+
+    Args:
+        rows (pd.DataFrame): The rows of the batch
+        image_embeddings (torch.Tensor): The image embeddings of the batch
+        prompt_embedding (torch.Tensor): The prompt embeddings
+
+    Returns:
+        pd.DataFrame: the rows with the columns Embedding and model_input
+    """
+    model_inputs = features.model_inputs(image_embeddings.float().cpu().numpy(), prompt_embedding.float().cpu().numpy())
+    rows = rows.copy()
+    rows["Embedding"] = pd.Series([image_embeddings[i:i + 1] for i in range(len(rows))], index=rows.index, dtype=object)
+    rows["model_input"] = [model_input.tobytes() for model_input in model_inputs]
+    return rows
+
+
+def embedding_fingerprint(df, backbone, quantization, prompt_embedding):
+    """Identifies the embeddings of a dataset, an interrupted run is only resumed if it wrote the same embeddings"""
+    digest = hashlib.sha256(f"{backbone}|{quantization}|".encode())
+    digest.update("\n".join(df["path"]).encode())
+    digest.update(prompt_embedding.float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def generate_embeddings(REPO_PATH,DATA_PATH,backbone=backbones.DEFAULT_BACKBONE,server_url=None,quantization=None,shard=None,batch_size=32,queue_size=4):
     """
     Generates embeddings for the geoguessr, tourist and aerial datasets and saves them to csv files
 
     Args:
         REPO_PATH (str): The path to the repository
         DATA_PATH (str): The path to the data folder
+        backbone (str, optional): The CLIP backbone, see utils/backbones.py. Defaults to backbones.DEFAULT_BACKBONE.
+        server_url (str, optional): Url of a running embedding server (utils/embedding_server.py), that encodes the images
+            and prompts instead of a model loaded by this process. Defaults to None.
+        quantization (str, optional): Encode the images on the CPU with an int8 quantized image encoder, 'dynamic' or 'static'
+            (see utils/quantization.py). Defaults to None.
+        shard (str, optional): Only embed the shard i/n of every dataset and save it with checksums in CLIP_Embeddings/Shards/{i}-of-{n},
+            merge_embedding_shards assembles the embeddings once all shards are done. Defaults to None.
+        batch_size (int, optional): The number of images encoded at once. Defaults to 32.
+        queue_size (int, optional): The maximal number of encoded batches waiting to be written, the memory of the generation is
+            bounded by batch_size and queue_size instead of growing with the datasets. Defaults to 4.
     """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocessor = clip.load("ViT-B/32", device=device)
+    if server_url is None and quantization is not None:
+        from utils.quantization import load_quantized_backbone
+        device = "cpu"
+        model, preprocessor = load_quantized_backbone(backbone, quantization, DATA_PATH, os.path.join(REPO_PATH, 'models'))
+    elif server_url is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, preprocessor = backbones.load_backbone(backbone, device, os.path.join(REPO_PATH, 'models'))
 
     # load image data
     geoguessr_df = load_dataset.load_data(f'{DATA_PATH}/geoguessr')
     tourist_df = load_dataset.load_data(f'{DATA_PATH}/tourist')
     aerial_df = load_dataset.load_data(f'{DATA_PATH}/aerial')
+    if shard is not None:
+        shard_index, shard_count = embedding_shards.parse_shard(shard)
+        geoguessr_df = embedding_shards.select_shard(geoguessr_df, f'{DATA_PATH}/geoguessr', shard_index, shard_count)
+        tourist_df = embedding_shards.select_shard(tourist_df, f'{DATA_PATH}/tourist', shard_index, shard_count)
+        aerial_df = embedding_shards.select_shard(aerial_df, f'{DATA_PATH}/aerial', shard_index, shard_count)
+        folder = embedding_shards.shard_dir(REPO_PATH, shard_index, shard_count)
+        os.makedirs(folder, exist_ok=True)
+        # a shard is only complete once its shard.json is written again
+        if os.path.isfile(f'{folder}/shard.json'):
+            os.remove(f'{folder}/shard.json')
 
     # generate Prompts
     country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')["Country"].to_list()
     country_prompt = list(map((lambda x: f"This image shows the country {x}"),country_list))
 
-    with torch.no_grad():
-        # generate image embeddings
-        geoguessr_df["Embedding"] = geoguessr_df["path"].apply(lambda path: model.encode_image(preprocessor(PIL.Image.open(path)).unsqueeze(0).to(device)))
-        tourist_df["Embedding"] = tourist_df["path"].apply(lambda path: model.encode_image(preprocessor(PIL.Image.open(path)).unsqueeze(0).to(device)))
-        aerial_df["Embedding"] = aerial_df["path"].apply(lambda path: model.encode_image(preprocessor(PIL.Image.open(path)).unsqueeze(0).to(device)))
+    # generate prompt embeddings, the model inputs of all images are built with them
+    if server_url is not None:
+        client = EmbeddingClient(server_url)
+        simple_embedding = torch.from_numpy(client.encode_text(country_list))
+        prompt_embedding = torch.from_numpy(client.encode_text(country_prompt))
+    else:
+        client = None
+        with torch.no_grad():
+            simple_tokens = clip.tokenize(country_list)
+            promt_token = clip.tokenize(country_prompt)
 
-        # generate prompt embeddings
-        simple_tokens = clip.tokenize(country_list)
-        promt_token = clip.tokenize(country_prompt)
+            simple_embedding = model.encode_text(simple_tokens)
+            prompt_embedding = model.encode_text(promt_token)
 
-        simple_embedding = model.encode_text(simple_tokens)
-        prompt_embedding = model.encode_text(promt_token)
+    # stream the image embeddings of every dataset into its csv files
+    datasets = {'geoguessr': geoguessr_df, 'tourist': tourist_df, 'aerial': aerial_df}
+    for name, df in datasets.items():
+        if shard is not None:
+            writer = EmbeddingWriter(f'{folder}/{name}_embeddings', None, embedding_fingerprint(df, backbone, quantization, prompt_embedding))
+        else:
+            writer = EmbeddingWriter(f"{REPO_PATH}/CLIP_Embeddings/Image/{name}_embeddings", 2000, embedding_fingerprint(df, backbone, quantization, prompt_embedding))
+        if client is not None:
+            batches = encode_batches_on_server(client, df.iloc[writer.rows:], batch_size)
+        else:
+            batches = encode_batches(model, preprocessor, device, df.iloc[writer.rows:], batch_size)
+        run_pipeline(batches, lambda batch: writer.write(embedding_rows(*batch, prompt_embedding)), queue_size)
+        writer.close()
+        print(f"Saved {writer.rows} {name} embeddings")
 
-    # generate model inputs, by appending distances to the prompt embeddings
-    geoguessr_df["model_input"] = geoguessr_df["Embedding"].apply(lambda x: calculate_distances(x, prompt_embedding))
-    aerial_df["model_input"] = aerial_df["Embedding"].apply(lambda x: calculate_distances(x, prompt_embedding))
-    tourist_df["model_input"] = tourist_df["Embedding"].apply(lambda x: calculate_distances(x, prompt_embedding))
-
-    # save image embeddings
-    save_dataframe_in_batches(geoguessr_df, 2000, f"{REPO_PATH}/CLIP_Embeddings/Image/geoguessr_embeddings")
-    save_dataframe_in_batches(tourist_df, 2000, f"{REPO_PATH}/CLIP_Embeddings/Image/tourist_embeddings")
-    save_dataframe_in_batches(aerial_df, 2000, f"{REPO_PATH}/CLIP_Embeddings/Image/aerial_embeddings")
+    if shard is not None:
+        torch.save(simple_embedding, f'{folder}/prompt_simple_embedding.pt')
+        torch.save(prompt_embedding, f'{folder}/prompt_image_shows_embedding.pt')
+        embedding_shards.write_shard_index(folder, shard_index, shard_count, backbone,
+                                           {name: embedding_shards.relative_paths(df, f'{DATA_PATH}/{name}').tolist() for name, df in datasets.items()},
+                                           ['prompt_simple_embedding.pt', 'prompt_image_shows_embedding.pt'])
+        print(f"Saved shard {shard} to {folder}")
+        return
 
     # save prompt embeddings
     torch.save(simple_embedding, f'{REPO_PATH}/CLIP_Embeddings/Prompt/prompt_simple_embedding.pt')
     torch.save(prompt_embedding, f'{REPO_PATH}/CLIP_Embeddings/Prompt/prompt_image_shows_embedding.pt')
 
+
+def merge_embedding_shards(REPO_PATH,DATA_PATH):
+    """
+    Validates the shards in CLIP_Embeddings/Shards (complete, checksums, every image in exactly one shard) and saves the
+    embeddings and prompt embeddings like generate_embeddings, in the same row order as a single process
+
+    Args:
+        REPO_PATH (str): The path to the repository
+        DATA_PATH (str): The path to the data folder
+    """
+    shards = embedding_shards.load_shard_indices(REPO_PATH)
+    # all datasets are validated before anything is written
+    merged = {name: embedding_shards.merge_dataset(shards, name, load_dataset.load_data(f'{DATA_PATH}/{name}'), f'{DATA_PATH}/{name}')
+              for name in ['geoguessr', 'tourist', 'aerial']}
+    for name, df in merged.items():
+        save_dataframe_in_batches(df, 2000, f"{REPO_PATH}/CLIP_Embeddings/Image/{name}_embeddings")
+    embedding_shards.copy_prompts(shards, f'{REPO_PATH}/CLIP_Embeddings/Prompt')
+    print(f"Merged {len(shards)} shards of {shards[0]['backbone']} embeddings")
+
+
+def run_local_shards(yaml_path,count,arguments):
+    """
+    Runs the shards 0/n..n-1/n in parallel processes on this machine, each with an equal part of the CPU threads
+
+    Args:
+        yaml_path (str): The path to the yaml file with the stored paths
+        count (int): The number of shards
+        arguments (list): Further command line arguments of the shards, e.g. ['--backbone', 'RN50']
+
+    Raises:
+        RuntimeError: A shard failed
+    """
+    threads = max(1, (os.cpu_count() or 1) // count)
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--yaml_path', yaml_path, '--shard', f'{index}/{count}', '--threads', str(threads)] + arguments)
+                 for index in range(count)]
+    failed = [index for index, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} of {count} failed, rerun them with --shard i/{count} and merge with --merge")
+
 if __name__ == "__main__":
     """Generates embeddings for the geoguessr, tourist and aerial datasets and saves them to csv files
     """
@@ -98,10 +244,41 @@ if __name__ == "__main__":
                         help='The path to the yaml file with the stored paths')
     parser.add_argument('-d', '--debug', action='store_true',
                         required=False, help='Enable debug mode', default=False)
+    parser.add_argument('--backbone', metavar='str',
+                        required=False, help='The CLIP backbone, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--server_url', metavar='str',
+                        required=False, help='Url of a running embedding server, e.g. http://127.0.0.1:8765', default=None)
+    parser.add_argument('--quantization', metavar='str', choices=['dynamic', 'static'],
+                        required=False, help='Encode the images with an int8 quantized image encoder on the CPU', default=None)
+    parser.add_argument('--shard', metavar='i/n',
+                        required=False, help='Only embed the shard i of n of every dataset, e.g. 0/4', default=None)
+    parser.add_argument('--merge', action='store_true',
+                        required=False, help='Validate and merge the shards into the embedding store', default=False)
+    parser.add_argument('--local_shards', metavar='int', type=int,
+                        required=False, help='Run n shards as parallel processes on this machine and merge them', default=None)
+    parser.add_argument('--threads', metavar='int', type=int,
+                        required=False, help='Number of torch threads', default=None)
+    parser.add_argument('--batch_size', metavar='int', type=int,
+                        required=False, help='Number of images encoded at once', default=32)
+    parser.add_argument('--queue_size', metavar='int', type=int,
+                        required=False, help='Maximal number of encoded batches waiting to be written', default=4)
+    parser.add_argument('--image_embeddings_only', action='store_true',
+                        required=False, help='Only save the image embeddings of the embedding store (CLIP_Embeddings/Image/{dataset}_embeddings.csv) to CLIP_Embeddings/Features', default=False)
     args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
 
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         REPO_PATH = paths['repo_path']
         DATA_PATH = paths['data_path']
-        generate_embeddings(REPO_PATH,DATA_PATH)
\ No newline at end of file
+    if args.local_shards is not None:
+        arguments = ['--backbone', args.backbone, '--batch_size', str(args.batch_size), '--queue_size', str(args.queue_size)] + (['--server_url', args.server_url] if args.server_url else []) + (['--quantization', args.quantization] if args.quantization else [])
+        run_local_shards(args.yaml_path, args.local_shards, arguments)
+        merge_embedding_shards(REPO_PATH,DATA_PATH)
+    elif args.image_embeddings_only:
+        load_dataset.save_image_embeddings(REPO_PATH)
+    elif args.merge:
+        merge_embedding_shards(REPO_PATH,DATA_PATH)
+    else:
+        generate_embeddings(REPO_PATH,DATA_PATH,args.backbone,args.server_url,args.quantization,args.shard,args.batch_size,args.queue_size)
\ No newline at end of file
@@ -0,0 +1,165 @@
+import hashlib
+import codecs
+import os
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+
+
+def embedding_strings_to_array(embeddings: pd.Series) -> np.ndarray:
+    """Parse the string representations of the stored torch tensors (e.g. "tensor([[0.1, ...]], device='cuda:0')")
+    into one float32 matrix, without going through ast, torch and python lists.
+
+    Args:
+        embeddings (pd.Series): column of tensor string representations
+
+    Returns:
+        np.ndarray: matrix of shape (samples, embedding size)
+    """
+    # str(tensor) wraps long embeddings over several lines, so the match has to span line breaks
+    values = embeddings.str.extract(r'(?s)\[\[(.*?)\]\]', expand=False)
+    if values.isnull().any():
+        raise ValueError("Not all embeddings are stored as tensor representations.")
+    return np.array(values.str.split(',').tolist(), dtype=np.float32)
+
+
+def model_input_strings_to_array(model_inputs: pd.Series) -> np.ndarray:
+    """Parse the stored byte strings of the model inputs into one float32 matrix.
+    The escape sequences of all rows are decoded in a single call instead of evaluating every row as a python literal.
+
+    Args:
+        model_inputs (pd.Series): column of byte string representations (e.g. "b'...'")
+
+    Returns:
+        np.ndarray: matrix of shape (samples, model input size)
+    """
+    model_inputs = pd.Series(model_inputs)
+    if not (model_inputs.str.match(r'b[\'"]') & (model_inputs.str[-1] == model_inputs.str[1])).all():
+        raise ValueError("Not all model inputs are stored as byte string representations.")
+    # every row is a complete sequence of escapes, so the rows can be decoded at once and split by their fixed size
+    buffer = codecs.escape_decode(''.join(model_inputs.str[2:-1]).encode('latin-1'))[0]
+    return np.frombuffer(buffer, dtype=np.float32).reshape(len(model_inputs), -1)
+
+
+def load_feature_matrix(df: pd.DataFrame, include_distances: bool) -> np.ndarray:
+    """Load the features of the t-SNE analysis from a DataFrame of stored embeddings
+
+    Args:
+        df (pd.DataFrame): DataFrame of the embedding csv files
+        include_distances (Boolean): Use the model inputs (embeddings appended with distances to prompts) instead of the embeddings
+
+    Returns:
+        np.ndarray: matrix of shape (samples, features)
+    """
+    if include_distances:
+        return model_input_strings_to_array(df['model_input'])
+    column = 'Embedding' if 'Embedding' in df.columns else 'Embeddings'
+    return embedding_strings_to_array(df[column])
+
+
+def stratified_subsample(labels: np.ndarray, max_samples: int, seed: int = 1234) -> np.ndarray:
+    """Select at most max_samples indices, keeping the label proportions and at least one sample per label
+
+    Args:
+        labels (np.ndarray): label of every sample
+        max_samples (int): maximal number of selected samples
+        seed (int, optional): random seed. Defaults to 1234.
+
+    Returns:
+        np.ndarray: sorted indices of the selected samples
+    """
+    if max_samples is None or len(labels) <= max_samples:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    codes, counts = np.unique(labels, return_inverse=True, return_counts=True)[1:]
+    quota = np.maximum(1, np.floor(counts * max_samples / len(labels))).astype(int)
+    # shuffle all samples once, then keep the first quota[label] samples of every label
+    order = rng.permutation(len(labels))
+    order = order[np.argsort(codes[order], kind='stable')]
+    rank = np.arange(len(labels)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.sort(order[rank < quota[codes[order]]])
+
+
+def place_out_of_sample(fitted_features: np.ndarray, fitted_projection: np.ndarray, features: np.ndarray, n_neighbors: int = 10) -> np.ndarray:
+    """Place samples, that were not part of the t-SNE fit, at the distance weighted mean position of their nearest fitted neighbours
+
+    Args:
+        fitted_features (np.ndarray): features of the samples used for the fit
+        fitted_projection (np.ndarray): 2-D coordinates of the fitted samples
+        features (np.ndarray): features of the samples to place
+        n_neighbors (int, optional): number of neighbours. Defaults to 10.
+
+    Returns:
+        np.ndarray: 2-D coordinates of the placed samples
+    """
+    neighbors = NearestNeighbors(n_neighbors=min(n_neighbors, len(fitted_features)), n_jobs=-1).fit(fitted_features)
+    distances, indices = neighbors.kneighbors(features)
+    weights = 1 / np.maximum(distances, 1e-12)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum('nk,nkd->nd', weights, fitted_projection[indices])
+
+
+def projection_hash(X: np.ndarray, labels: np.ndarray = None, **parameters) -> str:
+    """Hash of the input matrix, the labels and the projection parameters, used as cache key
+
+    Args:
+        X (np.ndarray): input matrix
+        labels (np.ndarray, optional): labels used for the stratified subsampling. Defaults to None.
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    digest.update(str(X.shape).encode())
+    digest.update(X.tobytes())
+    # the labels select the fitted subsample, so they change the projection
+    digest.update(repr(None if labels is None else np.asarray(labels).tolist()).encode())
+    digest.update(repr(sorted(parameters.items())).encode())
+    return digest.hexdigest()
+
+
+def project(X: np.ndarray, labels: np.ndarray = None, pca_components: int = 50, max_samples: int = None, seed: int = 1234, cache_dir: str = None) -> np.ndarray:
+    """Project the features to two dimensions with t-SNE.
+    The features are optionally PCA reduced before the t-SNE, which is fitted on a stratified subsample
+    (the remaining samples are placed out of sample) using all cores.
+    The resulting coordinates are cached by the hash of the input, the labels and the parameters.
+
+    Args:
+        X (np.ndarray): matrix of shape (samples, features)
+        labels (np.ndarray, optional): labels used for the stratified subsampling. Defaults to None.
+        pca_components (int, optional): number of PCA components, None to disable the reduction. Defaults to 50.
+        max_samples (int, optional): maximal number of samples used for the t-SNE fit, None to use all. Defaults to None.
+        seed (int, optional): random seed. Defaults to 1234.
+        cache_dir (str, optional): directory of the cached projections, None to disable the cache. Defaults to None.
+
+    Returns:
+        np.ndarray: t-SNE results of shape (samples, 2)
+    """
+    if cache_dir is not None:
+        key = projection_hash(X, labels, pca_components=pca_components, max_samples=max_samples, seed=seed)
+        cache_path = os.path.join(cache_dir, f'{key}.npy')
+        if os.path.isfile(cache_path):
+            return np.load(cache_path)
+
+    features = np.asarray(X, dtype=np.float32)
+    if pca_components is not None and features.shape[1] > pca_components:
+        features = PCA(n_components=pca_components, random_state=seed).fit_transform(features)
+
+    if labels is None:
+        labels = np.zeros(len(features))
+    fit_indices = stratified_subsample(np.asarray(labels), max_samples, seed)
+
+    tsne = TSNE(n_components=2, verbose=1, init='pca', random_state=seed, n_jobs=-1)
+    tsne_results = np.empty((len(features), 2), dtype=np.float32)
+    tsne_results[fit_indices] = tsne.fit_transform(features[fit_indices])
+    if len(fit_indices) < len(features):
+        remaining = np.setdiff1d(np.arange(len(features)), fit_indices, assume_unique=True)
+        tsne_results[remaining] = place_out_of_sample(features[fit_indices], tsne_results[fit_indices], features[remaining])
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path, tsne_results)
+    return tsne_results
@@ -1,14 +1,13 @@
 
 import pandas as pd
-import torch
 import argparse
 import yaml
 import os
 import numpy as np
-from sklearn.manifold import TSNE
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import seaborn as sns
-import ast
+from concurrent.futures import ProcessPoolExecutor
+import projection
 
 
 def load_european_data(REPO_PATH, dataset_name, country_list):
@@ -23,7 +22,7 @@ def load_european_data(REPO_PATH, dataset_name, country_list):
     directory = f'{REPO_PATH}/CLIP_Embeddings/Image/'
 
     # Get a list of all filenames in each directory
-    file_list = [file for file in os.listdir(directory) if file.startswith(dataset_name)]
+    file_list = [file for file in os.listdir(directory) if file.startswith(dataset_name) and file.endswith('.csv')]
 
     # Initialize an empty list to store DataFrames
     dfs = []
@@ -59,7 +58,7 @@ def load_data(REPO_PATH, dataset_name, country_list):
     directory = f'{REPO_PATH}/CLIP_Embeddings/Image/'
 
     # Get a list of all filenames in each directory
-    file_list = [file for file in os.listdir(directory) if file.startswith(dataset_name)]
+    file_list = [file for file in os.listdir(directory) if file.startswith(dataset_name) and file.endswith('.csv')]
 
     # Initialize an empty list to store DataFrames
     dfs = []
@@ -77,288 +76,168 @@ def load_data(REPO_PATH, dataset_name, country_list):
     combined_df = pd.merge(combined_df,country_list,left_on='label',right_on='Country')
     return combined_df
 
-def transform_tensor_rep_to_array(x):
-    """Transform a string representation of a torch tensor to a numpy array
+def map_labels(y, country_list):
+    """Map every country label to its region and continent with one vectorized lookup
 
     Args:
-        x (str): string representation of torch tensor
+        y (Array): labels of the t-SNE results
+        country_list (DataFrame): Data Frame of Countries, Regions and Continents
+
+    Returns:
+        tuple: Arrays of the intermediate region and continent of every label
     """
-    start = x.find('[[')
-    end = x.find(']]')+2
-    x = x[start:end]
-    image_embedding = torch.tensor(ast.literal_eval(x))
-    image_embedding_values = np.array(image_embedding.flatten().tolist()).reshape(1, -1)
-    return image_embedding_values
+    lookup = country_list.set_index('Country')
+    regions = lookup['Intermediate Region Name'].reindex(y).to_numpy()
+    continents = lookup['Continent'].reindex(y).to_numpy()
+    return regions, continents
 
-def transform_buffer_to_array(x):
-    """Transform a buffer string into a numpy list
+def split_indices(keys):
+    """Split the sample indices by key with a single stable argsort
 
     Args:
-        x (str): buffer string
+        keys (Array): key (e.g. region) of every sample
+
+    Returns:
+        dict: sorted keys mapped to the indices of their samples
     """
-    model_input_str = eval(x)
-    model_input_array = np.frombuffer(model_input_str, dtype=np.float32)
-    model_input = model_input_array.tolist()
-    return model_input
+    classes, codes = np.unique(keys, return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.cumsum(np.bincount(codes, minlength=len(classes)))[:-1]
+    return dict(zip(classes, np.split(order, bounds)))
 
-def save_continent_plot(REPO_PATH, tsne_results, dataset_name, continents, continent_classes, include_distances):
-    """Save a plot of the t-SNE results colored by continent
+def plot_path(REPO_PATH, dataset_name, include_distances, *subfolders):
+    """Path of the output plot
 
     Args:
         REPO_PATH (str): local path of repository
-        tsne_results (Array): Results of the t-SNE analysis
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
-        continents (List): list of all continents
         include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
+        subfolders (str): sub folders of the plot, e.g. 'Region', 'Western Europe'
     """
-    # Display tSNE results of continents
-
-    df_subset = pd.DataFrame()
-    df_subset['tsne-2d-one'] = tsne_results[:,0]
-    df_subset['tsne-2d-two'] = tsne_results[:,1]
-    df_subset['Classes'] = continents
-
-    plt.figure(figsize=(16,10), clear=True)
-    scatterplot = sns.scatterplot(
-        x="tsne-2d-one", y="tsne-2d-two",
-        hue="Classes",
-        hue_order=continent_classes,
-        palette=sns.color_palette("hls", 6),
-        data=df_subset,
-        legend="full",
-        alpha=0.3
-    )
-    if include_distances:
-        if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/World'):
-            os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/World')
-        scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/World/output.png')
-    else:
-        if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/World'):
-            os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/World')
-        scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/World/output.png')
+    feature_folder = 'Model_Input' if include_distances else 'Embeddings'
+    return os.path.join(REPO_PATH, 'CLIP_Embeddings', 't-SNE', feature_folder, dataset_name, *subfolders, 'output.png')
+
+def focus_panel(output_path, tsne_results, focus_indices, focus_labels):
+    """Create a panel that colors the samples of one group by their label and the remaining samples grey as 'Other'
+
+    Args:
+        output_path (str): path of the plot
+        tsne_results (Array): Results of the t-SNE analysis
+        focus_indices (Array): indices of the samples of the group
+        focus_labels (Array): labels of the samples of the group
 
-def save_region_plots_europe(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances):
-    """Save plots of the t-SNE results seperated by continent and colored by region
+    Returns:
+        tuple: panel that can be rendered by render_panel
+    """
+    groups = split_indices(focus_labels)
+    class_order = list(groups.keys())
+    class_points = [tsne_results[focus_indices[indices]] for indices in groups.values()]
+    colors = sns.color_palette("hls", len(class_order)).as_hex()
+
+    other_mask = np.ones(len(tsne_results), dtype=bool)
+    other_mask[focus_indices] = False
+    class_order.append('Other')
+    class_points.append(tsne_results[other_mask])
+    colors.append('#d3d3d3')
+    return output_path, class_order, class_points, colors
+
+def continent_panels(REPO_PATH, tsne_results, dataset_name, continents, include_distances):
+    """Panel of the t-SNE results colored by continent
 
     Args:
         REPO_PATH (str): local path of repository
-        y (List): List of labels for the t-SNE results
-        country_list (DataFrame): Data Frame of Countries, Regions and Continents
         tsne_results (Array): Results of the t-SNE analysis
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
-        region_classes (List): list of all regions
+        continents (Array): continent of every t-SNE result
         include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
     """
-    # Create intermediate region labels
-    region_result_array = []
-    for elem in y:
-        country_row = country_list.loc[country_list['Country'] == elem].iloc[0]
-        region_result_array.append(country_row['Intermediate Region Name'])
-
-    # Display tSNE results of intermediate regions within Europe
-
-    df_subset = pd.DataFrame()
-    df_subset['tsne-2d-one'] = tsne_results[:,0]
-    df_subset['tsne-2d-two'] = tsne_results[:,1]
-    df_subset['Classes'] = region_result_array
-
-    color_palette = sns.color_palette("hls", len(region_classes)).as_hex()
-
-    plt.figure(figsize=(16,10), clear=True)
-    scatterplot = sns.scatterplot(
-        x="tsne-2d-one", y="tsne-2d-two",
-        hue="Classes",
-        hue_order=region_classes,
-        palette=sns.color_palette(color_palette),
-        data=df_subset,
-        legend="full",
-        alpha=0.3
-    )
-    if include_distances:
-        if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe'):
-            os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe')
-        scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe/output.png')
-    else:
-        if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe'):
-            os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe')
-        scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe/output.png')
+    groups = split_indices(continents)
+    colors = sns.color_palette("hls", 6).as_hex()[:len(groups)]
+    class_points = [tsne_results[indices] for indices in groups.values()]
+    return [(plot_path(REPO_PATH, dataset_name, include_distances, 'World'), list(groups.keys()), class_points, colors)]
 
-def save_region_plots(REPO_PATH, y, country_list, tsne_results, dataset_name, continent_classes, include_distances):
-    """Save plots of the t-SNE results seperated by continent and colored by region
+def region_panels_europe(REPO_PATH, tsne_results, dataset_name, regions, include_distances):
+    """Panel of the european t-SNE results colored by region
 
     Args:
         REPO_PATH (str): local path of repository
-        y (List): List of labels for the t-SNE results
-        country_list (DataFrame): Data Frame of Countries, Regions and Continents
         tsne_results (Array): Results of the t-SNE analysis
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
-        continent_classes (List): list of all continents 
-        include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts
+        regions (Array): intermediate region of every t-SNE result
+        include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
     """
-    # Create intermediate region labels
-
-    continent_specific_labels = []
-    for continent in continent_classes:
-        result_array = []
-        for elem in y:
-            country_row = country_list.loc[country_list['Country'] == elem].iloc[0]
-            if country_row['Continent'] == continent:
-                result_array.append(country_row['Intermediate Region Name'])
-            else:
-                result_array.append('Other')
-        continent_specific_labels.append(result_array)
-
-    # Display tSNE results of intermediate regions within each continent
-
-    df_subset = pd.DataFrame()
-    df_subset['tsne-2d-one'] = tsne_results[:,0]
-    df_subset['tsne-2d-two'] = tsne_results[:,1]
-    for i in range(0, len(continent_specific_labels)):
-        df_subset['Classes'] = continent_specific_labels[i]
-
-        unique_classes = np.unique(continent_specific_labels[i])
-        modified_unique = list(np.delete(unique_classes, np.where(unique_classes == 'Other')))
-        color_palette = sns.color_palette("hls", len(modified_unique)).as_hex()
-        color_palette.append('#d3d3d3')
-        modified_unique.append('Other')
-
-        plt.figure(figsize=(16,10), clear=True)
-        scatterplot = sns.scatterplot(
-            x="tsne-2d-one", y="tsne-2d-two",
-            hue="Classes",
-            hue_order=modified_unique,
-            palette=sns.color_palette(color_palette),
-            data=df_subset,
-            legend="full",
-            alpha=0.3
-        )
-        if include_distances:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Continent/{continent_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Continent/{continent_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Continent/{continent_classes[i]}/output.png')
-        else:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Continent/{continent_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Continent/{continent_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Continent/{continent_classes[i]}/output.png')
-
-def save_country_plots_europe(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances):
-    """Save plots of the t-SNE results seperated by region and colored by country
+    groups = split_indices(regions)
+    colors = sns.color_palette("hls", len(groups)).as_hex()
+    class_points = [tsne_results[indices] for indices in groups.values()]
+    return [(plot_path(REPO_PATH, dataset_name, include_distances, 'Europe'), list(groups.keys()), class_points, colors)]
+
+def region_panels(REPO_PATH, tsne_results, dataset_name, regions, continents, include_distances):
+    """Panels of the t-SNE results seperated by continent and colored by region
 
     Args:
         REPO_PATH (str): local path of repository
-        y (List): List of labels for the t-SNE results
-        country_list (DataFrame): Data Frame of Countries, Regions and Continents
         tsne_results (Array): Results of the t-SNE analysis
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
-        region_classes (List): list of all regions
+        regions (Array): intermediate region of every t-SNE result
+        continents (Array): continent of every t-SNE result
         include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
-    """    
-    # Create country labels
-
-    region_specific_labels = []
-    for region in region_classes:
-        result_array = []
-        for elem in y:
-            country_row = country_list.loc[country_list['Country'] == elem].iloc[0]
-            if country_row['Intermediate Region Name'] == region:
-                result_array.append(elem)
-            else:
-                result_array.append('Other')
-        region_specific_labels.append(result_array)
-
-    # Display tSNE results of countries within each intermediate region
-
-    df_subset = pd.DataFrame()
-    df_subset['tsne-2d-one'] = tsne_results[:,0]
-    df_subset['tsne-2d-two'] = tsne_results[:,1]
-    for i in range(0, len(region_specific_labels)):
-        df_subset['Classes'] = region_specific_labels[i]
-
-        unique_classes = np.unique(region_specific_labels[i])
-        modified_unique = list(np.delete(unique_classes, np.where(unique_classes == 'Other')))
-        color_palette = sns.color_palette("hls", len(modified_unique)).as_hex()
-        color_palette.append('#d3d3d3')
-        modified_unique.append('Other')
-
-        plt.figure(figsize=(16,10), clear=True)
-        scatterplot = sns.scatterplot(
-            x="tsne-2d-one", y="tsne-2d-two",
-            hue="Classes",
-            hue_order=modified_unique,
-            palette=sns.color_palette(color_palette),
-            data=df_subset,
-            legend="full",
-            alpha=0.3
-        )
-        if include_distances:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe/Region/{region_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe/Region/{region_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Europe/Region/{region_classes[i]}/output.png')   
-        else:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe/Region/{region_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe/Region/{region_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Europe/Region/{region_classes[i]}/output.png')   
-
-def save_country_plots(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances):
-    """Save plots of the t-SNE results seperated by region and colored by country
+    """
+    return [focus_panel(plot_path(REPO_PATH, dataset_name, include_distances, 'Continent', continent), tsne_results, indices, regions[indices])
+            for continent, indices in split_indices(continents).items()]
+
+def country_panels(REPO_PATH, y, tsne_results, dataset_name, regions, include_distances, only_europe=False):
+    """Panels of the t-SNE results seperated by region and colored by country
 
     Args:
         REPO_PATH (str): local path of repository
-        y (List): List of labels for the t-SNE results
-        country_list (DataFrame): Data Frame of Countries, Regions and Continents
+        y (Array): labels of the t-SNE results
         tsne_results (Array): Results of the t-SNE analysis
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
-        region_classes (List): list of all regions
+        regions (Array): intermediate region of every t-SNE result
         include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
-    """    
-    # Create country labels
-
-    region_specific_labels = []
-    for region in region_classes:
-        result_array = []
-        for elem in y:
-            country_row = country_list.loc[country_list['Country'] == elem].iloc[0]
-            if country_row['Intermediate Region Name'] == region:
-                result_array.append(elem)
-            else:
-                result_array.append('Other')
-        region_specific_labels.append(result_array)
-
-    # Display tSNE results of countries within each intermediate region
-
-    df_subset = pd.DataFrame()
-    df_subset['tsne-2d-one'] = tsne_results[:,0]
-    df_subset['tsne-2d-two'] = tsne_results[:,1]
-    for i in range(0, len(region_specific_labels)):
-        df_subset['Classes'] = region_specific_labels[i]
-
-        unique_classes = np.unique(region_specific_labels[i])
-        modified_unique = list(np.delete(unique_classes, np.where(unique_classes == 'Other')))
-        color_palette = sns.color_palette("hls", len(modified_unique)).as_hex()
-        color_palette.append('#d3d3d3')
-        modified_unique.append('Other')
-
-        plt.figure(figsize=(16,10), clear=True)
-        scatterplot = sns.scatterplot(
-            x="tsne-2d-one", y="tsne-2d-two",
-            hue="Classes",
-            hue_order=modified_unique,
-            palette=sns.color_palette(color_palette),
-            data=df_subset,
-            legend="full",
-            alpha=0.3
-        )
-        if include_distances:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Region/{region_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Region/{region_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Model_Input/{dataset_name}/Region/{region_classes[i]}/output.png')
-        else:
-            if not os.path.isdir(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Region/{region_classes[i]}'):
-                os.makedirs(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Region/{region_classes[i]}')
-            scatterplot.figure.savefig(f'{REPO_PATH}/CLIP_Embeddings/t-SNE/Embeddings/{dataset_name}/Region/{region_classes[i]}/output.png')            
-
-
-def conduct_tsne_analysis(REPO_PATH, dataset_name, only_europe, include_distances):
+        only_europe (Boolean, optional): Save the plots in the Europe folder. Defaults to False.
+    """
+    subfolders = ('Europe', 'Region') if only_europe else ('Region',)
+    return [focus_panel(plot_path(REPO_PATH, dataset_name, include_distances, *subfolders, region), tsne_results, indices, y[indices])
+            for region, indices in split_indices(regions).items()]
+
+def render_panel(panel):
+    """Render and save a single scatter plot from its pre-sliced point arrays.
+    A pyplot free Figure is used, so panels can be rendered in worker processes.
+
+    Args:
+        panel (tuple): output path, class names, points of each class and colors of each class
+    """
+    output_path, class_order, class_points, colors = panel
+    figure = Figure(figsize=(16,10))
+    ax = figure.subplots()
+    # draw 'Other' first, so it does not cover the colored classes
+    draw_order = sorted(range(len(class_order)), key=lambda i: class_order[i] != 'Other')
+    for i in draw_order:
+        ax.scatter(class_points[i][:,0], class_points[i][:,1], s=36, color=colors[i], alpha=0.3, edgecolors='w', linewidths=0.5, label=class_order[i])
+    handles, labels = ax.get_legend_handles_labels()
+    ordered = sorted(range(len(labels)), key=lambda i: class_order.index(labels[i]))
+    ax.legend([handles[i] for i in ordered], [labels[i] for i in ordered], title='Classes')
+    ax.set_xlabel('tsne-2d-one')
+    ax.set_ylabel('tsne-2d-two')
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    figure.savefig(output_path)
+
+def render_panels(panels, num_workers=None):
+    """Render independent panels in parallel worker processes
+
+    Args:
+        panels (List): panels to render
+        num_workers (int, optional): number of worker processes, 1 renders in this process. Defaults to the number of CPUs.
+    """
+    if num_workers == 1 or len(panels) <= 1:
+        for panel in panels:
+            render_panel(panel)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(render_panel, panels))
+
+def conduct_tsne_analysis(REPO_PATH, dataset_name, only_europe, include_distances, pca_components=50, max_samples=None, use_cache=True, num_workers=None):
     """Run t-SNE analysis on a dataset
 
     Args:
@@ -366,6 +245,10 @@ def conduct_tsne_analysis(REPO_PATH, dataset_name, only_europe, include_distance
         dataset_name (str): unique dataset name from {geoguessr, aerial, tourist}
         only_europe (Boolean): Defines whether only european samples will be analyzed
         include_distances (Boolean): Defines whether the t-SNE analysis will be undertaken on the embeddings or embeddings appended with distances to prompts 
+        pca_components (int, optional): Number of PCA components before the t-SNE, None to disable the reduction. Defaults to 50.
+        max_samples (int, optional): Maximal number of samples for the t-SNE fit, the others are placed out of sample. Defaults to None.
+        use_cache (Boolean, optional): Reuse cached t-SNE results of identical inputs. Defaults to True.
+        num_workers (int, optional): Number of processes rendering the plots. Defaults to the number of CPUs.
     """    
     country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')
 
@@ -376,36 +259,23 @@ def conduct_tsne_analysis(REPO_PATH, dataset_name, only_europe, include_distance
         combined_df = load_data(REPO_PATH, dataset_name, country_list)
     y = combined_df['label'].to_numpy()
 
-    # Get sets of country, region and continent classes
-    regions = []
-    continents = []
-    for elem in y:
-        country_row = country_list.loc[country_list['Country'] == elem].iloc[0]
-        regions.append(country_row['Intermediate Region Name'])
-        continents.append(country_row['Continent'])
-
-    region_classes = np.unique(regions)
-    continent_classes = np.unique(continents)
-
+    # Get the region and continent of every sample
+    regions, continents = map_labels(y, country_list)
 
     #Create numpy array for TSNE
-    if include_distances:
-        X = combined_df["model_input"].apply(transform_buffer_to_array).to_list()
-    else:
-        X = combined_df["Embeddings"].apply(transform_tensor_rep_to_array).to_list()
-    X = np.array(X)
-    X = np.squeeze(X)
+    X = projection.load_feature_matrix(combined_df, include_distances)
 
     # Run TSNE
-    tsne = TSNE(n_components=2, verbose=1, init='pca')
-    tsne_results = tsne.fit_transform(X)
+    cache_dir = f'{REPO_PATH}/CLIP_Embeddings/t-SNE/cache' if use_cache else None
+    tsne_results = projection.project(X, y, pca_components=pca_components, max_samples=max_samples, cache_dir=cache_dir)
     if (not only_europe):
-        save_continent_plot(REPO_PATH, tsne_results, dataset_name, continents, continent_classes, include_distances)
-        save_region_plots(REPO_PATH, y, country_list, tsne_results, dataset_name, continent_classes, include_distances)
-        save_country_plots(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances)
+        panels = continent_panels(REPO_PATH, tsne_results, dataset_name, continents, include_distances)
+        panels += region_panels(REPO_PATH, tsne_results, dataset_name, regions, continents, include_distances)
+        panels += country_panels(REPO_PATH, y, tsne_results, dataset_name, regions, include_distances)
     else:
-        save_region_plots_europe(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances)
-        save_country_plots_europe(REPO_PATH, y, country_list, tsne_results, dataset_name, region_classes, include_distances)
+        panels = region_panels_europe(REPO_PATH, tsne_results, dataset_name, regions, include_distances)
+        panels += country_panels(REPO_PATH, y, tsne_results, dataset_name, regions, include_distances, only_europe=True)
+    render_panels(panels, num_workers)
 
 
 if __name__ == "__main__":
@@ -418,9 +288,18 @@ if __name__ == "__main__":
                         required=False, help='Name of dataset to conduct tsne analysis on', default='geoguessr')
     parser.add_argument('-d', '--debug', action='store_true',
                         required=False, help='Enable debug mode', default=False)
+    parser.add_argument('--pca_components', metavar='int', type=int,
+                        required=False, help='Number of PCA components before the t-SNE, 0 to disable the reduction', default=50)
+    parser.add_argument('--max_samples', metavar='int', type=int,
+                        required=False, help='Maximal number of samples for the t-SNE fit (stratified by label), the others are placed out of sample', default=None)
+    parser.add_argument('--no_cache', action='store_true',
+                        required=False, help='Recompute the t-SNE results even if they are cached', default=False)
+    parser.add_argument('--num_workers', metavar='int', type=int,
+                        required=False, help='Number of processes rendering the plots', default=None)
     args = parser.parse_args()
 
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         REPO_PATH = paths['repo_path']
-        conduct_tsne_analysis(REPO_PATH,dataset_name=args.dataset_name,only_europe=False,include_distances=True)
\ No newline at end of file
+        conduct_tsne_analysis(REPO_PATH,dataset_name=args.dataset_name,only_europe=False,include_distances=True,
+                              pca_components=args.pca_components or None,max_samples=args.max_samples,use_cache=not args.no_cache,num_workers=args.num_workers)
\ No newline at end of file
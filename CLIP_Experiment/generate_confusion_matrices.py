@@ -1,7 +1,6 @@
 import pandas as pd
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 import sys
 sys.path.append('.')
 from utils.confusion_matrix import create_and_save_confusion_matrices
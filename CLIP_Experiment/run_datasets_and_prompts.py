@@ -5,7 +5,12 @@ from typing import Callable, List
 from torch.utils.data import DataLoader
 from utils import load_dataset
 import utils.load_dataset as geo_data
-import clip
+from utils.image_preprocessing import FastPreprocessor
+from utils.tensor_cache import PreprocessedTensorCache
+from utils import backbones
+from utils.embedding_client import EmbeddingClient
+from utils.prompt_bank import PromptBank
+from utils.embedding_writer import run_pipeline
 import torch
 import csv
 import pandas as pd
@@ -13,6 +18,8 @@ import argparse
 import yaml
 import os
 import tqdm
+import time
+import threading
 from datetime import datetime
 import random
 
@@ -24,7 +31,7 @@ class ModelTester:
     Attributes:
         test_set (geo_data.ImageDataset_from_df): The test dataset.
         model (torch.nn.Module): The model to test.
-        prompt (Callable): Transformation for the prompt given the country name.
+        prompt (List[Callable | str]): Transformations for the prompt given the country name, or templates (see utils/prompt_bank.py).
         batch_size (int): The batch size to use.
         country_list (List[str]): List of all possible countries.
         seed (int): Random seed used for operations.
@@ -32,9 +39,13 @@ class ModelTester:
         model_name (str): The name of the model that is used.
         prompt_name (str): The name of the prompt used.
         custom_tag (str): Custom tag for naming the experiment.
+        client (EmbeddingClient): Client of an embedding server, that is used instead of the model.
+        prompt_bank (PromptBank): Cached text embeddings of the prompts, used instead of encoding the prompts with the model.
+        group_size (int): Number of consecutive images per evaluation group, recorded in the group column of the results.
+        queue_size (int): Maximal number of batches waiting for the writer thread.
 
     Methods:
-        __init__(self, dataset: geo_data.ImageDataset_from_df, model: torch.nn.Module, prompt: Callable, batch_size: int, country_list: List[str], seed: int, folder_path: str, model_name: str, prompt_name: str, custom_tag: str):
+        __init__(self, dataset: geo_data.ImageDataset_from_df, model: torch.nn.Module, prompt: Callable, batch_size: int, country_list: List[str], seed: int, folder_path: str, model_name: str, prompt_name: str, custom_tag: str, client: EmbeddingClient = None, prompt_bank: PromptBank = None, group_size: int = None, queue_size: int = 4):
             Initializes a new instance of the ModelTester class.
 
         run_test(self):
@@ -42,29 +53,49 @@ class ModelTester:
             The results are saved as CSV files using the structure:
             {output_folder}/Experiments/{model_name}/{prompt_name}/{dataset_name}-{custom_tag}/{date}-{batch_number}.csv
 
+        run_test_of_prompt(self, texts: List[str], prompt_name: str, device: str):
+            Yields the results of one prompt with the CLIP model.
+
+        run_test_with_prompt_bank(self, device: str):
+            Yields the results of all prompts with the text embeddings of the prompt bank, every batch of images is encoded once.
+
+        run_test_on_server(self, texts: List[str], prompt_name: str):
+            Yields the results of one prompt with the embedding server of the client.
+
+        write_results(self, results):
+            Saves the results of the batches in a writer thread with a bounded queue.
+
         __save_data_to_file(self, data: pd.DataFrame, model_name: str, prompt_name: str, dataset_name: str, batch_number: str, custom_tag: str = None, output_dir='./Experiments/'):
             Saves data from a Pandas DataFrame as a CSV file in the specified structure.
 
     Usage:
         # Example usage:
-        tester = ModelTester(dataset=my_dataset, model=my_model, prompt=my_prompt, batch_size=32, country_list=my_country_list, seed=42, folder_path='./', model_name='MyModel', prompt_name='MyPrompt', custom_tag='Tag1')
+        tester = ModelTester(dataset=my_dataset, model=my_model, prompt=my_prompt, batch_size=32, country_list=my_country_list, seed=42, folder_path='./', model_name='MyModel', prompt_name='MyPrompt', custom_tag='Tag1', group_size=calculate_group_size(len(my_dataset)))
         tester.run_test()
     """
 
-    def __init__(self, dataset: geo_data.ImageDataset_from_df, model: torch.nn.Module, prompt: List[Callable], batch_size: int, country_list: List[str], seed: int, folder_path: str, model_name: str, prompt_name: List[str], custom_tag: str):
+    def __init__(self, dataset: geo_data.ImageDataset_from_df, model: torch.nn.Module, prompt: List[Callable], batch_size: int, country_list: List[str], seed: int, folder_path: str, model_name: str, prompt_name: List[str], custom_tag: str, client: EmbeddingClient = None, prompt_bank: PromptBank = None, group_size: int = None, queue_size: int = 4):
         """Generate a ModelTester object, that can be used to test the model.
 
         Args:
             dataset (geo_data.ImageDataset_from_df): The test-dataset.
             model (torch.nn.Module): The Model to test.
-            prompt (List[Callable]): Transformations for prompts given the countryname.
-            batch_size (int): The batch size to use.
+            prompt (List[Callable | str]): Transformations for prompts given the countryname, or templates with {} for the country.
+                With a prompt bank they are names or templates of the bank.
+            batch_size (int): The batch size to use, only the compute efficiency depends on it if group_size is given.
             country_list (List[str]): List of all possible countries.
             seed (int): Random seed used for operations.
             folder_path (str): Path to save results to.
             model_name (str): The name of the model that is used.
             prompt_name (List[str]): The name of all prompts used.
             custom_tag (str): Custom tag for naming experiment.
+            client (EmbeddingClient, optional): Client of an embedding server (utils/embedding_server.py), the images are then
+                encoded by the server and model can be None. Defaults to None.
+            prompt_bank (PromptBank, optional): Bank of the prompts (utils/prompt_bank.py), the cached text embeddings of the prompts are used
+                and the images are encoded once for all prompts. Defaults to None.
+            group_size (int, optional): Number of consecutive images per evaluation group (see calculate_group_size), the group of every image
+                is saved in the group column and the metrics are calculated per group. Defaults to None, every batch file is one group.
+            queue_size (int, optional): Maximal number of batches waiting for the writer thread (see write_results). Defaults to 4.
         """
         self.test_set = dataset
         self.model = model
@@ -76,36 +107,153 @@ class ModelTester:
         self.model_name = model_name
         self.prompt_name = prompt_name
         self.custom_tag = custom_tag
+        self.client = client
+        self.prompt_bank = prompt_bank
+        self.group_size = group_size
+        self.queue_size = queue_size
         self.performance_data = None
 
     def run_test(self):
         """Runs the model on the given test set, with the given batchsize.
         The results are saved as csv files using the strucutre:
         {output_folder}/Experiments/{model_name}/{prompt_name}/{dateset_name}-{custom_tag}/{date}-{batch_number}.csv
+        The files are written by a writer thread while the next batches are decoded and encoded, see write_results.
         """
         random.seed(self.seed)
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        # the images follow the model, a quantized model stays on the cpu
+        device = self.model.logit_scale.device if self.model is not None else "cpu"
+
+        if self.prompt_bank is not None and self.client is None:
+            self.write_results(self.run_test_with_prompt_bank(device))
+            return
 
         for promt, promt_name in zip(self.prompt,self.prompt_name):
-            country_tokens = clip.tokenize(list(map(promt, self.country_list)))
             print(f"Running data from dataset: {self.test_set.name}")
-            for batch_number, (images, labels) in enumerate(tqdm.tqdm(DataLoader(self.test_set, batch_size=self.batch_size), desc=f"Testing on {self.test_set.name}")):
+            if self.client is not None:
+                self.write_results(self.run_test_on_server(self.prompt_texts(promt), promt_name))
+                continue
+            self.write_results(self.run_test_of_prompt(self.prompt_texts(promt), promt_name, device))
+
+    def run_test_of_prompt(self, texts: List[str], prompt_name: str, device: str):
+        """Runs the test of one prompt with the CLIP model.
+
+        Args:
+            texts (List[str]): The prompts of all countries.
+            prompt_name (str): The name of the prompt.
+            device (str): The device of the images.
+
+        Yields:
+            tuple: the results of every batch, see write_results
+        """
+        import clip
+        country_tokens = clip.tokenize(texts)
+        data_loader = DataLoader(self.test_set, batch_size=self.batch_size, collate_fn=getattr(self.test_set, 'collate_fn', None))
+        for batch_number, (images, labels) in enumerate(tqdm.tqdm(data_loader, desc=f"Testing on {self.test_set.name}")):
+
+            images = images.to(device)
 
-                images = images.to(device)
+            with torch.no_grad():
 
-                with torch.no_grad():
+                logits_per_image, _ = self.model(images, country_tokens)
+                probs = logits_per_image.softmax(dim=-1).cpu().numpy()
 
-                    logits_per_image, _ = self.model(images, country_tokens)
-                    probs = logits_per_image.softmax(dim=-1).cpu().numpy()
+            yield labels, probs, batch_number * self.batch_size, prompt_name, batch_number
 
-                performance_data = pd.DataFrame({
-                    'label': labels,
-                    'All-Probs': probs.tolist()
-                })
-                self.__save_data_to_file(performance_data, self.model_name, promt_name, self.test_set.name,
-                                        batch_number, self.custom_tag, self.folder_path)
+    def write_results(self, results):
+        """Saves the results of the batches in a writer thread (see utils/embedding_writer.run_pipeline): the results of a batch are
+        converted and written while the next batches are decoded and encoded. At most queue_size batches wait for the writer, the test
+        waits for it if it falls behind. If the writer fails, the test stops and the error is raised; if the test fails, the waiting
+        results are written before its error is raised.
+
+        Args:
+            results (Iterable): Tuples of the labels, probabilities, position of the first image, prompt name and batch number of every batch.
+        """
+        written = {}
+
+        def write(result):
+            labels, probs, start, prompt_name, batch_number = result
+            file_path = self.__save_data_to_file(self.results_frame(labels, probs, start), self.model_name, prompt_name, self.test_set.name,
+                                                 batch_number, self.custom_tag, self.folder_path)
+            written[os.path.dirname(file_path)] = written.get(os.path.dirname(file_path), 0) + 1
+
+        try:
+            run_pipeline(results, write, self.queue_size)
+        finally:
+            for experiment_dir, files in written.items():
+                print(f"Model performance saved to {experiment_dir} ({files} files).")
+
+    def results_frame(self, labels: list, probs, start: int) -> pd.DataFrame:
+        """The results of a batch, with the evaluation group of every image if there is a group size.
+
+        Args:
+            labels (list): The labels of the images.
+            probs (np.ndarray): The probabilities of all countries.
+            start (int): Position of the first image of the batch in the test set.
+
+        Returns:
+            pd.DataFrame: the results
+        """
+        performance_data = pd.DataFrame({
+            'label': labels,
+            'All-Probs': probs.tolist()
+        })
+        if self.group_size is not None:
+            performance_data['group'] = [(start + i) // self.group_size for i in range(len(performance_data))]
+        return performance_data
+
+    def prompt_texts(self, prompt) -> List[str]:
+        """The prompts of all countries, of a transformation or of a template (resolved by the prompt bank if there is one)."""
+        if callable(prompt):
+            return list(map(prompt, self.country_list))
+        if self.prompt_bank is not None:
+            return self.prompt_bank.texts(self.prompt_bank.template(prompt))
+        return [prompt.replace('{}', country) for country in self.country_list]
+
+    def run_test_with_prompt_bank(self, device: str):
+        """Runs the test of all prompts with the cached text features of the prompt bank, with the same batches and files as run_test.
+        Every batch of images is encoded once and compared to the text features of all prompts as in the forward pass of CLIP, i.e. normalized
+        and multiplied in the precision of the model (float16 on the GPU), so the probabilities equal those of run_test_of_prompt.
 
-    def __save_data_to_file(self, data: pd.DataFrame, model_name: str, prompt_name: str, dataset_name: str, batch_number: str, custom_tag: str = None, output_dir='./Experiments/'):
+        Args:
+            device (str): The device of the images.
+
+        Yields:
+            tuple: the results of every batch and prompt, see write_results
+        """
+        print(f"Running data from dataset: {self.test_set.name}")
+        text_features = [torch.from_numpy(self.prompt_bank.features(promt)).to(device) for promt in self.prompt]
+        text_features = [features / features.norm(dim=1, keepdim=True) for features in text_features]
+        data_loader = DataLoader(self.test_set, batch_size=self.batch_size, collate_fn=getattr(self.test_set, 'collate_fn', None))
+        for batch_number, (images, labels) in enumerate(tqdm.tqdm(data_loader, desc=f"Testing on {self.test_set.name}")):
+            with torch.no_grad():
+                image_features = self.model.encode_image(images.to(device))
+                image_features = image_features / image_features.norm(dim=1, keepdim=True)
+                logit_scale = self.model.logit_scale.exp()
+                probs = [(logit_scale * image_features @ features.t()).softmax(dim=-1).cpu().numpy() for features in text_features]
+            for promt_probs, promt_name in zip(probs, self.prompt_name):
+                yield labels, promt_probs, batch_number * self.batch_size, promt_name, batch_number
+
+    def run_test_on_server(self, texts: List[str], prompt_name: str):
+        """Runs the test of one prompt on the embedding server, with the same batches as run_test.
+
+        Args:
+            texts (List[str]): The prompts of all countries.
+            prompt_name (str): The name of the prompt.
+
+        Yields:
+            tuple: the results of every batch, see write_results
+        """
+        for batch_number, start in enumerate(tqdm.tqdm(range(0, len(self.test_set), self.batch_size), desc=f"Testing on {self.test_set.name}")):
+            paths = self.test_set.images[start:start + self.batch_size]
+            labels = self.test_set.captions[start:start + self.batch_size]
+            if self.test_set.target_transform:
+                labels = [self.test_set.target_transform(label) for label in labels]
+            logits_per_image = torch.from_numpy(self.client.logits(texts, paths=paths))
+            probs = logits_per_image.softmax(dim=-1).numpy()
+
+            yield labels, probs, start, prompt_name, batch_number
+
+    def __save_data_to_file(self, data: pd.DataFrame, model_name: str, prompt_name: str, dataset_name: str, batch_number: str, custom_tag: str = None, output_dir='./Experiments/') -> str:
         """Saves data from a Pandas DataFrame as a csv file in the way: 
         {model_name}/{prompt_name}/{dateset_name}-{custom_tag}/{date}-{batch_number}.csv
         Args:
@@ -119,6 +267,10 @@ class ModelTester:
 
         Raises:
             TypeError: Data parameter must be a pandas DataFrame
+            OSError: The file could not be written, a missing result file would change the statistics.
+
+        Returns:
+            str: the path of the file
         """
         # Check if data is a DataFrame
         if not isinstance(data, pd.DataFrame):
@@ -137,71 +289,176 @@ class ModelTester:
         # Save the DataFrame to a CSV file
         try:
             data.to_csv(file_path, index=False)
-            print(f"Model performance saved to {file_path} successfully.")
         except Exception as e:
             print(
                 f"Error: Unable to save model performance to {file_path}. {str(e)}")
+            raise
+        return file_path
 
-
-def run_experiments(DATA_PATH: str, REPO_PATH: str):
+def run_experiments(DATA_PATH: str, REPO_PATH: str, fast_decode: bool = False, tensor_cache_dir: str = None, tensor_cache_max_gb: float = 8.0, backbone: str = backbones.DEFAULT_BACKBONE, server_url: str = None, quantization: str = None, batch_size: int = None, max_batch_memory_gb: float = 4.0):
     """Runs CLIP experiments for 10 different seeds, over the 3 datasets and 2 prompts
     The experiment results will be saved in '{REPO_PATH}/CLIP_Experiment/clip_results'
     Args:
         DATA_PATH (str): path to the data folder.
         REPO_PATH (str): path to the repo folder
+        fast_decode (bool, optional): decode JPEGs in draft mode and normalize in batches (see utils/image_preprocessing.py). Defaults to False.
+        tensor_cache_dir (str, optional): folder of a persistent cache of the preprocessed images, that is shared by all seeds and runs. Defaults to None.
+        tensor_cache_max_gb (float, optional): maximal size of the cache in GiB. Defaults to 8.0.
+        backbone (str, optional): CLIP backbone (see utils/backbones.py), the results of other backbones than the default
+            are saved in '{REPO_PATH}/CLIP_Experiment/clip_results_{backbone}'. Defaults to backbones.DEFAULT_BACKBONE.
+        server_url (str, optional): url of a running embedding server (utils/embedding_server.py), that encodes the images
+            instead of a model loaded by this process. The backbone of the server is used. Defaults to None.
+        quantization (str, optional): run the image encoder on the CPU with int8 quantization, 'dynamic' or 'static' (see utils/quantization.py),
+            the results are saved in '{results folder}_int8_{quantization}'. Defaults to None.
+        batch_size (int, optional): number of images encoded at once. The 20 evaluation groups of every dataset (see calculate_group_size) are
+            recorded in the results, so the metrics do not depend on it. Defaults to None, the batch size with the highest throughput
+            within max_batch_memory_gb (see tune_batch_size), or 64 with an embedding server.
+        max_batch_memory_gb (float, optional): maximal memory of a batch in GiB when the batch size is tuned. Defaults to 4.0.
     """
     seeds = [4808,4947,5723,3838,5836,3947,8956,5402,1215,8980]
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocessor = clip.load("ViT-B/32", device=device)
+    client = None
+    if server_url is not None:
+        client = EmbeddingClient(server_url)
+        backbone = client.stats()['backbone']
+        model, preprocessor = None, None
+        print(f"Using the embedding server at {server_url} with backbone {backbone}")
+        prompt_bank = PromptBank(REPO_PATH, backbone, client=client)
+    elif quantization is not None:
+        from utils.quantization import load_quantized_backbone
+        model, preprocessor = load_quantized_backbone(backbone, quantization, DATA_PATH, os.path.join(REPO_PATH, 'models'))
+        # the text encoder is not quantized, the text embeddings are those of the backbone
+        prompt_bank = PromptBank(REPO_PATH, backbone, model=model)
+    else:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, preprocessor = backbones.load_backbone(backbone, device, os.path.join(REPO_PATH, 'models'))
+        prompt_bank = PromptBank(REPO_PATH, backbone, model=model)
+    if batch_size is None:
+        batch_size = tune_batch_size(model, max_batch_memory_gb) if client is None else 64
+    results_folder = 'clip_results' if backbone == backbones.DEFAULT_BACKBONE else 'clip_results_' + os.path.splitext(os.path.basename(backbones.weight_file(backbone)))[0]
+    if quantization is not None and client is None:
+        results_folder += f'_int8_{quantization}'
+    cache = None
+    if tensor_cache_dir is not None and client is None:
+        cache = PreprocessedTensorCache(tensor_cache_dir, FastPreprocessor.from_clip(preprocessor, draft=fast_decode).config(), int(tensor_cache_max_gb * 2**30))
 
     for seed in seeds:
         datasets = []
 
         geoguessr = load_dataset.load_data(f'{DATA_PATH}/geoguessr/', 0, 5000, False, False, seed)
         geoguessr = geoguessr.head(int(len(geoguessr)*0.2))
-        geoguessr = load_dataset.ImageDataset_from_df(geoguessr, preprocessor, name= "geoguessr")
+        geoguessr = load_dataset.ImageDataset_from_df(geoguessr, preprocessor, name= "geoguessr", fast_decode=fast_decode, cache=cache)
         datasets.append(geoguessr)
         tourist = load_dataset.load_data(f'{DATA_PATH}/tourist/', 0, 5000, False, False, seed)
-        tourist = load_dataset.ImageDataset_from_df(tourist, preprocessor, name= "tourist")
+        tourist = load_dataset.ImageDataset_from_df(tourist, preprocessor, name= "tourist", fast_decode=fast_decode, cache=cache)
         datasets.append(tourist)
         aerialmap = load_dataset.load_data(f'{DATA_PATH}/aerial/', 0, 5000, False, False, seed)
-        aerialmap = load_dataset.ImageDataset_from_df(aerialmap, preprocessor, name= "aerial")
+        aerialmap = load_dataset.ImageDataset_from_df(aerialmap, preprocessor, name= "aerial", fast_decode=fast_decode, cache=cache)
         datasets.append(aerialmap)
 
-        default_prompt = lambda x: f"{x}"
-        extended_prompt = lambda x: f"This image shows the country {x}"
-
-        batch_sizes = []
-
-
-        geoguessr_batch_size = calculate_batch_size(len(geoguessr))
-        batch_sizes.append(geoguessr_batch_size)
-        tourist_batch_size = calculate_batch_size(len(tourist))
-        batch_sizes.append(tourist_batch_size)
-        aerialmap_batch_size = calculate_batch_size(len(aerialmap))
-        batch_sizes.append(aerialmap_batch_size)
+        # every dataset is split into 20 evaluation groups of consecutive images, the statistical samples
+        group_sizes = [calculate_group_size(len(dataset)) for dataset in datasets]
 
         country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')["Country"].to_list()
 
         folder_path = f'{REPO_PATH}/CLIP_Experiment'
-        model_name = f'clip_results/seed_{seed}'
+        model_name = f'{results_folder}/seed_{seed}'
 
-        default_prompt_name = 'default_prompt'
-        extended_name = 'extended_prompt'
+        # templates of the prompt bank, their text embeddings are encoded once per backbone and cached
+        prompt_names = ['default_prompt', 'extended_prompt']
 
         for i in range(0,len(datasets)):
-            test = ModelTester(datasets[i], model, [default_prompt, extended_prompt], batch_sizes[i], country_list, seed, folder_path, model_name, [default_prompt_name, extended_name] , '')
+            test = ModelTester(datasets[i], model, prompt_names, batch_size, country_list, seed, folder_path, model_name, prompt_names, '', client, prompt_bank, group_sizes[i])
             test.run_test()
+            if cache is not None:
+                cache.flush()
+                print(f"Tensor cache: {cache.hits} hits, {cache.misses} misses, {cache.size_bytes() / 2**30:.2f} GiB")
 
-def calculate_batch_size(len: int):
-    """Calculates the batch size for the given length
+def calculate_group_size(len: int):
+    """Calculates the number of images per evaluation group for the given length, so that the dataset is split into 20 groups
     Args:
         len (int): The length of the dataset
     Returns:
-        int: The batch size
+        int: The group size
     """
     return len // 20 if len % 20 == 0 else len // 20 + 1
 
+def resident_memory() -> int:
+    """Current resident memory of the process in bytes, read from /proc/self/statm (None where it is not available)"""
+    try:
+        with open('/proc/self/statm') as handler:
+            return int(handler.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def run_with_peak_memory(device: torch.device, function: Callable) -> int:
+    """Runs the function and returns the peak memory in bytes during the call: allocated by torch on cuda, resident memory of the process
+    on the cpu, sampled every 5 ms by a background thread (None if it is not available).
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        function()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device)
+    peak = resident_memory()
+    if peak is None:
+        function()
+        return None
+    done = threading.Event()
+    def sample():
+        nonlocal peak
+        while not done.wait(0.005):
+            peak = max(peak, resident_memory())
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        function()
+    finally:
+        done.set()
+        sampler.join()
+    return max(peak, resident_memory())
+
+def tune_batch_size(model: torch.nn.Module, max_memory_gb: float = 4.0, candidates: List[int] = [16, 32, 64, 128, 256]) -> int:
+    """Picks the batch size of the image encoder with the highest throughput. The candidates are tried in increasing order on random images,
+    until a batch needs more than max_memory_gb, runs out of memory or does not increase the throughput by at least 5%.
+    On the cpu the memory of a batch is the peak resident memory above the resident memory before the first candidate, because freed
+    memory is not necessarily returned to the system; the bound is not applied where the resident memory is not available.
+    Args:
+        model (torch.nn.Module): The CLIP model.
+        max_memory_gb (float, optional): Maximal memory of a batch in GiB. Defaults to 4.0.
+        candidates (List[int], optional): The batch sizes to try. Defaults to [16, 32, 64, 128, 256].
+    Returns:
+        int: The batch size
+    """
+    device = model.logit_scale.device
+    n_px = model.visual.input_resolution
+    best, best_throughput = candidates[0], 0.0
+    with torch.no_grad():
+        model.encode_image(torch.zeros(1, 3, n_px, n_px, device=device))
+        baseline = resident_memory() if device.type != 'cuda' else None
+        if device.type != 'cuda' and baseline is None:
+            print("The resident memory is not available, the batch size is tuned without the memory bound")
+        for candidate in candidates:
+            images = torch.randn(candidate, 3, n_px, n_px, device=device)
+            before = torch.cuda.memory_allocated(device) if device.type == 'cuda' else baseline
+            try:
+                start = time.perf_counter()
+                peak = run_with_peak_memory(device, lambda: model.encode_image(images))
+                seconds = time.perf_counter() - start
+            except RuntimeError:
+                # out of memory
+                if device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                break
+            if peak is not None and peak - before > max_memory_gb * 2**30:
+                break
+            throughput = candidate / seconds
+            if throughput < best_throughput * 1.05:
+                break
+            best, best_throughput = candidate, throughput
+    print(f"Batch size {best} ({best_throughput:.1f} images/s)")
+    return best
+
 if __name__ == "__main__":
     """Runs the initial CLIP experiments
     """
@@ -210,10 +467,26 @@ if __name__ == "__main__":
                         help='The path to the yaml file with the stored paths')
     parser.add_argument('-d', '--debug', action='store_true',
                         required=False, help='Enable debug mode', default=False)
+    parser.add_argument('--fast_decode', action='store_true',
+                        required=False, help='Decode JPEGs in draft mode and normalize in batches', default=False)
+    parser.add_argument('--tensor_cache_dir', metavar='str',
+                        required=False, help='Folder of a persistent cache of the preprocessed images', default=None)
+    parser.add_argument('--tensor_cache_max_gb', metavar='float', type=float,
+                        required=False, help='Maximal size of the preprocessed image cache in GiB', default=8.0)
+    parser.add_argument('--backbone', metavar='str',
+                        required=False, help='The CLIP backbone, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--server_url', metavar='str',
+                        required=False, help='Url of a running embedding server, e.g. http://127.0.0.1:8765', default=None)
+    parser.add_argument('--quantization', metavar='str', choices=['dynamic', 'static'],
+                        required=False, help='Run the image encoder with int8 quantization on the CPU', default=None)
+    parser.add_argument('--batch_size', metavar='int', type=int,
+                        required=False, help='Number of images encoded at once, tuned for throughput by default', default=None)
+    parser.add_argument('--max_batch_memory_gb', metavar='float', type=float,
+                        required=False, help='Maximal memory of a batch in GiB when the batch size is tuned', default=4.0)
     args = parser.parse_args()
 
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         DATA_PATH = paths['data_path']
         REPO_PATH = paths['repo_path']
-        run_experiments(DATA_PATH, REPO_PATH)
\ No newline at end of file
+        run_experiments(DATA_PATH, REPO_PATH, args.fast_decode, args.tensor_cache_dir, args.tensor_cache_max_gb, args.backbone, args.server_url, args.quantization, args.batch_size, args.max_batch_memory_gb)
\ No newline at end of file
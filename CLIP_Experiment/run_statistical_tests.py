@@ -1,16 +1,12 @@
 import pandas as pd
 import os
 from typing import List
-from scipy import stats
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-from deepsig import aso
 import sys
 sys.path.append('.')
+from utils import statistical_tests
 import argparse
 import yaml
-import math
 
 def generate_plot(df: pd.DataFrame, plot_type: str, metric: str, output_dir: str) -> None:
     """
@@ -22,6 +18,10 @@ def generate_plot(df: pd.DataFrame, plot_type: str, metric: str, output_dir: str
         metric (str): Metric for the plot.
         output_dir (str): Directory to save the plot.
     """
+    # plotting libraries are only imported when a plot is created
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     if plot_type == 'box':
         sns.boxplot(data=df, showmeans=True)
     elif plot_type == 'violin':
@@ -48,17 +48,49 @@ def compute_paired_k_fold_cross_validation_t_test(results_1:list,results_2:list,
         raise Exception(f'The results are not the same length.')
     if num_experiments != r*k:
         raise Exception(f'The results do not coincide with the r and k values.')
-    differences = [x_i - y_i for x_i, y_i in zip(results_1, results_2)] 
-    mean = sum(differences) / num_experiments
-    variance = 0
-    for count in range(0, num_experiments):
-        variance += (differences[count] - mean)**2
-    variance *= 1/(num_experiments - 1)
-    t = mean / math.sqrt(variance/(num_experiments + 1/(k-1)))
+    t, p, df = statistical_tests.paired_k_fold_cv_t_test(np.array([results_1, results_2]), k, r)
+    return t[0, 1], p[0, 1], df
+
+
+def run_pairwise_tests(output_dir: str, comparison_df: pd.DataFrame, paired_ttest: bool, num_resamples: int = 10000, run_aso: bool = False) -> None:
+    """
+    Run all pairwise tests (t-test, effect size, bootstrap, permutation and optionally ASO) on the columns
+    of the comparison DataFrame and save them in long format to pairwise_tests.csv.
 
-    p = stats.t.sf(abs(t), num_experiments-1)
-    df= num_experiments-1
-    return t,p,df
+    Args:
+        output_dir (str): Directory to save the CSV file.
+        comparison_df (pd.DataFrame): Dataframe to be analyzed, one column per model.
+        paired_ttest (bool): Whether the rows of the columns are paired folds or not, selects the paired or unpaired variant of every test
+        num_resamples (int, optional): Number of bootstrap and permutation resamples. Defaults to 10000.
+        run_aso (bool, optional): Whether to run the ASO test of deepsig. Defaults to False.
+    """
+    results = comparison_df.to_numpy().T
+    if paired_ttest:
+        t_values, p_values, _ = statistical_tests.paired_k_fold_cv_t_test(results, 20, 10)
+    else:
+        t_values, p_values = statistical_tests.independent_t_test(results)
+    effect_sizes = statistical_tests.effect_sizes(results, paired_ttest)
+    lower, upper, bootstrap_p_values = statistical_tests.bootstrap_test(results, num_resamples, paired=paired_ttest)
+    permutation_p_values = statistical_tests.permutation_test(results, num_resamples, paired=paired_ttest)
+    if run_aso:
+        aso_values = statistical_tests.aso_test(results)
+
+    rows, cols = np.triu_indices(len(comparison_df.columns), k=1)
+    pairwise_df = pd.DataFrame({
+        'Model 1': comparison_df.columns[rows],
+        'Model 2': comparison_df.columns[cols],
+        't-value': t_values[rows, cols],
+        'p-value': p_values[rows, cols],
+        'Effect Size': effect_sizes[rows, cols],
+        'Bootstrap CI Lower': lower[rows, cols],
+        'Bootstrap CI Upper': upper[rows, cols],
+        'Bootstrap p-value': bootstrap_p_values[rows, cols],
+        'Permutation p-value': permutation_p_values[rows, cols],
+    })
+    if run_aso:
+        pairwise_df['ASO epsilon_min'] = aso_values[rows, cols]
+        pairwise_df['ASO epsilon_min reversed'] = aso_values[cols, rows]
+    pairwise_df.to_csv(f'{output_dir}/pairwise_tests.csv', index=False)
 
 
 def run_analysis_of_dataset_and_prompts(output_dir: str,comparison_df: pd.DataFrame, metric: str, paired_ttest: bool) -> None:
@@ -87,31 +119,19 @@ def run_analysis_of_dataset_and_prompts(output_dir: str,comparison_df: pd.DataFr
         analysis['Standard Deviation'].append(np.std(comparison_df[prompt]))
 
     num_datasets = len(comparison_df.columns)
+    results = comparison_df.to_numpy().T
+    if paired_ttest:
+        t_matrix, p_matrix, df = statistical_tests.paired_k_fold_cv_t_test(results, 20, 10)
+    else:
+        t_matrix, p_matrix = statistical_tests.independent_t_test(results)
+        df = len(comparison_df) - 1
+    # only the lower triangle (i > j) is reported, all other entries are set to 0
+    lower_triangle = np.tril(np.ones((num_datasets, num_datasets), dtype=bool), k=-1)
 
     for i in range(num_datasets):
-        t_values = []
-        p_values = []
-        df_values = []
-        for j in range(num_datasets):              
-            if i > j:
-                if paired_ttest:
-                    t,p,df = compute_paired_k_fold_cross_validation_t_test(comparison_df.iloc[:,i].tolist(),comparison_df.iloc[:,j].tolist(),20,10)
-                    t_values.append(t)
-                    p_values.append(p)
-                    df_values.append(df)
-                else:
-                    results = stats.ttest_ind(comparison_df.iloc[:,i].tolist(),comparison_df.iloc[:,j].tolist())
-                    t_values.append(results.statistic)
-                    p_values.append(results.pvalue)
-                    df_values.append(len(comparison_df.iloc[:,i].tolist()) - 1)
-            else:
-                t_values.append(0.0)
-                p_values.append(0.0)               
-                df_values.append(0.0) 
-
-        analysis[f'{comparison_df.columns[i]}_t_values'] = t_values
-        analysis[f'{comparison_df.columns[i]}_p_values'] = p_values
-        analysis[f'{comparison_df.columns[i]}_df_values'] = df_values
+        analysis[f'{comparison_df.columns[i]}_t_values'] = np.where(lower_triangle[i], t_matrix[i], 0.0).tolist()
+        analysis[f'{comparison_df.columns[i]}_p_values'] = np.where(lower_triangle[i], p_matrix[i], 0.0).tolist()
+        analysis[f'{comparison_df.columns[i]}_df_values'] = np.where(lower_triangle[i], df, 0.0).tolist()
 
     # Convert the analysis dictionary to a DataFrame
     analysis_df = pd.DataFrame(analysis)
@@ -123,13 +143,15 @@ def run_analysis_of_dataset_and_prompts(output_dir: str,comparison_df: pd.DataFr
     analysis_df.to_csv(f'{output_dir}/analysis.csv', index=False)
 
 
-def run_analysis_of_experiments(REPO_PATH, metric):
+def run_analysis_of_experiments(REPO_PATH, metric, pairwise_tests=False, run_aso=False):
     """
     Generate and save a plot based on the given parameters.
 
     Args:
         REPO_PATH (str): path to the repo folder.
         metric (str): name of metric used
+        pairwise_tests (bool, optional): Additionally run effect sizes, bootstrap and permutation tests for all pairs. Defaults to False.
+        run_aso (bool, optional): Additionally run the ASO test for all pairs. Defaults to False.
     """
     seeds = [4808,4947,5723,3838,5836,3947,8956,5402,1215,8980]
 
@@ -151,6 +173,8 @@ def run_analysis_of_experiments(REPO_PATH, metric):
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
         run_analysis_of_dataset_and_prompts(output_dir,comparison_df, metric, True)
+        if pairwise_tests:
+            run_pairwise_tests(output_dir, comparison_df, True, run_aso=run_aso)
     
     default_output_dir = f'{REPO_PATH}/CLIP_Experiment/statistical_tests/{metric}/default_prompt/'
     extended_prompt_output_dir = f'{REPO_PATH}/CLIP_Experiment/statistical_tests/{metric}/extended_prompt/'
@@ -160,6 +184,9 @@ def run_analysis_of_experiments(REPO_PATH, metric):
         os.makedirs(extended_prompt_output_dir)
     run_analysis_of_dataset_and_prompts(default_output_dir,default_df, metric, False)
     run_analysis_of_dataset_and_prompts(extended_prompt_output_dir,extended_prompt_df, metric, False)
+    if pairwise_tests:
+        run_pairwise_tests(default_output_dir, default_df, False, run_aso=run_aso)
+        run_pairwise_tests(extended_prompt_output_dir, extended_prompt_df, False, run_aso=run_aso)
 
 if __name__ == "__main__":
     """
@@ -168,9 +195,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Pretrained Model')
     parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
     parser.add_argument('-d', '--debug', action='store_true', required=False, help='Enable debug mode', default=False)
+    parser.add_argument('--pairwise_tests', action='store_true', required=False, help='Run effect sizes, bootstrap and permutation tests for all pairs', default=False)
+    parser.add_argument('--aso', action='store_true', required=False, help='Run the ASO test for all pairs in a process pool', default=False)
     args = parser.parse_args()
 
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         REPO_PATH = paths['repo_path']
-        run_analysis_of_experiments(REPO_PATH, 'Mixed_F1')
+        run_analysis_of_experiments(REPO_PATH, 'Mixed_F1', args.pairwise_tests, args.aso)
@@ -1,6 +1,5 @@
-import leafmap
 import os
-import requests
+import sys
 import argparse
 import yaml
 import csv
@@ -10,6 +9,11 @@ import operator
 import math
 import random
 import ast
+import time
+import hashlib
+import threading
+import requests
+from concurrent.futures import ProcessPoolExecutor
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import TimeoutException
@@ -19,6 +23,8 @@ from webdriver_manager.chrome import ChromeDriverManager
 from shapely.geometry import Point, Polygon, LineString
 from shapely.ops import nearest_points
 import shapely.wkt
+sys.path.append('.')
+from data_collection import download_engine
 
 # Options for the selenium chrome webdriver
 options = Options()
@@ -31,72 +37,112 @@ options.add_argument('--disable-notifications')
 #Set random seed for random selection of images
 random.seed(9)
 
-def find_interior_boxes(REPO_PATH):
+# Search endpoint of openaerialmap.org (the endpoint queried by leafmap.oam_search)
+OAM_API_URL = 'https://api.openaerialmap.org/meta'
+
+# Search results are reused for 30 days by default
+SEARCH_CACHE_TTL = 30 * 24 * 60 * 60
+
+def find_interior_boxes(REPO_PATH, max_workers=None):
     """Find a large interior box for each country, based on polygon data taken from natural earth (https://github.com/martynafford/natural-earth-geojson/blob/master/110m/cultural/ne_110m_admin_0_countries.json)
     Saves the internal boxes into the file interior_boxes.csv
+    The polygons are looked up by their ISO_A2 code in a dictionary and the countries are processed in a process pool.
     
     Args:
         REPO_PATH (str): Path to project folder.
+        max_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
 
     Returns:
         None
     """
-    polygon_file = open("{}/data_collection/aerial/ne_110m_admin_0_countries.json".format(REPO_PATH))
-    polygons_json = json.load(polygon_file)
-    countries_polygons = polygons_json["features"]
+    with open("{}/data_collection/aerial/ne_110m_admin_0_countries.json".format(REPO_PATH)) as polygon_file:
+        polygons_json = json.load(polygon_file)
+    # later features overwrite earlier features with the same code, as in a linear scan keeping the last match
+    polygons_by_code = {country_pol["properties"]["ISO_A2"]: country_pol["geometry"]["coordinates"] for country_pol in polygons_json["features"]}
 
     country_panda = pandas.read_csv('{}/utils/country_list/country_list_region_and_continent.csv'.format(REPO_PATH))
-    interior_boxes = []
-    for index, row in country_panda.iterrows():
-        polygon_object = []
-        for country_pol in countries_polygons:
-            if (country_pol["properties"]["ISO_A2"] == row['Alpha2Code']):
-                polygon_object = country_pol["geometry"]["coordinates"]
-        coords = []
-        nested_coords = []
-        if (len(polygon_object) > 0):
-            for el in polygon_object:
-                if len(el) > 1:
-                    points = []
-                    for point in el:
-                        points.append((float(point[0]), float(point[1])))
-                    coords.append((Polygon(points)))
-                else:
-                    nested = []
-                    for nested_point in el[0]:
-                        nested.append((float(nested_point[0]), float(nested_point[1])))
-                    nested_coords.append(Polygon(nested))
-        if (len(coords) > 0):
-            result = coords[0]
-            box = Polygon(get_rectangle(result, result.centroid))
-            count = 0
-            while not result.covers(box) and count < 10000:
-                box = box.buffer(-0.005, join_style="mitre")
-                count += 1
-            if result.covers(box):
+    arguments = [(row['Country'], row['Alpha2Code'], polygons_by_code.get(row['Alpha2Code'], [])) for _, row in country_panda.iterrows()]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(find_interior_box, arguments, chunksize=8))
+
+    interior_boxes = [result for result in results if result is not None]
+    interior_panda = pandas.DataFrame(interior_boxes)
+    interior_panda.to_csv("{}/data_collection/aerial/interior_boxes.csv".format(REPO_PATH))
+
+
+def find_interior_box(arguments):
+    """Find the interior box (or one box per polygon for countries consisting of multiple polygons) of a single country
+
+    Args:
+        arguments (tuple): The country name, its Alpha2Code and the coordinates of its natural earth geometry.
+
+    Returns:
+        dict: The row of interior_boxes.csv, None if the country has no polygon.
+    """
+    country, alpha2code, polygon_object = arguments
+    coords = []
+    nested_coords = []
+    for el in polygon_object:
+        if len(el) > 1:
+            coords.append(Polygon([(float(point[0]), float(point[1])) for point in el]))
+        else:
+            nested_coords.append(Polygon([(float(nested_point[0]), float(nested_point[1])) for nested_point in el[0]]))
+    if (len(coords) > 0):
+        result = coords[0]
+        box = shrink_until_covered(result, Polygon(get_rectangle(result, result.centroid)))
+        if box is not None:
+            xx,yy = box.exterior.coords.xy
+            return {'Country': country, 'Alpha2Code': alpha2code, 'box': [min(xx), max(yy), max(xx), min(yy)], 'boxes': ''}
+        print(country)
+        return None
+    elif (len(nested_coords) > 0):
+        boxes = []
+        for el in nested_coords:
+            box = shrink_until_covered(el, Polygon(get_rectangle(el, el.centroid)))
+            if box is not None:
                 xx,yy = box.exterior.coords.xy
-                interior_boxes.append({'Country': row['Country'], 'Alpha2Code': row['Alpha2Code'], 'box': [min(xx), max(yy), max(xx), min(yy)], 'boxes': ''})
+                boxes.append([min(xx), max(yy), max(xx), min(yy)])
             else:
-                print(row['Country'])            
-        elif (len(nested_coords) > 0):
-            result = nested_coords
-            boxes = []
-            for el in result:
-                box = Polygon(get_rectangle(el, el.centroid))
-                count = 0
-                while not el.covers(box) and count < 10000:
-                    box = box.buffer(-0.005, join_style="mitre")
-                    count += 1
-                if el.covers(box):
-                    xx,yy = box.exterior.coords.xy
-                    boxes.append([min(xx), max(yy), max(xx), min(yy)])
-                else:
-                    print(row['Country'])
-            interior_boxes.append({'Country': row['Country'], 'Alpha2Code': row['Alpha2Code'], 'box': '', 'boxes': boxes})   
+                print(country)
+        return {'Country': country, 'Alpha2Code': alpha2code, 'box': '', 'boxes': boxes}
+    print(country)
+    return None
+
+
+def shrink_until_covered(polygon, box, step=0.005, max_steps=10000):
+    """Shrinks the box by the smallest multiple of step that makes it covered by the polygon.
+    Inward offsets of the (convex) box are nested, so coverage is monotone in the number of steps
+    and the smallest number is found by bisection instead of shrinking step by step.
+    Shrinking a box until it is empty counts as covered during the search, and returns None afterwards.
+
+    Args:
+        polygon (Polygon): The country polygon
+        box (Polygon): The initial box
+        step (float, optional): Distance of a single shrinking step. Defaults to 0.005.
+        max_steps (int, optional): Maximal number of steps. Defaults to 10000.
+
+    Returns:
+        box (Polygon): The shrunken box, None if no box up to max_steps is covered.
+    """
+    def shrink(steps):
+        return box if steps == 0 else box.buffer(-step * steps, join_style="mitre")
+
+    def covered_or_empty(shrunken_box):
+        return shrunken_box.is_empty or polygon.covers(shrunken_box)
+
+    if polygon.covers(box):
+        return box
+    if not covered_or_empty(shrink(max_steps)):
+        return None
+    low, high = 0, max_steps
+    while high - low > 1:
+        middle = (low + high) // 2
+        if covered_or_empty(shrink(middle)):
+            high = middle
         else:
-            print(row['Country'])         
-    interior_panda = pandas.DataFrame(interior_boxes)
-    interior_panda.to_csv("{}/data_collection/aerial/interior_boxes.csv".format(REPO_PATH))
+            low = middle
+    result = shrink(high)
+    return None if result.is_empty else result
 
 
 def get_rectangle(polygon, center):
@@ -129,67 +175,230 @@ def get_rectangle(polygon, center):
     bbox = [[center.x - dif_x, center.y + dif_y], [center.x + dif_x, center.y + dif_y], [center.x + dif_x, center.y - dif_y], [center.x - dif_x, center.y + dif_y]]
     return bbox
 
-def get_aerial_images(REPO_PATH, DATA_PATH):
+class SearchCache:
+    """
+    On-disk cache of openaerialmap search results, one json file per search.
+    The key consists of the search endpoint, the bounding box, the limit, the gsd and the ordering of the search.
+
+    Attributes:
+        cache_dir (str): Directory of the cached searches.
+        ttl (float): Time in seconds after which a cached search expires, None to never expire.
+        offline (bool): Only use cached searches, searches that are not cached (or expired) are not sent.
+        hits (int): Number of searches answered by the cache.
+        misses (int): Number of searches not found in the cache.
+        lock (threading.Lock): Lock guarding the counters.
+    """
+
+    def __init__(self, cache_dir: str, ttl: float = SEARCH_CACHE_TTL, offline: bool = False):
+        """
+        Args:
+            cache_dir (str): Directory of the cached searches, it is created if it does not exist.
+            ttl (float, optional): Time in seconds after which a cached search expires, None to never expire. Defaults to SEARCH_CACHE_TTL.
+            offline (bool, optional): Only use cached searches. Defaults to False.
+        """
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, params: dict) -> str:
+        """Path of the cache file of a search.
+
+        Args:
+            params (dict): The endpoint and parameters of the search.
+
+        Returns:
+            str: Path of the json file.
+        """
+        key = json.dumps(params, sort_keys=True)
+        return os.path.join(self.cache_dir, '{}.json'.format(hashlib.sha256(key.encode()).hexdigest()))
+
+    def get(self, params: dict):
+        """Looks up the result of a search.
+
+        Args:
+            params (dict): The endpoint and parameters of the search.
+
+        Returns:
+            List: urls of the thumbnails, None if the search is not cached or expired.
+        """
+        path = self.path(params)
+        try:
+            with open(path) as handler:
+                entry = json.load(handler)
+        except (OSError, ValueError):
+            entry = None
+        if entry is not None and entry['params'] == params and (self.ttl is None or time.time() - entry['created'] <= self.ttl):
+            with self.lock:
+                self.hits += 1
+            return entry['images']
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, params: dict, images: list):
+        """Stores the result of a search, the file is replaced atomically.
+
+        Args:
+            params (dict): The endpoint and parameters of the search.
+            images (List): urls of the thumbnails.
+        """
+        path = self.path(params)
+        temporary_path = '{}.{}.part'.format(path, threading.get_ident())
+        with open(temporary_path, 'w') as handler:
+            json.dump({'params': params, 'created': time.time(), 'images': images}, handler)
+        os.replace(temporary_path, path)
+
+
+def get_aerial_images(REPO_PATH, DATA_PATH, max_workers=8, api_url=OAM_API_URL, cache_ttl=SEARCH_CACHE_TTL, offline=False, use_cache=True):
     """Finds images from openaerialmap.org using interior_boxes saved in interior_boxes.csv and bounding boxes (for a few island or peninsular countries) saved in island_bounding_boxes.csv
     Saves the files into the folder {DATA_PATH}/aerial
+    The searches and downloads run concurrently, completed files are recorded in {DATA_PATH}/aerial_download_journal.jsonl and skipped on a rerun.
 
     Args:
         REPO_PATH (str): Path to project folder.
         DATA_PATH (str): Path to data folder.
+        max_workers (int, optional): Number of concurrent requests. Defaults to 8.
+        api_url (str, optional): Url of the openaerialmap search endpoint. Defaults to OAM_API_URL.
+        cache_ttl (float, optional): Time in seconds after which a cached search in {DATA_PATH}/aerial_search_cache expires, None to never expire. Defaults to SEARCH_CACHE_TTL.
+        offline (bool, optional): Only use cached searches, boxes without a cached search are skipped. Defaults to False.
+        use_cache (bool, optional): Whether to cache the searches. Defaults to True.
 
     Returns:
         None
     """
-    interior_boxes = pandas.read_csv('{}/data_collection/aerial/interior_boxes.csv'.format(REPO_PATH))
+    engine = download_engine.DownloadEngine(journal_path='{}/aerial_download_journal.jsonl'.format(DATA_PATH), max_workers=max_workers)
+    cache = SearchCache('{}/aerial_search_cache'.format(DATA_PATH), cache_ttl, offline) if use_cache or offline else None
 
+    # collect all searches as (bbox, country, first box of the country)
+    searches = []
+    interior_boxes = pandas.read_csv('{}/data_collection/aerial/interior_boxes.csv'.format(REPO_PATH))
     for index, row in interior_boxes.iterrows():
-        count = 0
         if not pandas.isnull(row["box"]):
-            new_count = get_images_from_bbox(ast.literal_eval(row["box"]), count, row["Country"], DATA_PATH)
-            count = new_count
+            searches.append((ast.literal_eval(row["box"]), row["Country"], True))
         elif not pandas.isnull(row["boxes"]):
             loaded_array = ast.literal_eval(row["boxes"])
-            for el in loaded_array:
-                new_count = get_images_from_bbox(el, count, row["Country"], DATA_PATH)   
-                count = new_count
+            for i, el in enumerate(loaded_array):
+                searches.append((el, row["Country"], i == 0))
 
     island_bounding_boxes = pandas.read_csv('{}/data_collection/aerial/island_bounding_boxes.csv'.format(REPO_PATH))
     for index, row in island_bounding_boxes.iterrows():
-        get_images_from_bbox([row['x1'], row['y1'], row['x2'], row['y2']], 0, "islandbbox-{}".format(row["Country"]), DATA_PATH) 
+        searches.append(([row['x1'], row['y1'], row['x2'], row['y2']], "islandbbox-{}".format(row["Country"]), True))
+
+    def search_images(search):
+        try:
+            return oam_search(engine, search[0], api_url, cache=cache)
+        except requests.RequestException as e:
+            # a failing search must not abort the other searches and the downloads
+            print("Error: Unable to search the images of {} in {}. {}".format(search[1], search[0], str(e)))
+            return []
+
+    search_results = engine.map(search_images, searches)
+    if cache is not None:
+        print('Search cache: {} hits, {} misses'.format(cache.hits, cache.misses))
+
+    # assign the file names in the order of the boxes, independent of the order in which the searches finished
+    jobs = []
+    count = 0
+    for (bbox, country, first_box), images in zip(searches, search_results):
+        if first_box:
+            count = 0
+        new_jobs, count = get_download_jobs(images, count, country, DATA_PATH)
+        jobs += new_jobs
+
+    print(engine.download_all(jobs))
+
+
+def oam_search(engine, bbox, api_url=OAM_API_URL, limit=100, gsd_to=0.05, order_by='gsd', sort='asc', cache=None):
+    """Searches openaerialmap for images within the bounding box, with the same parameters as leafmap.oam_search
+    If a cache is given, a cached result is returned instead of sending the search. In offline mode a search that is not cached returns no images.
+
+    Args:
+        engine (DownloadEngine): The engine used for the request
+        bbox (List): The bounding box that provides the area within which images can be found
+        api_url (str, optional): Url of the openaerialmap search endpoint. Defaults to OAM_API_URL.
+        limit (int, optional): Maximal number of results. Defaults to 100.
+        gsd_to (float, optional): Maximal ground sample distance. Defaults to 0.05.
+        order_by (str, optional): Field to order the results by. Defaults to 'gsd'.
+        sort (str, optional): Sort order. Defaults to 'asc'.
+        cache (SearchCache, optional): Cache of the search results. Defaults to None.
+
+    Returns:
+        images (List): urls of the thumbnails of all results
+    """
+    params = {'bbox': ','.join(map(str, bbox)), 'limit': limit, 'gsd_to': gsd_to, 'order_by': order_by, 'sort': sort}
+    if cache is not None:
+        cache_params = dict(params, api_url=api_url)
+        images = cache.get(cache_params)
+        if images is not None:
+            return images
+        if cache.offline:
+            print("Offline: no cached search for the box {}".format(params['bbox']))
+            return []
+    response = engine.get(api_url, params=params).json()
+    images = [result['properties']['thumbnail'] for result in response.get('results', []) if 'thumbnail' in result.get('properties', {})]
+    if cache is not None:
+        cache.put(cache_params, images)
+    return images
+
+
+def get_download_jobs(images, count, country, DATA_PATH):
+    """Selects up to 20 random images of a search result and assigns their file names
+
+    Args:
+        images (List): urls of the found thumbnails
+        count (int): The current amount of images already found
+        country (str): the name of the country (prefaced with islandbbox- for island countries) to provide the folder and path for saving of the images
+        DATA_PATH (str): Path to data folder.
+
+    Returns:
+        jobs (List): (url, path) tuples of the images to download
+        count (int): the updated amount of images already found
+    """
+    jobs = []
+    if len(images) != 0:
+        images = list(images)
+        random.shuffle(images)
+        only_country = country.split('-')[-1]
+        for i in range(0,min(20,len(images))):
+            jobs.append((images[i], "{}/aerial/{}/aerial-{}-{}.png".format(DATA_PATH, only_country,country,count)))
+            count += 1
+    return jobs, count
 
 
-def get_images_from_bbox(bbox, count, country, DATA_PATH):
-    """Downloads images within the given bounding box from openaerialmap using the leafmap module
+def get_images_from_bbox(bbox, count, country, DATA_PATH, engine=None, api_url=OAM_API_URL, cache=None):
+    """Downloads images within the given bounding box from openaerialmap
 
     Args:
         bbox (List): The bounding box that provides the area within which images can be found
         count (int): The current amount of images already found
         country (str): the name of the country (prefaced with islandbbox- for island countries) to provide the folder and path for saving of the images
         DATA_PATH (str): Path to data folder.
+        engine (DownloadEngine, optional): The engine used for the downloads. Defaults to a new engine without journal.
+        api_url (str, optional): Url of the openaerialmap search endpoint. Defaults to OAM_API_URL.
+        cache (SearchCache, optional): Cache of the search results. Defaults to None.
 
     Returns:
         count (int): the updated amount of images already found
     """
-    gdf = leafmap.oam_search(
-        bbox=bbox, limit=100, gsd_to=0.05, order_by='gsd', sort='asc'
-    )
-    if gdf is not None:
-        images = gdf['thumbnail'].tolist()
-        if len(images) != 0:
-            random.shuffle(images)
-            only_country = country.split('-')[-1]
-            if not os.path.isdir("{}/aerial/{}/".format(DATA_PATH, only_country)):
-                os.makedirs("{}/aerial/{}/".format(DATA_PATH, only_country))
-            for i in range(0,min(20,len(images))):
-                    img_data = requests.get(images[i]).content
-                    with open("{}/aerial/{}/aerial-{}-{}.png".format(DATA_PATH, only_country,country,count), 'wb') as handler:
-                        handler.write(img_data)
-                    count += 1
+    if engine is None:
+        engine = download_engine.DownloadEngine()
+    images = oam_search(engine, bbox, api_url, cache=cache)
+    jobs, count = get_download_jobs(images, count, country, DATA_PATH)
+    engine.download_all(jobs)
     return count
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Pretrained Model')
     parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--max_workers', metavar='int', type=int, required=False, help='Number of concurrent requests', default=8)
+    parser.add_argument('--api_url', metavar='str', required=False, help='Url of the openaerialmap search endpoint, e.g. of a local_oam_server.py', default=OAM_API_URL)
+    parser.add_argument('--cache_ttl', metavar='float', type=float, required=False, help='Days after which a cached search expires', default=SEARCH_CACHE_TTL / (24 * 60 * 60))
+    parser.add_argument('--offline', action='store_true', required=False, help='Only use cached searches', default=False)
+    parser.add_argument('--no_search_cache', action='store_true', required=False, help='Do not cache the searches', default=False)
     args = parser.parse_args()
 
     with open(args.yaml_path) as file:
@@ -197,4 +406,4 @@ if __name__ == "__main__":
         DATA_PATH = paths['data_path']
         REPO_PATH = paths['repo_path']
         # find_interior_boxes(REPO_PATH)
-        get_aerial_images(REPO_PATH, DATA_PATH)
\ No newline at end of file
+        get_aerial_images(REPO_PATH, DATA_PATH, args.max_workers, args.api_url, args.cache_ttl * 24 * 60 * 60, args.offline, not args.no_search_cache)
\ No newline at end of file
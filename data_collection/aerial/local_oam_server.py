@@ -0,0 +1,115 @@
+import argparse
+import json
+import struct
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_thumbnail(seed: int, size: int = 8) -> bytes:
+    """Creates a small, valid single colour png image
+
+    Args:
+        seed (int): Seed of the colour of the image
+        size (int, optional): Width and height of the image. Defaults to 8.
+
+    Returns:
+        bytes: The png file
+    """
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff)
+
+    colour = bytes([seed * 37 % 256, seed * 91 % 256, seed * 173 % 256])
+    raw = b''.join(b'\x00' + colour * size for _ in range(size))
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw)) + chunk(b'IEND', b'')
+
+
+class LocalOAMHandler(BaseHTTPRequestHandler):
+    """
+    Serves a stand-in of the openaerialmap search endpoint (/meta) and fake thumbnails (/thumbnails/{name}.png).
+    The search returns server.results_per_search results for every bounding box.
+    If server.failures_per_thumbnail is larger than zero, every thumbnail is answered with a 503 error that many times before it is served, to exercise the retries.
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/meta':
+            self.send_search_results(parse_qs(url.query))
+        elif url.path.startswith('/thumbnails/'):
+            self.send_thumbnail(url.path)
+        else:
+            self.send_error(404)
+
+    def send_search_results(self, query):
+        bbox = query.get('bbox', [''])[0]
+        limit = int(query.get('limit', ['100'])[0])
+        host = f'http://{self.server.server_address[0]}:{self.server.server_address[1]}'
+        box_id = zlib.crc32(bbox.encode())
+        results = [{'properties': {'thumbnail': f'{host}/thumbnails/{box_id}-{i}.png'}, 'gsd': 0.01}
+                   for i in range(min(limit, self.server.results_per_search))]
+        self.send_bytes(json.dumps({'meta': {'found': len(results)}, 'results': results}).encode(), 'application/json')
+        with self.server.lock:
+            self.server.search_requests += 1
+
+    def send_thumbnail(self, path):
+        with self.server.lock:
+            failures = self.server.failures.get(path, 0)
+            if failures < self.server.failures_per_thumbnail:
+                self.server.failures[path] = failures + 1
+            else:
+                self.server.thumbnail_requests += 1
+        if failures < self.server.failures_per_thumbnail:
+            self.send_error(503)
+            return
+        self.send_bytes(fake_thumbnail(zlib.crc32(path.encode())), 'image/png')
+
+    def send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server(port: int = 0, results_per_search: int = 30, failures_per_thumbnail: int = 0):
+    """Starts the local openaerialmap stand-in in a background thread
+
+    Args:
+        port (int, optional): Port of the server, 0 selects a free port. Defaults to 0.
+        results_per_search (int, optional): Number of results of every search. Defaults to 30.
+        failures_per_thumbnail (int, optional): Number of 503 errors before a thumbnail is served. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its search endpoint is http://127.0.0.1:{server.server_address[1]}/meta
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), LocalOAMHandler)
+    server.results_per_search = results_per_search
+    server.failures_per_thumbnail = failures_per_thumbnail
+    server.failures = {}
+    server.search_requests = 0
+    server.thumbnail_requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    """Serves a local stand-in of openaerialmap, run aerial_data_collection.py with --api_url http://127.0.0.1:{port}/meta against it
+    """
+    parser = argparse.ArgumentParser(description='Local openaerialmap stand-in')
+    parser.add_argument('--port', metavar='int', type=int, required=False, help='Port of the server', default=8000)
+    parser.add_argument('--results_per_search', metavar='int', type=int, required=False, help='Number of results of every search', default=30)
+    parser.add_argument('--failures_per_thumbnail', metavar='int', type=int, required=False, help='Number of 503 errors before a thumbnail is served', default=0)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.results_per_search, args.failures_per_thumbnail)
+    print(f"Serving the openaerialmap stand-in at http://127.0.0.1:{server.server_address[1]}/meta")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import threading
+import requests
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HostRateLimiter:
+    """
+    Limits the number of requests per second to each host, shared between all download threads.
+
+    Attributes:
+        min_interval (float): Minimal time in seconds between two requests to the same host.
+        next_request (dict): Earliest time of the next request for every host.
+        lock (threading.Lock): Lock guarding next_request.
+    """
+
+    def __init__(self, requests_per_second: float):
+        """
+        Args:
+            requests_per_second (float): Maximal number of requests per second to each host, None or 0 disables the limit.
+        """
+        self.min_interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_request = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str):
+        """Blocks until a request to the host of the url is allowed.
+
+        Args:
+            url (str): The url that will be requested.
+        """
+        if self.min_interval == 0.0:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            scheduled = max(now, self.next_request.get(host, now))
+            self.next_request[host] = scheduled + self.min_interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+class DownloadJournal:
+    """
+    Append-only journal (one json object per line) of completed downloads, so that a rerun skips files that are already on disk.
+
+    Attributes:
+        path (str): Path of the journal file.
+        completed (set): Paths of all completed files.
+        lock (threading.Lock): Lock guarding the journal file.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path (str): Path of the journal file, it is created if it does not exist.
+        """
+        self.path = path
+        self.completed = set()
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        self.completed.add(json.loads(line)['path'])
+                    except (ValueError, KeyError):
+                        # ignore a partially written last line of an interrupted run
+                        continue
+
+    def is_complete(self, path: str) -> bool:
+        """Whether the file was downloaded completely and still exists on disk.
+
+        Args:
+            path (str): Path of the file.
+        """
+        return path in self.completed and os.path.isfile(path)
+
+    def record(self, path: str, url: str, size: int):
+        """Adds a completed file to the journal.
+
+        Args:
+            path (str): Path of the file.
+            url (str): Url the file was downloaded from.
+            size (int): Size of the file in bytes.
+        """
+        with self.lock:
+            with open(self.path, 'a') as journal:
+                journal.write(json.dumps({'path': path, 'url': url, 'size': size}) + '\n')
+            self.completed.add(path)
+
+
+class DownloadEngine:
+    """
+    Downloads files concurrently with a pooled HTTP session, retries with exponential backoff,
+    per-host rate limiting and a journal of completed files.
+
+    Attributes:
+        session (requests.Session): Session shared by all threads, its connection pool holds max_workers connections per host.
+        journal (DownloadJournal): Journal of completed files, None if no journal is used.
+        rate_limiter (HostRateLimiter): Per-host rate limiter.
+        max_workers (int): Number of concurrent downloads.
+        timeout (float): Timeout in seconds for connecting and reading.
+
+    Usage:
+        engine = DownloadEngine(journal_path='downloads.jsonl', max_workers=8)
+        engine.download_all([(url, path), ...])
+    """
+
+    def __init__(self, journal_path: str = None, max_workers: int = 8, requests_per_second: float = 5.0, retries: int = 5, backoff_factor: float = 0.5, timeout: float = 30.0):
+        """
+        Args:
+            journal_path (str, optional): Path of the journal of completed files. Defaults to None.
+            max_workers (int, optional): Number of concurrent downloads. Defaults to 8.
+            requests_per_second (float, optional): Maximal number of requests per second to each host. Defaults to 5.0.
+            retries (int, optional): Number of retries of failed requests. Defaults to 5.
+            backoff_factor (float, optional): Factor of the exponential backoff between retries. Defaults to 0.5.
+            timeout (float, optional): Timeout in seconds for connecting and reading. Defaults to 30.0.
+        """
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET', 'HEAD'])
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.journal = DownloadJournal(journal_path) if journal_path is not None else None
+        self.rate_limiter = HostRateLimiter(requests_per_second)
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        """Rate limited GET request with the pooled session.
+
+        Args:
+            url (str): The requested url.
+            kwargs: Further arguments of requests.Session.get.
+
+        Raises:
+            requests.HTTPError: If the response has an error status after all retries.
+
+        Returns:
+            requests.Response: The response.
+        """
+        self.rate_limiter.wait(url)
+        response = self.session.get(url, timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def download(self, url: str, path: str) -> bool:
+        """Downloads a single file, unless the journal lists it as completed.
+        The file is written to a temporary file first, so an interrupted download never leaves a truncated file.
+
+        Args:
+            url (str): Url of the file.
+            path (str): Path the file is saved to.
+
+        Returns:
+            bool: True if the file was downloaded, False if it was skipped.
+        """
+        if self.journal is not None and self.journal.is_complete(path):
+            return False
+        content = self.get(url).content
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.part'
+        with open(temporary_path, 'wb') as handler:
+            handler.write(content)
+        os.replace(temporary_path, path)
+        if self.journal is not None:
+            self.journal.record(path, url, len(content))
+        return True
+
+    def map(self, function, items: list) -> list:
+        """Applies the function to all items with max_workers threads, keeping the order of the items.
+
+        Args:
+            function (Callable): The function to apply.
+            items (list): The items.
+
+        Returns:
+            list: The results of the function.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(function, items))
+
+    def download_all(self, jobs: list) -> dict:
+        """Downloads all files concurrently. Failed downloads are reported but do not stop the other downloads.
+
+        Args:
+            jobs (list): List of (url, path) tuples.
+
+        Returns:
+            dict: Number of 'downloaded', 'skipped' and 'failed' files.
+        """
+        def run_job(job):
+            url, path = job
+            try:
+                return 'downloaded' if self.download(url, path) else 'skipped'
+            except requests.RequestException as e:
+                print(f"Error: Unable to download {url} to {path}. {str(e)}")
+                return 'failed'
+
+        results = self.map(run_job, jobs)
+        return {status: results.count(status) for status in ['downloaded', 'skipped', 'failed']}
@@ -0,0 +1,145 @@
+import os
+import argparse
+import yaml
+import pandas as pd
+from collections import Counter
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+# Name of the manifest written into every normalized dataset folder, read by utils/load_dataset.load_data
+MANIFEST_NAME = 'manifest.csv'
+
+# File extension of the supported output formats
+EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def target_size(width: int, height: int, max_side: int, min_short_side: int) -> tuple:
+    """Size of the normalized image: the longer side is bounded by max_side, but the shorter side is kept at
+    least at min_short_side (if the image is that large), so that panoramas are not shrunk below the CLIP input resolution.
+    Images are never enlarged.
+
+    Args:
+        width (int): Width of the image.
+        height (int): Height of the image.
+        max_side (int): Maximal length of the longer side.
+        min_short_side (int): Minimal length of the shorter side.
+
+    Returns:
+        tuple: (width, height) of the normalized image
+    """
+    scale = min(1.0, max(max_side / max(width, height), min_short_side / min(width, height)))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def normalize_image(arguments: tuple) -> dict:
+    """Re-encodes a single image. An existing target file is kept, so an interrupted ingestion can be resumed.
+
+    Args:
+        arguments (tuple): (source_path, target_path, max_side, min_short_side, image_format, quality)
+
+    Returns:
+        dict: manifest row of the image, None if the image can not be decoded
+    """
+    source_path, target_path, max_side, min_short_side, image_format, quality = arguments
+    try:
+        with Image.open(source_path) as img:
+            source_width, source_height = img.size
+            source_format = img.format
+            if not os.path.isfile(target_path):
+                size = target_size(source_width, source_height, max_side, min_short_side)
+                # decode JPEG sources directly at a reduced scale
+                img.draft('RGB', size)
+                img = img.convert('RGB')
+                if img.size != size:
+                    img = img.resize(size, Image.LANCZOS)
+                temporary_path = f'{target_path}.part'
+                img.save(temporary_path, format=image_format, quality=quality)
+                os.replace(temporary_path, target_path)
+    except OSError as e:
+        print(f"Error: Unable to normalize {source_path}. {str(e)}")
+        return None
+
+    with Image.open(target_path) as img:
+        width, height = img.size
+    return {
+        'label': os.path.basename(os.path.dirname(target_path)),
+        'width': width,
+        'height': height,
+        'format': image_format,
+        'path': target_path,
+        'source_path': source_path,
+        'source_width': source_width,
+        'source_height': source_height,
+        'source_format': source_format,
+        'bytes': os.path.getsize(target_path),
+        'source_bytes': os.path.getsize(source_path),
+    }
+
+
+def normalize_dataset(source_dir: str, target_dir: str, max_side: int = 768, min_short_side: int = 336, image_format: str = 'JPEG', quality: int = 90, max_workers: int = None) -> pd.DataFrame:
+    """Re-encodes all images of a dataset (one folder per label) in parallel into a normalized copy with bounded size,
+    a single format and the true file extension. The mapping of every source file to its normalized file is saved in {target_dir}/manifest.csv.
+
+    Args:
+        source_dir (str): Folder containing one folder of images per label.
+        target_dir (str): Folder of the normalized copy.
+        max_side (int, optional): Maximal length of the longer side. Defaults to 768.
+        min_short_side (int, optional): Minimal length of the shorter side. Defaults to 336.
+        image_format (str, optional): 'JPEG' or 'WEBP'. Defaults to 'JPEG'.
+        quality (int, optional): Encoding quality. Defaults to 90.
+        max_workers (int, optional): Number of processes, None uses all cores. Defaults to None.
+
+    Raises:
+        ValueError: If two source files of a folder would be normalized into the same file.
+
+    Returns:
+        pd.DataFrame: the manifest
+    """
+    if image_format not in EXTENSIONS:
+        raise ValueError(f'Unsupported format {image_format}, use one of {list(EXTENSIONS)}.')
+    jobs = []
+    for folder in sorted(os.listdir(source_dir)):
+        if not os.path.isdir(os.path.join(source_dir, folder)):
+            continue
+        os.makedirs(os.path.join(target_dir, folder), exist_ok=True)
+        files = sorted(os.listdir(os.path.join(source_dir, folder)))
+        stems = Counter(os.path.splitext(file)[0] for file in files)
+        for file in files:
+            stem = os.path.splitext(file)[0]
+            # files with the same name and another extension (e.g. x.png and x.jpg) keep their extension, so every source has its own target
+            target_file = (file if stems[stem] > 1 else stem) + EXTENSIONS[image_format]
+            jobs.append((os.path.join(source_dir, folder, file), os.path.join(target_dir, folder, target_file), max_side, min_short_side, image_format, quality))
+
+    targets = Counter(job[1] for job in jobs)
+    collisions = sorted(target for target, count in targets.items() if count > 1)
+    if collisions:
+        raise ValueError(f'{len(collisions)} normalized files would be written by several source files (e.g. {collisions[:3]}), rename the source files.')
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        rows = list(executor.map(normalize_image, jobs, chunksize=64))
+
+    manifest = pd.DataFrame([row for row in rows if row is not None])
+    manifest.to_csv(os.path.join(target_dir, MANIFEST_NAME), index=False)
+    if len(manifest) > 0:
+        print(f"{source_dir}: {len(manifest)} images, {manifest['source_bytes'].sum() / 2**20:.1f} MiB -> {manifest['bytes'].sum() / 2**20:.1f} MiB")
+    return manifest
+
+
+if __name__ == "__main__":
+    """Normalizes the datasets into {data_path}/normalized/{dataset}. Set data_path in paths.yaml to {data_path}/normalized to use the normalized copies.
+    """
+    parser = argparse.ArgumentParser(description='Normalize images')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--datasets', metavar='str', nargs='+', required=False, help='The datasets to normalize', default=['geoguessr', 'tourist', 'aerial'])
+    parser.add_argument('--max_side', metavar='int', type=int, required=False, help='Maximal length of the longer side', default=768)
+    parser.add_argument('--min_short_side', metavar='int', type=int, required=False, help='Minimal length of the shorter side', default=336)
+    parser.add_argument('--format', metavar='str', choices=list(EXTENSIONS), required=False, help='Output format', default='JPEG')
+    parser.add_argument('--quality', metavar='int', type=int, required=False, help='Encoding quality', default=90)
+    parser.add_argument('--max_workers', metavar='int', type=int, required=False, help='Number of processes', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        DATA_PATH = paths['data_path']
+        for dataset in args.datasets:
+            normalize_dataset(os.path.join(DATA_PATH, dataset), os.path.join(DATA_PATH, 'normalized', dataset), args.max_side, args.min_short_side, args.format, args.quality, args.max_workers)
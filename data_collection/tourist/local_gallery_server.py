@@ -0,0 +1,105 @@
+import os
+import sys
+import argparse
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+sys.path.append('.')
+from data_collection.aerial.local_oam_server import fake_thumbnail
+
+
+def gallery_page(page_id: int, images_per_page: int) -> str:
+    """Creates a gallery page with the markup of the gallery blocks of bigfoto.com
+
+    Args:
+        page_id (int): Id of the page, used for the image names
+        images_per_page (int): Number of images of the gallery
+
+    Returns:
+        str: The html of the page
+    """
+    items = ''.join(
+        f'<li class="blocks-gallery-item"><figure><a href="/images/{page_id}-{i}.png"><img src="/images/{page_id}-{i}.png" alt=""></a></figure></li>'
+        for i in range(images_per_page))
+    return f'<!DOCTYPE html><html><body><figure class="wp-block-gallery"><ul class="blocks-gallery-grid">{items}</ul></figure></body></html>'
+
+
+class LocalGalleryHandler(BaseHTTPRequestHandler):
+    """
+    Serves a stand-in of bigfoto.com: gallery pages (/{region}/{link_path}/) and fake images (/images/{name}.png).
+    A page is served from {server.pages_dir}/{region}/{link_path}/index.html if it was recorded with
+    tourist_data_collection.py --record_dir, otherwise a gallery with server.images_per_page images is generated.
+    Relative image links of recorded pages are answered with fake images as well, absolute links still point to the original host.
+    """
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path)
+        if path.startswith('/images/') or os.path.splitext(path)[1].lower() in ['.png', '.jpg', '.jpeg', '.webp']:
+            self.send_image(path)
+        else:
+            self.send_page(path)
+
+    def send_page(self, path):
+        recorded_path = os.path.normpath(os.path.join(self.server.pages_dir, path.strip('/'), 'index.html')) if self.server.pages_dir else None
+        if recorded_path is not None and recorded_path.startswith(os.path.normpath(self.server.pages_dir)) and os.path.isfile(recorded_path):
+            with open(recorded_path, 'rb') as handler:
+                content = handler.read()
+        else:
+            content = gallery_page(zlib.crc32(path.encode()), self.server.images_per_page).encode()
+        self.send_bytes(content, 'text/html; charset=utf-8')
+        with self.server.lock:
+            self.server.page_requests += 1
+
+    def send_image(self, path):
+        self.send_bytes(fake_thumbnail(zlib.crc32(path.encode())), 'image/png')
+        with self.server.lock:
+            self.server.image_requests += 1
+
+    def send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server(port: int = 0, pages_dir: str = None, images_per_page: int = 10):
+    """Starts the local bigfoto.com stand-in in a background thread
+
+    Args:
+        port (int, optional): Port of the server, 0 selects a free port. Defaults to 0.
+        pages_dir (str, optional): Directory of the recorded gallery pages. Defaults to None.
+        images_per_page (int, optional): Number of images of the generated gallery pages. Defaults to 10.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its url is http://127.0.0.1:{server.server_address[1]}
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), LocalGalleryHandler)
+    server.pages_dir = pages_dir
+    server.images_per_page = images_per_page
+    server.page_requests = 0
+    server.image_requests = 0
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    """Serves a local stand-in of bigfoto.com, run tourist_data_collection.py with --base_url http://127.0.0.1:{port} --num_drivers 0 against it
+    """
+    parser = argparse.ArgumentParser(description='Local bigfoto.com stand-in')
+    parser.add_argument('--port', metavar='int', type=int, required=False, help='Port of the server', default=8001)
+    parser.add_argument('--pages_dir', metavar='str', required=False, help='Directory of the recorded gallery pages', default=None)
+    parser.add_argument('--images_per_page', metavar='int', type=int, required=False, help='Number of images of the generated gallery pages', default=10)
+    args = parser.parse_args()
+
+    server = start_server(args.port, args.pages_dir, args.images_per_page)
+    print(f"Serving the bigfoto.com stand-in at http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,6 +1,6 @@
-import leafmap
 import os
-import requests
+import sys
+import threading
 import argparse
 import yaml
 import csv
@@ -10,15 +10,21 @@ import operator
 import math
 import random
 import ast
+import requests
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from urllib.parse import urljoin
 from selenium import webdriver
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
 from webdriver_manager.chrome import ChromeDriverManager
 from shapely.geometry import Point, Polygon, LineString
 from shapely.ops import nearest_points
 import shapely.wkt
+sys.path.append('.')
+from data_collection import download_engine
 
 # Options for the selenium chrome webdriver
 options = Options()
@@ -31,50 +37,220 @@ options.add_argument('--disable-notifications')
 #Set random seed for random selection of images
 random.seed(9)
 
-def get_tourist_images(REPO_PATH, DATA_PATH):
+BIGFOTO_URL = 'https://bigfoto.com'
+
+class GalleryLinkParser(HTMLParser):
+    """
+    Collects the links of the static gallery markup, i.e. the elements matching the XPath
+    //li[contains(@class,'blocks-gallery-item')]//figure//a, without running a browser.
+
+    Attributes:
+        page_url (str): Url of the parsed page, used to resolve relative links.
+        links (List[str]): The absolute urls of all gallery links.
+        open_tags (List[tuple]): Stack of the open tags with flags for gallery items and figures.
+    """
+    void_elements = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+    def __init__(self, page_url):
+        super().__init__()
+        self.page_url = page_url
+        self.links = []
+        self.open_tags = []
+
+    def in_gallery_figure(self):
+        in_gallery_item = False
+        for tag, is_gallery_item in self.open_tags:
+            in_gallery_item = in_gallery_item or is_gallery_item
+            if in_gallery_item and tag == 'figure':
+                return True
+        return False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and attrs.get('href') and self.in_gallery_figure():
+            self.links.append(urljoin(self.page_url, attrs['href']))
+        if tag not in self.void_elements:
+            self.open_tags.append((tag, tag == 'li' and 'blocks-gallery-item' in (attrs.get('class') or '')))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.open_tags) - 1, -1, -1):
+            if self.open_tags[i][0] == tag:
+                del self.open_tags[i:]
+                break
+
+
+class DriverPool:
+    """
+    A small pool of headless chrome drivers, that are created on demand, reused for all pages and quit at the end.
+
+    Usage:
+        with DriverPool(2) as drivers:
+            with drivers.driver() as driver:
+                driver.get(link)
+    """
+
+    def __init__(self, size: int = 2):
+        """
+        Args:
+            size (int, optional): Maximal number of drivers. Defaults to 2.
+        """
+        self.size = size
+        self.available = []
+        self.drivers = []
+        self.lock = threading.Lock()
+        # notified whenever a driver is returned or discarded, so waiting threads reuse or replace it
+        self.changed = threading.Condition(self.lock)
+        self.service = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Quits all drivers."""
+        with self.lock:
+            for driver in self.drivers:
+                driver.quit()
+            self.drivers = []
+            self.available = []
+
+    def create_driver(self):
+        """Starts a new driver if the pool is not full yet, the chromedriver is only installed once."""
+        with self.lock:
+            if len(self.drivers) >= self.size:
+                return None
+            if self.service is None:
+                self.service = Service(ChromeDriverManager().install())
+            driver = webdriver.Chrome(service=self.service, options=options)
+            self.drivers.append(driver)
+            return driver
+
+    @contextmanager
+    def driver(self):
+        """Borrows a driver from the pool and returns it afterwards, also if the caller raised.
+        Broken drivers (WebDriverException) are quit instead and replaced on demand."""
+        driver = self.borrow()
+        broken = False
+        try:
+            yield driver
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            with self.changed:
+                if broken:
+                    self.drivers.remove(driver)
+                else:
+                    self.available.append(driver)
+                self.changed.notify()
+            if broken:
+                driver.quit()
+
+    def borrow(self):
+        """Takes an available driver, starts a new one if the pool is not full, or waits until a driver is returned or discarded."""
+        while True:
+            with self.changed:
+                while not self.available and len(self.drivers) >= self.size:
+                    self.changed.wait()
+                if self.available:
+                    return self.available.pop()
+            # another thread may fill the pool first, then wait again
+            driver = self.create_driver()
+            if driver is not None:
+                return driver
+
+
+def get_gallery_links(engine, drivers, link, record_path=None):
+    """Finds the links of all gallery images of a page.
+    The static markup is parsed first, a browser of the pool is only used if it contains no gallery (i.e. it needs JavaScript).
+
+    Args:
+        engine (DownloadEngine): The engine used for the request of the page.
+        drivers (DriverPool): Pool of drivers for pages that need JavaScript, None to only use the static markup.
+        link (str): Url of the page.
+        record_path (str, optional): Path to save the fetched page to, for replaying it with local_gallery_server.py. Defaults to None.
+
+    Returns:
+        List[str]: urls of the gallery images
+    """
+    html = engine.get(link).text
+    if record_path is not None:
+        os.makedirs(os.path.dirname(record_path), exist_ok=True)
+        with open(record_path, 'w') as handler:
+            handler.write(html)
+    parser = GalleryLinkParser(link)
+    parser.feed(html)
+    if len(parser.links) > 0 or drivers is None:
+        return parser.links
+
+    with drivers.driver() as driver:
+        driver.get(link)
+        try:
+            elems = driver.find_elements(By.XPATH, "//li[contains(@class,'blocks-gallery-item')]//figure//a")
+            return [elem.get_attribute('href') for elem in elems]
+        except TimeoutException:
+            print("Loading of result page took too much time!")
+            return []
+
+
+def get_tourist_images(REPO_PATH, DATA_PATH, base_url=BIGFOTO_URL, max_workers=8, num_drivers=2, record_dir=None):
     """Scrapes images from bigfoto.com using the paths saved in the file regions.json
     Saves the files into the folder {DATA_PATH}/tourist
+    The pages are fetched and the images downloaded concurrently, completed files are recorded in {DATA_PATH}/tourist_download_journal.jsonl and skipped on a rerun.
 
     Args:
         REPO_PATH (str): Path to project folder.
         DATA_PATH (str): Path to data folder.
+        base_url (str, optional): Url of the website, e.g. of a local_gallery_server.py. Defaults to BIGFOTO_URL.
+        max_workers (int, optional): Number of concurrent requests. Defaults to 8.
+        num_drivers (int, optional): Maximal number of browsers for pages that need JavaScript, 0 to never start a browser. Defaults to 2.
+        record_dir (str, optional): Directory to record the fetched gallery pages in. Defaults to None.
 
     Returns:
         None
     """
-    regions_file = open("{}/data_collection/tourist/url_paths_for_tourist_collection.json".format(REPO_PATH))
-    regions_json = json.load(regions_file)
+    with open("{}/data_collection/tourist/url_paths_for_tourist_collection.json".format(REPO_PATH)) as regions_file:
+        regions_json = json.load(regions_file)
     regions = regions_json["regions"]
+    pages = []
     for region in regions:
         for country in region['array']:
             for link_path in country['links']:
-                link = 'https://bigfoto.com/{}/{}/'.format(region['region'],link_path)
-                result = {}
-                driver = webdriver.Chrome(service=Service(ChromeDriverManager().install()), options=options)
-                driver.get(link)
-                result.update(link=link)
-                try:
-                    elems = driver.find_elements(By.XPATH, "//li[contains(@class,'blocks-gallery-item')]//figure//a")
-                    links = [elem.get_attribute('href') for elem in elems]
-                    for i in range(0,len(links)):
-                        img_data = requests.get(links[i]).content
-                        folder_path = "{}/tourist/{}".format(DATA_PATH, country['name'])
-                        if not os.path.isdir(folder_path):
-                            os.makedirs(folder_path)
-                        with open("{}/tourist/{}/{}-{}.png".format(DATA_PATH, country['name'],link_path.replace('/','-'),i), 'wb') as handler:
-                            handler.write(img_data)
-                except TimeoutException:
-                    print("Loading of result page took too much time!")
-                    driver.quit()
+                pages.append((region['region'], country['name'], link_path))
+
+    engine = download_engine.DownloadEngine(journal_path='{}/tourist_download_journal.jsonl'.format(DATA_PATH), max_workers=max_workers)
+    with DriverPool(num_drivers) as drivers:
+        def get_page_jobs(page):
+            region, country_name, link_path = page
+            link = '{}/{}/{}/'.format(base_url, region, link_path)
+            record_path = os.path.join(record_dir, region, link_path, 'index.html') if record_dir is not None else None
+            try:
+                links = get_gallery_links(engine, drivers if num_drivers > 0 else None, link, record_path)
+            except (requests.RequestException, WebDriverException) as e:
+                # a failing page must not abort the crawl of the other pages
+                print(f"Error: Unable to get the gallery of {link}. {str(e)}")
+                return []
+            return [(links[i], "{}/tourist/{}/{}-{}.png".format(DATA_PATH, country_name, link_path.replace('/','-'), i)) for i in range(0,len(links))]
+
+        page_jobs = engine.map(get_page_jobs, pages)
+
+    jobs = [job for jobs in page_jobs for job in jobs]
+    print(engine.download_all(jobs))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Pretrained Model')
     parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--base_url', metavar='str', required=False, help='Url of the website, e.g. of a local_gallery_server.py', default=BIGFOTO_URL)
+    parser.add_argument('--max_workers', metavar='int', type=int, required=False, help='Number of concurrent requests', default=8)
+    parser.add_argument('--num_drivers', metavar='int', type=int, required=False, help='Maximal number of browsers for pages that need JavaScript', default=2)
+    parser.add_argument('--record_dir', metavar='str', required=False, help='Directory to record the fetched gallery pages in', default=None)
     args = parser.parse_args()
 
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         DATA_PATH = paths['data_path']
         REPO_PATH = paths['repo_path']
-        get_tourist_images(REPO_PATH, DATA_PATH)
\ No newline at end of file
+        get_tourist_images(REPO_PATH, DATA_PATH, args.base_url, args.max_workers, args.num_drivers, args.record_dir)
\ No newline at end of file
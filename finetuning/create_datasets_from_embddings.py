@@ -4,21 +4,71 @@ sys.path.append(".")
 
 import random
 import numpy as np
-import sklearn.model_selection
-import PIL
 import os
 import pandas as pd
-import torch
-import clip
 from utils import load_dataset
 import argparse
 
 
+def seeded_permutation(n: int, seed: int, cache: dict = None) -> np.ndarray:
+    """
+    The permutation drawn by DataFrame.sample(n, random_state=seed) on a frame of length n,
+    i.e. np.random.RandomState(seed).permutation(n). Permutations are cached by length, as every group of the same size draws the same one.
+
+    Args:
+        n (int): The length of the permutation.
+        seed (int): The random seed.
+        cache (dict, optional): Cache of the permutations by length. Defaults to None.
+
+    Returns:
+        np.ndarray: The permutation.
+    """
+    if cache is None:
+        return np.random.RandomState(seed).permutation(n)
+    if n not in cache:
+        cache[n] = np.random.RandomState(seed).permutation(n)
+    return cache[n]
+
+
+def group_positions(codes: np.ndarray):
+    """
+    Positions of the rows of every label, in frame order.
+
+    Args:
+        codes (np.ndarray): Integer label code of every row.
+
+    Returns:
+        tuple: the labels, the rows ordered by label (stable) and the start and count of every label in this order
+    """
+    order = np.argsort(codes, kind="stable")
+    labels, starts, counts = np.unique(codes[order], return_index=True, return_counts=True)
+    return labels, order, starts, counts
+
+
+def balance_indices(
+    codes: np.ndarray, max_images: int = 1000, min_images: int = 10, seed: int = 1234
+) -> np.ndarray:
+    """
+    Positions of the rows selected by balance_data: classes below the minimum are dropped, classes above the maximum are sampled
+    exactly as group.sample(n=max_images, random_state=seed), the result is ordered by label.
 
+    Args:
+        codes (np.ndarray): Integer label code of every row, codes have to be ordered like the labels.
+        max_images (int, optional): The maximum number of images to sample. Defaults to 1000.
+        min_images (int, optional): The minimum number of images to sample. Defaults to 10.
+        seed (int, optional): The random seed. Defaults to 1234.
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocessor = clip.load("ViT-B/32", device=device)
-model.to(device)
+    Returns:
+        np.ndarray: The positions of the selected rows.
+    """
+    _, order, starts, counts = group_positions(codes)
+    permutations = {}
+    selected = [
+        order[start + seeded_permutation(count, seed, permutations)[: min(count, max_images)]]
+        for start, count in zip(starts, counts)
+        if count >= min_images
+    ]
+    return np.concatenate(selected) if selected else np.empty(0, dtype=np.intp)
 
 
 def balance_data(
@@ -29,7 +79,6 @@ def balance_data(
 
     Args:
         df (pd.DataFrame): The DataFrame containing the data.
-        REPO_PATH (str): The path to the repository.
         max_images (int, optional): The maximum number of images to sample. Defaults to 1000.
         min_images (int, optional): The minimum number of images to sample. Defaults to 10.
         seed (int, optional): The random seed. Defaults to 1234.
@@ -37,25 +86,41 @@ def balance_data(
     Returns:
         pd.DataFrame: The balanced DataFrame.
     """
-    # Group the DataFrame by label
-    grouped = df.groupby("label")
+    codes = pd.factorize(df["label"], sort=True)[0]
+    return df.iloc[balance_indices(codes, max_images, min_images, seed)].reset_index(drop=True)
 
-    # Create an empty DataFrame to store the balanced data
-    balanced_df = pd.DataFrame(columns=df.columns)
 
-    # Iterate over each group
-    for _, group_df in grouped:
-        # Check if the group has enough images
-        if len(group_df) >= min_images:
-            # Randomly sample the maximum number of images from the group
-            sampled_df = group_df.sample(
-                n=min(len(group_df), max_images), random_state=seed
-            )
-            # Append the sampled data to the balanced DataFrame
-            balanced_df = pd.concat([balanced_df, sampled_df], ignore_index=True)
+def mix_indices(
+    base: np.ndarray, pool: np.ndarray, codes: np.ndarray, min_geo_percentage: float = 0.5, seed: int = 1234
+) -> np.ndarray:
+    """
+    Replace up to min_geo_percentage of the rows of each label in base with rows of the same label from the pool.
+    The rows are drawn exactly like the former per-label DataFrame.sample(num_replace, random_state=seed) calls on both sides.
 
-    # Save the balanced DataFrame
-    return balanced_df
+    Args:
+        base (np.ndarray): Store positions of the base dataset, in frame order.
+        pool (np.ndarray): Store positions of the replacement images, in frame order.
+        codes (np.ndarray): Integer label code of every row of the store.
+        min_geo_percentage (float, optional): The maximal share of replaced rows per label. Defaults to 0.5.
+        seed (int, optional): The random seed. Defaults to 1234.
+
+    Returns:
+        np.ndarray: Store positions of the mixed dataset, in the order of base.
+    """
+    mixed = base.copy()
+    base_labels, base_order, base_starts, base_counts = group_positions(codes[base])
+    pool_labels, pool_order, pool_starts, pool_counts = group_positions(codes[pool])
+    pool_group = dict(zip(pool_labels, zip(pool_starts, pool_counts)))
+    permutations = {}
+    for label, base_start, base_count in zip(base_labels, base_starts, base_counts):
+        pool_start, pool_count = pool_group.get(label, (0, 0))
+        num_replace = min(int(base_count * min_geo_percentage), pool_count)
+        if num_replace == 0:
+            continue
+        replace_rows = base_order[base_start + seeded_permutation(base_count, seed, permutations)[:num_replace]]
+        replace_images = pool_order[pool_start + seeded_permutation(pool_count, seed, permutations)[:num_replace]]
+        mixed[replace_rows] = pool[replace_images]
+    return mixed
 
 
 def create_datasets_from_embddings(
@@ -68,9 +133,13 @@ def create_datasets_from_embddings(
     min_aerial_images=2,
     min_tourist_images=10,
     test_size=0.15,
+    save_csv=False,
 ):
     """
     Create balanced datasets from embeddings for training and testing.
+    All datasets are built as arrays of row positions into one store of the geo, aerial and tourist embeddings.
+    They are saved as split manifests ({name}.json, see load_dataset.save_split_manifest) that reference the rows of the store,
+    the trainers resolve them with load_dataset.read_split.
 
     Args:
         REPO_PATH (str): The path to the repository.
@@ -82,7 +151,21 @@ def create_datasets_from_embddings(
         min_aerial_images (int, optional): The minimum number of aerial images. Defaults to 2.
         min_tourist_images (int, optional): The minimum number of tourist images. Defaults to 10.
         test_size (float, optional): The proportion of the dataset to include in the test split. Defaults to 0.15.
+        save_csv (bool, optional): Additionally save a csv copy of every dataset. Defaults to False.
     """
+    parameters = dict(
+        min_geo_percentage=min_geo_percentage,
+        max_images_weakly=max_images_weakly,
+        max_images_strongly=max_images_strongly,
+        min_geo_images=min_geo_images,
+        min_aerial_images=min_aerial_images,
+        min_tourist_images=min_tourist_images,
+        test_size=test_size,
+    )
+
+    # torch is only needed for seeding and sklearn only for the splits, so both are imported here
+    import torch
+    import sklearn.model_selection
 
     # set random seed
     os.environ["PYTHONHASHSEED"] = str(seed)
@@ -92,257 +175,128 @@ def create_datasets_from_embddings(
     random.seed(seed)
     np.random.seed(seed)
 
-    with torch.no_grad():
-        # read in and balance each dataset
-        geo_embed = pd.read_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Image/geoguessr_embeddings.csv")
-        )
-        aerial_df = pd.read_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Image/aerial_embeddings.csv")
-        )
-        tourist_df = pd.read_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Image/tourist_embeddings.csv")
-        )
-
-        # Print dataset information
-        print(f"Datasets read in with seed {seed}")
-        print(f"Geo: {len(geo_embed)}")
-        print(f"Aerial: {len(aerial_df)}")
-        print(f"Tourist: {len(tourist_df)}")
-
-        # Balance the datasets
-        balanced_geo_df = balance_data(
-            df=geo_embed,
-            max_images=max_images_weakly,
-            min_images=min_geo_images,
-            seed=seed,
-        )
-        balanced_aerial_df = balance_data(
-            df=aerial_df,
-            max_images=max_images_weakly,
-            min_images=min_aerial_images,
-            seed=seed,
-        )
-        balanced_tourist_df = balance_data(
-            df=tourist_df,
-            max_images=max_images_weakly,
-            min_images=min_tourist_images,
-            seed=seed,
-        )
-
-        # Split the datasets into train, validation and test sets
-        geo_train_and_val, geo_test = sklearn.model_selection.train_test_split(
-            balanced_geo_df,
-            test_size=test_size,
-            random_state=seed,
-            shuffle=True,
-            stratify=balanced_geo_df["label"],
-        )
-        aerial_train_and_val, aerial_test = sklearn.model_selection.train_test_split(
-            balanced_aerial_df,
-            test_size=test_size,
-            random_state=seed,
-            shuffle=True,
-            stratify=balanced_aerial_df["label"],
-        )
-        # Make sure that all labels in the training set are also in the test set
-        labels_in_aerial_train_not_in_aerial_test = set(aerial_train_and_val['label'].value_counts().keys().to_list()) - set(aerial_test['label'].value_counts().keys().to_list())
-        for label in labels_in_aerial_train_not_in_aerial_test:
-            entry = aerial_train_and_val[aerial_train_and_val['label'] == label].sample(1)
-            aerial_test = pd.concat([aerial_test, entry])
-            aerial_train_and_val = aerial_train_and_val.drop(entry.index)
-
-        tourist_train_and_val, tourist_test = sklearn.model_selection.train_test_split(
-            balanced_tourist_df,
+    # read in all datasets into one store
+    store_paths = [
+        "CLIP_Embeddings/Image/geoguessr_embeddings.csv",
+        "CLIP_Embeddings/Image/aerial_embeddings.csv",
+        "CLIP_Embeddings/Image/tourist_embeddings.csv",
+    ]
+    geo_embed, aerial_df, tourist_df = (pd.read_csv(os.path.join(REPO_PATH, path)) for path in store_paths)
+    store_files = [
+        load_dataset.store_file_entry(REPO_PATH, path, len(df))
+        for path, df in zip(store_paths, [geo_embed, aerial_df, tourist_df])
+    ]
+
+    # Print dataset information
+    print(f"Datasets read in with seed {seed}")
+    print(f"Geo: {len(geo_embed)}")
+    print(f"Aerial: {len(aerial_df)}")
+    print(f"Tourist: {len(tourist_df)}")
+
+    store = pd.concat([geo_embed, aerial_df, tourist_df], ignore_index=True)
+    sources = np.repeat(np.arange(3), [len(geo_embed), len(aerial_df), len(tourist_df)])
+    geo_positions, aerial_positions, tourist_positions = (np.flatnonzero(sources == source) for source in range(3))
+    labels = store["label"].to_numpy()
+    codes = pd.factorize(store["label"], sort=True)[0]
+
+    def shuffle(positions):
+        # same order as DataFrame.sample(frac=1, random_state=seed)
+        return positions[seeded_permutation(len(positions), seed)]
+
+    def split(positions):
+        return sklearn.model_selection.train_test_split(
+            positions,
             test_size=test_size,
             random_state=seed,
             shuffle=True,
-            stratify=balanced_tourist_df["label"],
+            stratify=labels[positions],
         )
 
-        # Concatenate and shuffle all test and zero_shot datasets
-        test_data = pd.concat([geo_test, aerial_test, tourist_test]).sample(
-            frac=1, random_state=seed
-        )
-
-        # Create zero shot datasets
-        geo_zero_shot_df = geo_embed[~geo_embed["label"].isin(test_data["label"])]
-        aerial_zero_shot_df = aerial_df[
-            ~aerial_df["label"].isin(test_data["label"])
-        ]
-        tourist_zero_shot_df = tourist_df[
-            ~tourist_df["label"].isin(test_data["label"])
-        ]
-
-        zero_shot_data = pd.concat(
-            [geo_zero_shot_df, aerial_zero_shot_df, tourist_zero_shot_df]
-        ).sample(frac=1, random_state=seed)
-
-        # Save test and zero shot datasets
-        test_data.to_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Testing/known_test_data.csv"),
-            index=False,
-        )
-        zero_shot_data.to_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Testing/zero_shot_test_data.csv"),
-            index=False,
-        )
-
-        weakly_balanced_geo_df = geo_train_and_val.sample(frac=1, random_state=seed)
-        weakly_balanced_geo_df.to_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Training/geo_weakly_balanced.csv"),
-            index=False,
-        )
-
-        # Get all images from geo_df for the classes that have more than 2000 images
-        # and that are not in balanced_geo_df
-        geo_large_classes = (
-            geo_embed["label"]
-            .value_counts()[geo_embed["label"].value_counts() > max_images_weakly]
-            .index.tolist()
-        )
-        geo_additional_images = geo_embed[
-            geo_embed["label"].isin(geo_large_classes)
-            & ~geo_embed["path"].isin(balanced_geo_df["path"])
-        ]
-
-        # Add the additional images to recreate the class imbalance
-        unbalanced_geo_df = pd.concat(
-            [geo_train_and_val, geo_additional_images]
-        ).sample(frac=1, random_state=seed)
-        unbalanced_geo_df.to_csv(
-            os.path.join(REPO_PATH, "CLIP_Embeddings/Training/geo_unbalanced.csv"),
-            index=False,
-        )
-
-        # Remove images of classes to have a maximum of 200 images for the strongly balanced dataset
-        strongley_balanced_geo_df = balance_data(
-            df=unbalanced_geo_df,
-            max_images=max_images_strongly,
-            min_images=0,
+    # Balance the datasets
+    balanced_geo = geo_positions[balance_indices(codes[geo_positions], max_images_weakly, min_geo_images, seed)]
+    balanced_aerial = aerial_positions[balance_indices(codes[aerial_positions], max_images_weakly, min_aerial_images, seed)]
+    balanced_tourist = tourist_positions[balance_indices(codes[tourist_positions], max_images_weakly, min_tourist_images, seed)]
+
+    # Split the datasets into train, validation and test sets
+    geo_train_and_val, geo_test = split(balanced_geo)
+    aerial_train_and_val, aerial_test = split(balanced_aerial)
+    # Make sure that all labels in the training set are also in the test set
+    labels_in_aerial_train_not_in_aerial_test = set(pd.Series(labels[aerial_train_and_val]).value_counts().keys().to_list()) - set(pd.Series(labels[aerial_test]).value_counts().keys().to_list())
+    for label in sorted(labels_in_aerial_train_not_in_aerial_test):
+        candidates = aerial_train_and_val[labels[aerial_train_and_val] == label]
+        entry = candidates[np.random.choice(len(candidates), size=1, replace=False)]
+        aerial_test = np.concatenate([aerial_test, entry])
+        aerial_train_and_val = aerial_train_and_val[aerial_train_and_val != entry[0]]
+    tourist_train_and_val, tourist_test = split(balanced_tourist)
+
+    # Concatenate and shuffle all test and zero_shot datasets
+    test_data = shuffle(np.concatenate([geo_test, aerial_test, tourist_test]))
+
+    # Create zero shot datasets
+    known_labels = np.zeros(codes.max() + 1, dtype=bool)
+    known_labels[codes[test_data]] = True
+    zero_shot_data = shuffle(np.flatnonzero(~known_labels[codes]))
+
+    weakly_balanced_geo = shuffle(geo_train_and_val)
+
+    # Get all images from geo_df for the classes that have more than 2000 images
+    # and that are not in balanced_geo_df
+    geo_counts = np.bincount(codes[geo_positions], minlength=codes.max() + 1)
+    in_balanced_geo = np.zeros(len(store), dtype=bool)
+    in_balanced_geo[balanced_geo] = True
+    geo_additional_images = geo_positions[(geo_counts[codes[geo_positions]] > max_images_weakly) & ~in_balanced_geo[geo_positions]]
+
+    # Add the additional images to recreate the class imbalance
+    unbalanced_geo = shuffle(np.concatenate([geo_train_and_val, geo_additional_images]))
+
+    # Remove images of classes to have a maximum of 200 images for the strongly balanced dataset
+    strongly_balanced_geo = shuffle(unbalanced_geo[balance_indices(codes[unbalanced_geo], max_images_strongly, 0, seed)])
+
+    # Replace up to 50% of each label with images of that same label from aerial
+    # and tourist data in the weakly and strongly balanced sets
+    replacement_pool = np.concatenate([aerial_train_and_val, tourist_train_and_val])
+    mixed_weakly_balanced = mix_indices(weakly_balanced_geo, replacement_pool, codes, min_geo_percentage, seed)
+    mixed_strongly_balanced = mix_indices(strongly_balanced_geo, replacement_pool, codes, min_geo_percentage, seed)
+
+    # Save all datasets
+    datasets = {
+        "Testing/known_test_data": (test_data, store.columns),
+        "Testing/zero_shot_test_data": (zero_shot_data, store.columns),
+        "Training/geo_weakly_balanced": (weakly_balanced_geo, geo_embed.columns),
+        "Training/geo_unbalanced": (unbalanced_geo, geo_embed.columns),
+        "Training/geo_strongly_balanced": (strongly_balanced_geo, geo_embed.columns),
+        "Training/mixed_weakly_balanced": (mixed_weakly_balanced, geo_embed.columns),
+        "Training/mixed_strongly_balanced": (mixed_strongly_balanced, geo_embed.columns),
+    }
+    for file_name, (positions, columns) in datasets.items():
+        path = os.path.join(REPO_PATH, "CLIP_Embeddings", file_name)
+        load_dataset.save_split_manifest(
+            f"{path}.json",
+            store_files,
+            positions,
+            columns,
+            name=os.path.basename(file_name),
+            split=os.path.dirname(file_name).lower(),
             seed=seed,
-        ).sample(frac=1, random_state=seed)
-        strongley_balanced_geo_df.to_csv(
-            os.path.join(
-                REPO_PATH, "CLIP_Embeddings/Training/geo_strongly_balanced.csv"
-            ),
-            index=False,
-        )
-
-        # Replace up to 50% of each label with images of that same label from aerial
-        # and tourist data in the weakly balanced set
-        mixed_weakly_balanced_df = weakly_balanced_geo_df.copy()
-        for label in mixed_weakly_balanced_df["label"].unique():
-            label_images = mixed_weakly_balanced_df[
-                mixed_weakly_balanced_df["label"] == label
-            ]
-            aerial_images = aerial_train_and_val[aerial_train_and_val["label"] == label]
-            tourist_images = tourist_train_and_val[
-                tourist_train_and_val["label"] == label
-            ]
-            num_replace = min(
-                int(len(label_images) * min_geo_percentage),
-                len(aerial_images) + len(tourist_images),
-            )
-            if num_replace == 0:
-                continue
-            replace_images = pd.concat([aerial_images, tourist_images])
-            replace_indices = (
-                mixed_weakly_balanced_df[mixed_weakly_balanced_df["label"] == label]
-                .sample(num_replace, random_state=seed)
-                .index
-            )
-            cols_to_use = mixed_weakly_balanced_df.columns
-            mixed_weakly_balanced_df.loc[replace_indices] = replace_images[cols_to_use].sample(num_replace, random_state=seed).to_numpy()
-
-        # Replace up to 50% of each label with images of that same label from aerial
-        # and tourist data in the strongly balanced set
-        mixed_strongly_balanced_df = strongley_balanced_geo_df.copy()
-        for label in mixed_strongly_balanced_df["label"].unique():
-            label_images = mixed_strongly_balanced_df[
-                mixed_strongly_balanced_df["label"] == label
-            ]
-            aerial_images = aerial_train_and_val[aerial_train_and_val["label"] == label]
-            tourist_images = tourist_train_and_val[
-                tourist_train_and_val["label"] == label
-            ]
-            num_replace = min(
-                int(len(label_images) * min_geo_percentage),
-                len(aerial_images) + len(tourist_images),
-            )
-            if num_replace == 0:
-                continue
-            replace_images = pd.concat([aerial_images, tourist_images])
-            replace_indices = (
-                mixed_strongly_balanced_df[mixed_strongly_balanced_df["label"] == label]
-                .sample(num_replace, random_state=seed)
-                .index
-            )
-            cols_to_use = mixed_strongly_balanced_df.columns
-            mixed_strongly_balanced_df.loc[replace_indices] = replace_images[cols_to_use].sample(num_replace, random_state=seed).to_numpy()
-
-        # Save the mixed datasets
-        mixed_weakly_balanced_df.to_csv(
-            os.path.join(
-                REPO_PATH, "CLIP_Embeddings/Training/mixed_weakly_balanced.csv"
-            ),
-            index=False,
-        )
-        mixed_strongly_balanced_df.to_csv(
-            os.path.join(
-                REPO_PATH, "CLIP_Embeddings/Training/mixed_strongly_balanced.csv"
-            ),
-            index=False,
+            parameters=parameters,
         )
-
-        # Print dataset sizes
-        print(f"Test data: {len(test_data)}")
-        print(f"Zero shot data: {len(zero_shot_data)}")
-        print(f"Geo weakly balanced: {len(weakly_balanced_geo_df)}")
-        print(f"Geo unbalanced: {len(unbalanced_geo_df)}")
-        print(f"Geo strongly balanced: {len(strongley_balanced_geo_df)}")
-        print(f"Mixed weakly balanced: {len(mixed_weakly_balanced_df)}")
-        print(f"Mixed strongly balanced: {len(mixed_strongly_balanced_df)}")
-
-        # Check how much data from the tourist df is in the mixed weakly dataframe
-        tourist_in_mixed_weakly = mixed_weakly_balanced_df[mixed_weakly_balanced_df["path"].isin(tourist_df["path"])]
-        tourist_count_in_mixed_weakly = len(tourist_in_mixed_weakly)
-        print(f"Number of tourist data in mixed weakly balanced dataset: {tourist_count_in_mixed_weakly}")
-
-        # Check how much data from the aerial df is in the mixed weakly dataframe
-        aerial_in_mixed_weakly = mixed_weakly_balanced_df[mixed_weakly_balanced_df["path"].isin(aerial_df["path"])]
-        aerial_count_in_mixed_weakly = len(aerial_in_mixed_weakly)
-        print(f"Number of aerial data in mixed weakly balanced dataset: {aerial_count_in_mixed_weakly}")
-
-        # Check how much data from the tourist df is in the mixed strongly dataframe
-        tourist_in_mixed_strongly = mixed_strongly_balanced_df[mixed_strongly_balanced_df["path"].isin(tourist_df["path"])]
-        tourist_count_in_mixed_strongly = len(tourist_in_mixed_strongly)
-        print(f"Number of tourist data in mixed strongly balanced dataset: {tourist_count_in_mixed_strongly}")
-
-        # Check how much data from the aerial df is in the mixed strongly dataframe
-        aerial_in_mixed_strongly = mixed_strongly_balanced_df[mixed_strongly_balanced_df["path"].isin(aerial_df["path"])]
-        aerial_count_in_mixed_strongly = len(aerial_in_mixed_strongly)
-        print(f"Number of aerial data in mixed strongly balanced dataset: {aerial_count_in_mixed_strongly}")
-
-        # Check how much data from the tourist df is in the test data
-        tourist_in_test = test_data[test_data["path"].isin(tourist_df["path"])]
-        tourist_count_in_test = len(tourist_in_test)
-        print(f"Number of tourist data in test dataset: {tourist_count_in_test}")
-
-        # Check how much data from the aerial df is in the test data
-        aerial_in_test = test_data[test_data["path"].isin(aerial_df["path"])]
-        aerial_count_in_test = len(aerial_in_test)
-        print(f"Number of aerial data in test dataset: {aerial_count_in_test}")
-
-        # Check how much data from the tourist df is in the zero shot data
-        tourist_in_zero_shot = zero_shot_data[zero_shot_data["path"].isin(tourist_df["path"])]
-        tourist_count_in_zero_shot = len(tourist_in_zero_shot)
-        print(f"Number of tourist data in zero shot dataset: {tourist_count_in_zero_shot}")
-
-        # Check how much data from the aerial df is in the zero shot data
-        aerial_in_zero_shot = zero_shot_data[zero_shot_data["path"].isin(aerial_df["path"])]
-        aerial_count_in_zero_shot = len(aerial_in_zero_shot)
-        print(f"Number of aerial data in zero shot dataset: {aerial_count_in_zero_shot}")
+        if save_csv:
+            store.iloc[positions][columns].to_csv(f"{path}.csv", index=False)
+
+    # Print dataset sizes
+    print(f"Test data: {len(test_data)}")
+    print(f"Zero shot data: {len(zero_shot_data)}")
+    print(f"Geo weakly balanced: {len(weakly_balanced_geo)}")
+    print(f"Geo unbalanced: {len(unbalanced_geo)}")
+    print(f"Geo strongly balanced: {len(strongly_balanced_geo)}")
+    print(f"Mixed weakly balanced: {len(mixed_weakly_balanced)}")
+    print(f"Mixed strongly balanced: {len(mixed_strongly_balanced)}")
+
+    # Check how much data from the aerial and tourist df is in the mixed, test and zero shot data
+    for name, positions in [("mixed weakly balanced", mixed_weakly_balanced), ("mixed strongly balanced", mixed_strongly_balanced), ("test", test_data), ("zero shot", zero_shot_data)]:
+        _, aerial_count, tourist_count = np.bincount(sources[positions], minlength=3)
+        print(f"Number of tourist data in {name} dataset: {tourist_count}")
+        print(f"Number of aerial data in {name} dataset: {aerial_count}")
 
 if __name__ == "__main__":
     """Creates the test set and the diffrent train/valdiation sets.
@@ -402,5 +356,21 @@ if __name__ == "__main__":
         type=float,
         help="The proportion of the dataset to include in the test split",
     )
+    parser.add_argument(
+        "--save_csv",
+        action="store_true",
+        help="Additionally save a csv copy of every dataset",
+    )
     args = parser.parse_args()
-    create_datasets_from_embddings(args.repo_path)
+    create_datasets_from_embddings(
+        args.repo_path,
+        seed=args.seed,
+        min_geo_percentage=args.min_geo_percentage,
+        max_images_weakly=args.max_images_weakly,
+        max_images_strongly=args.max_images_strongly,
+        min_geo_images=args.min_geo_images,
+        min_aerial_images=args.min_aerial_images,
+        min_tourist_images=args.min_tourist_images,
+        test_size=args.test_size,
+        save_csv=args.save_csv,
+    )
@@ -0,0 +1,192 @@
+import sys
+sys.path.append('.')
+sys.path.append('CLIP_Embeddings')
+import os
+import time
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from finetuning.model import nn
+from utils import backbones, features, load_dataset
+
+# Folder of the exported graphs, kept apart from the backbone state dicts in models/, which are listed as backbones
+EXPORT_FOLDER = 'exported_models'
+
+class GeolocationGraph(torch.nn.Module):
+    """
+    The complete prediction path as one module: CLIP image encoder, cosine similarities to the frozen prompt embeddings
+    (in float64 like calculate_distances in CLIP_Embeddings/generate_embeddings.py) and the FinetunedClip head.
+    Takes preprocessed images of shape (batch, 3, n_px, n_px) and returns the country probabilities of shape (batch, countries).
+    """
+
+    def __init__(self, visual: torch.nn.Module, prompt_embeddings: torch.Tensor, head: nn.FinetunedClip):
+        """
+        Args:
+            visual (torch.nn.Module): The image encoder of the CLIP model (model.visual).
+            prompt_embeddings (torch.Tensor): The country prompt embeddings, shape (countries, dim).
+            head (nn.FinetunedClip): The trained head.
+        """
+        super().__init__()
+        self.visual = visual
+        self.head = head
+        prompt_embeddings = prompt_embeddings.detach().double()
+        self.register_buffer('prompt_matrix', prompt_embeddings / prompt_embeddings.norm(dim=1, keepdim=True))
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        image_embeddings = self.visual(images.type(self.visual.conv1.weight.dtype)).double()
+        similarities = (image_embeddings / image_embeddings.norm(dim=1, keepdim=True)) @ self.prompt_matrix.t()
+        return self.head(torch.cat([image_embeddings, similarities], dim=1).float())
+
+
+def build_graph(REPO_PATH: str, checkpoint: str, backbone: str = backbones.DEFAULT_BACKBONE) -> tuple:
+    """Builds the GeolocationGraph of a trained head on CPU.
+
+    Args:
+        REPO_PATH (str): path to the repo folder.
+        checkpoint (str): Path of the state dict of the FinetunedClip.
+        backbone (str, optional): The CLIP backbone the embeddings were generated with. Defaults to backbones.DEFAULT_BACKBONE.
+
+    Returns:
+        tuple: the graph, the CLIP model, the preprocessor, the head and the prompt embeddings
+    """
+    model, preprocessor = backbones.load_backbone(backbone, 'cpu', os.path.join(REPO_PATH, 'models'))
+    head = nn.FinetunedClip()
+    head.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    head.eval()
+    prompt_path = f'{REPO_PATH}/CLIP_Embeddings/Prompt/prompt_image_shows_embedding.pt'
+    if os.path.isfile(prompt_path):
+        prompt_embeddings = torch.load(prompt_path, map_location='cpu').float()
+    else:
+        import clip
+        with torch.no_grad():
+            prompt_embeddings = model.encode_text(clip.tokenize(features.country_prompts(REPO_PATH))).float()
+    return GeolocationGraph(model.visual, prompt_embeddings, head).eval(), model, preprocessor, head, prompt_embeddings
+
+
+def export_graph(graph: GeolocationGraph, path: str, export_format: str = 'torchscript', n_px: int = 224):
+    """Exports the graph as TorchScript (torch.jit.trace) or ONNX file, with a dynamic batch size.
+
+    Args:
+        graph (GeolocationGraph): The graph.
+        path (str): Path of the exported file.
+        export_format (str, optional): 'torchscript' or 'onnx'. Defaults to 'torchscript'.
+        n_px (int, optional): Input resolution of the image encoder. Defaults to 224.
+    """
+    example = torch.randn(2, 3, n_px, n_px)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        if export_format == 'torchscript':
+            traced = torch.jit.freeze(torch.jit.trace(graph, example))
+            traced.save(path)
+        elif export_format == 'onnx':
+            # needs the onnx package
+            torch.onnx.export(graph, example, path, input_names=['images'], output_names=['country_probs'],
+                              dynamic_axes={'images': {0: 'batch'}, 'country_probs': {0: 'batch'}}, opset_version=17)
+        else:
+            raise ValueError(f'Unsupported format {export_format}, use torchscript or onnx.')
+
+
+def load_graph(path: str):
+    """Loads an exported graph as callable, that maps a float32 tensor of preprocessed images to the country probabilities.
+
+    Args:
+        path (str): Path of the TorchScript (.pt) or ONNX (.onnx) file.
+
+    Returns:
+        Callable: the graph
+    """
+    if path.endswith('.onnx'):
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        return lambda images: torch.from_numpy(session.run(None, {'images': images.numpy()})[0])
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return torch.jit.load(path, map_location='cpu')
+
+
+def eager_predict(model, head: nn.FinetunedClip, prompt_embeddings: torch.Tensor, images: torch.Tensor) -> torch.Tensor:
+    """The current prediction path: clip encode_image, calculate_distances per image and the head.
+
+    Returns:
+        torch.Tensor: country probabilities of shape (batch, countries)
+    """
+    from generate_embeddings import calculate_distances
+    with torch.no_grad():
+        image_embeddings = model.encode_image(images)
+        model_inputs = np.stack([np.frombuffer(calculate_distances(embedding, prompt_embeddings), dtype=np.float32) for embedding in image_embeddings])
+        return head(torch.from_numpy(model_inputs))
+
+
+def benchmark(REPO_PATH: str, DATA_PATH: str, checkpoint: str, exported_path: str, backbone: str = backbones.DEFAULT_BACKBONE,
+              dataset: str = 'geoguessr', num_images: int = 256, batch_size: int = 32, threads: int = None) -> dict:
+    """Compares the exported graph with the eager Python path on CPU, on the same preprocessed images.
+
+    Args:
+        REPO_PATH (str): path to the repo folder.
+        DATA_PATH (str): path to the data folder.
+        checkpoint (str): Path of the state dict of the FinetunedClip.
+        exported_path (str): Path of the exported graph.
+        backbone (str, optional): The CLIP backbone. Defaults to backbones.DEFAULT_BACKBONE.
+        dataset (str, optional): Dataset of the images. Defaults to 'geoguessr'.
+        num_images (int, optional): Number of images. Defaults to 256.
+        batch_size (int, optional): Batch size. Defaults to 32.
+        threads (int, optional): Number of torch threads, None keeps the default. Defaults to None.
+
+    Returns:
+        dict: images per second of both paths, maximal absolute difference of the probabilities and agreement of the top-1 countries
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    graph, model, preprocessor, head, prompt_embeddings = build_graph(REPO_PATH, checkpoint, backbone)
+    exported = load_graph(exported_path)
+    df = load_dataset.load_data(f'{DATA_PATH}/{dataset}').head(num_images)
+    dataset_images = load_dataset.ImageDataset_from_df(df, preprocessor)
+    batches = [torch.stack([dataset_images[i][0] for i in range(start, min(start + batch_size, len(df)))])
+               for start in range(0, len(df), batch_size)]
+
+    result = {'images': len(df), 'batch_size': batch_size, 'threads': torch.get_num_threads()}
+    outputs = {}
+    for name, predict in [('eager', lambda images: eager_predict(model, head, prompt_embeddings, images)),
+                          ('exported', lambda images: exported(images))]:
+        with torch.no_grad():
+            predict(batches[0])  # warm up
+            start = time.perf_counter()
+            outputs[name] = torch.cat([predict(images) for images in batches])
+        result[f'{name}_images_per_second'] = len(df) / (time.perf_counter() - start)
+    result['speedup'] = result['exported_images_per_second'] / result['eager_images_per_second']
+    result['max_abs_difference'] = (outputs['eager'] - outputs['exported']).abs().max().item()
+    result['top1_agreement'] = (outputs['eager'].argmax(dim=1) == outputs['exported'].argmax(dim=1)).float().mean().item()
+    return result
+
+
+if __name__ == "__main__":
+    """Exports the fused prediction graph of a trained model and benchmarks it against the eager path
+    """
+    parser = argparse.ArgumentParser(description='Export inference graph')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--checkpoint', metavar='str', required=True, help='The state dict of the trained FinetunedClip')
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--format', metavar='str', choices=['torchscript', 'onnx'], required=False, help='Export format', default='torchscript')
+    parser.add_argument('--output', metavar='str', required=False, help=f'Path of the exported graph, defaults to {EXPORT_FOLDER}/{{checkpoint}}.pt or .onnx', default=None)
+    parser.add_argument('--benchmark', action='store_true', required=False, help='Benchmark the exported graph against the eager path', default=False)
+    parser.add_argument('--dataset', metavar='str', required=False, help='Dataset of the benchmark', default='geoguessr')
+    parser.add_argument('--num_images', metavar='int', type=int, required=False, help='Number of benchmark images', default=256)
+    parser.add_argument('--batch_size', metavar='int', type=int, required=False, help='Batch size of the benchmark', default=32)
+    parser.add_argument('--threads', metavar='int', type=int, required=False, help='Number of torch threads', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+        DATA_PATH = paths['data_path']
+    output = args.output or os.path.join(REPO_PATH, EXPORT_FOLDER, os.path.basename(args.checkpoint) + ('.onnx' if args.format == 'onnx' else '.pt'))
+    graph = build_graph(REPO_PATH, args.checkpoint, args.backbone)[0]
+    export_graph(graph, output, args.format, graph.visual.input_resolution)
+    print(f"Exported the inference graph to {output}")
+    if args.benchmark:
+        result = benchmark(REPO_PATH, DATA_PATH, args.checkpoint, output, args.backbone, args.dataset, args.num_images, args.batch_size, args.threads)
+        print(pd.Series(result).to_string())
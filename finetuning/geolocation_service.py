@@ -0,0 +1,305 @@
+import sys
+sys.path.append('.')
+import os
+import json
+import time
+import base64
+import queue
+import argparse
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from finetuning.model import nn
+from utils import features
+from utils.embedding_server import MicroBatcher
+
+
+class GeolocationService:
+    """
+    Predicts countries and regions with a trained FinetunedClip. Accepts images (encoded by an EmbeddingService or an
+    EmbeddingClient), CLIP image embeddings or complete model inputs (image embedding and prompt similarities, see utils/features.py).
+    The model inputs of concurrent requests are passed through the model in micro-batches, the queue of waiting requests is bounded.
+
+    Attributes:
+        model (nn.FinetunedClip): The finetuned model.
+        countries (list): Country of every output of the model.
+        regions (list): Names of the regions.
+        region_operator (torch.Tensor): Sums the country probabilities of every region, shape (regions, countries).
+        embeddings (EmbeddingService or EmbeddingClient): Encodes the images, None if only embeddings are accepted.
+        batcher (MicroBatcher): Micro-batches the model inputs.
+
+    Usage:
+        service = GeolocationService(REPO_PATH, 'saved_models/model_geo_unbalanced.csv_..._epoch_15')
+        service.predict(embeddings=image_embeddings, top_k=5)
+    """
+
+    def __init__(self, REPO_PATH: str, checkpoint: str, embeddings=None, device: str = None, max_batch_size: int = 256,
+                 max_wait: float = 0.005, max_queue: int = 64, queue_timeout: float = 1.0):
+        """
+        Args:
+            REPO_PATH (str): path to the repo folder.
+            checkpoint (str): Path of the state dict of the FinetunedClip, saved by the ModelTrainer.
+            embeddings (EmbeddingService or EmbeddingClient, optional): Encodes images. Defaults to None.
+            device (str, optional): Device of the model, None uses cuda if available. Defaults to None.
+            max_batch_size (int, optional): Maximal number of inputs per forward pass. Defaults to 256.
+            max_wait (float, optional): Maximal time in seconds to wait for further requests of a batch. Defaults to 0.005.
+            max_queue (int, optional): Maximal number of waiting requests. Defaults to 64.
+            queue_timeout (float, optional): Maximal time in seconds a request waits for a place in the queue before it is rejected. Defaults to 1.0.
+        """
+        self.REPO_PATH = REPO_PATH
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = nn.FinetunedClip()
+        self.model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        self.model = self.model.to(self.device).eval()
+        self.embeddings = embeddings
+        self.queue_timeout = queue_timeout
+        self.prompt_embeddings = None
+
+        # same region grouping as the Regional_Loss
+        country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')
+        self.countries = country_list['Country'].to_list()
+        region_indices = country_list.groupby('Intermediate Region Name')['Country'].apply(lambda x: list(x.index))
+        self.regions = region_indices.index.to_list()
+        self.region_operator = torch.zeros(len(self.regions), len(self.countries))
+        for i, indices in enumerate(region_indices.to_list()):
+            self.region_operator[i, indices] = 1
+
+        self.batcher = MicroBatcher(self.forward, max_batch_size, max_wait, max_queue)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.requests = 0
+        self.inputs = 0
+        self.rejected = 0
+        self.latencies = collections.deque(maxlen=1000)
+
+    def forward(self, model_inputs: torch.Tensor) -> torch.Tensor:
+        """Country probabilities of a batch of model inputs, called by the micro-batcher."""
+        with torch.no_grad():
+            return self.model(model_inputs.to(self.device)).cpu()
+
+    def load_prompt_embeddings(self) -> np.ndarray:
+        """The country prompt embeddings, that the image embeddings are compared to. The embeddings saved by
+        generate_embeddings.py are used if they exist, as the model was trained on them, otherwise they are encoded.
+
+        Raises:
+            ValueError: Neither saved prompt embeddings nor an image encoder are available.
+
+        Returns:
+            np.ndarray: prompt embeddings of shape (countries, dim)
+        """
+        if self.prompt_embeddings is None:
+            path = f'{self.REPO_PATH}/CLIP_Embeddings/Prompt/prompt_image_shows_embedding.pt'
+            if os.path.isfile(path):
+                self.prompt_embeddings = torch.load(path, map_location='cpu').float().numpy()
+            elif self.embeddings is not None:
+                self.prompt_embeddings = self.embeddings.encode_text(features.country_prompts(self.REPO_PATH))
+            else:
+                raise ValueError(f'No prompt embeddings at {path}, run generate_embeddings.py or pass an embedding service.')
+        return self.prompt_embeddings
+
+    def model_inputs(self, paths: list = None, images: list = None, embeddings: np.ndarray = None) -> np.ndarray:
+        """Model inputs of images (by path or as encoded files), image embeddings or model inputs.
+
+        Raises:
+            ValueError: Images without an embedding service or embeddings of the wrong size.
+
+        Returns:
+            np.ndarray: float32 model inputs of shape (inputs, 723)
+        """
+        input_size = self.model.linear1.in_features
+        if embeddings is None:
+            if self.embeddings is None:
+                raise ValueError('Images can only be predicted with an embedding service, pass embeddings instead.')
+            embeddings = self.embeddings.encode_image(paths, images)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+        if embeddings.shape[1] == input_size:
+            return embeddings
+        if embeddings.shape[1] + len(self.countries) == input_size:
+            return features.model_inputs(embeddings, self.load_prompt_embeddings())
+        raise ValueError(f'Expected image embeddings of size {input_size - len(self.countries)} or model inputs of size {input_size}, got {embeddings.shape[1]}.')
+
+    def predict(self, paths: list = None, images: list = None, embeddings: np.ndarray = None, top_k: int = 5) -> list:
+        """Top-k countries and regions of every input.
+
+        Args:
+            paths (list, optional): Paths of images. Defaults to None.
+            images (list, optional): Encoded image files (bytes). Defaults to None.
+            embeddings (np.ndarray, optional): CLIP image embeddings or model inputs, one row per input. Defaults to None.
+            top_k (int, optional): Number of returned countries and regions. Defaults to 5.
+
+        Raises:
+            queue.Full: The service is overloaded, the request was rejected.
+
+        Returns:
+            list: per input a dict with the top_k countries and regions as [name, probability] pairs
+        """
+        start = time.monotonic()
+        model_inputs = torch.from_numpy(self.model_inputs(paths, images, embeddings))
+        try:
+            future = self.batcher.submit(model_inputs, timeout=self.queue_timeout)
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            raise
+        country_probs = future.result()
+        region_probs = country_probs @ self.region_operator.t()
+        countries = torch.topk(country_probs, min(top_k, len(self.countries)), dim=1)
+        regions = torch.topk(region_probs, min(top_k, len(self.regions)), dim=1)
+        predictions = [{
+            'countries': [[self.countries[index], probability] for index, probability in zip(country_indices.tolist(), country_values.tolist())],
+            'regions': [[self.regions[index], probability] for index, probability in zip(region_indices.tolist(), region_values.tolist())],
+        } for country_values, country_indices, region_values, region_indices in zip(countries.values, countries.indices, regions.values, regions.indices)]
+        with self.lock:
+            self.requests += 1
+            self.inputs += len(model_inputs)
+            self.latencies.append(time.monotonic() - start)
+        return predictions
+
+    def stats(self) -> dict:
+        """Number of requests, inputs, batches and rejected requests, throughput and latency of the last 1000 requests."""
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.monotonic() - self.started
+            return {
+                'requests': self.requests,
+                'inputs': self.inputs,
+                'rejected': self.rejected,
+                'batches': self.batcher.batches,
+                'mean_batch_size': self.batcher.items / self.batcher.batches if self.batcher.batches else 0.0,
+                'queued': self.batcher.requests.qsize(),
+                'inputs_per_second': self.inputs / elapsed,
+                'latency_mean_ms': float(latencies.mean() * 1000) if len(latencies) else 0.0,
+                'latency_p50_ms': float(np.percentile(latencies, 50) * 1000) if len(latencies) else 0.0,
+                'latency_p95_ms': float(np.percentile(latencies, 95) * 1000) if len(latencies) else 0.0,
+                'latency_max_ms': float(latencies.max() * 1000) if len(latencies) else 0.0,
+            }
+
+
+class GeolocationHandler(BaseHTTPRequestHandler):
+    """
+    Serves the GeolocationService of the server. POST /predict takes a json body with "paths" (image paths readable by the server),
+    "images" (base64 encoded image files) or "embeddings" (lists of floats) and an optional "top_k", and returns the predictions as json.
+    A request is answered with 503 if the queue stays full. GET /health returns the statistics of the service.
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_bytes(json.dumps(self.server.service.stats()).encode(), 'application/json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            images = [base64.b64decode(image) for image in request['images']] if 'images' in request else None
+            predictions = self.server.service.predict(request.get('paths'), images, request.get('embeddings'), int(request.get('top_k', 5)))
+        except queue.Full:
+            self.send_error(503, 'Queue is full')
+            return
+        except (ValueError, KeyError, OSError) as e:
+            self.send_error(400, str(e))
+            return
+        self.send_bytes(json.dumps({'predictions': predictions}).encode(), 'application/json')
+
+    def send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server(service: GeolocationService, port: int = 0):
+    """Starts the geolocation server in a background thread
+
+    Args:
+        service (GeolocationService): The service to serve.
+        port (int, optional): Port of the server, 0 selects a free port. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its url is http://127.0.0.1:{server.server_address[1]}
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), GeolocationHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_test(service: GeolocationService, inputs: np.ndarray, requests: int = 1000, inputs_per_request: int = 4, concurrency: int = 16) -> dict:
+    """Sends concurrent requests of random rows of inputs to the service (in process, without HTTP) and returns its statistics.
+
+    Args:
+        service (GeolocationService): The service.
+        inputs (np.ndarray): Image embeddings or model inputs.
+        requests (int, optional): Number of requests. Defaults to 1000.
+        inputs_per_request (int, optional): Number of inputs per request. Defaults to 4.
+        concurrency (int, optional): Number of concurrent clients. Defaults to 16.
+
+    Returns:
+        dict: statistics of the service
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    rng = np.random.default_rng(0)
+    batches = [inputs[rng.integers(0, len(inputs), inputs_per_request)] for _ in range(requests)]
+
+    def send(batch):
+        try:
+            service.predict(embeddings=batch)
+        except queue.Full:
+            pass
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(send, batches))
+    return service.stats()
+
+
+if __name__ == "__main__":
+    """Serves the predictions of a trained FinetunedClip, or runs a local load test with --load_test
+    """
+    parser = argparse.ArgumentParser(description='Geolocation service')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--checkpoint', metavar='str', required=True, help='The state dict of the trained FinetunedClip')
+    parser.add_argument('--port', metavar='int', type=int, required=False, help='Port of the server', default=8766)
+    parser.add_argument('--server_url', metavar='str', required=False, help='Url of a running embedding server, that encodes the images', default=None)
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone loaded in this process if no embedding server is given, see utils/backbones.py', default=None)
+    parser.add_argument('--max_batch_size', metavar='int', type=int, required=False, help='Maximal number of inputs per forward pass', default=256)
+    parser.add_argument('--max_wait_ms', metavar='float', type=float, required=False, help='Maximal time to wait for further requests of a batch', default=5.0)
+    parser.add_argument('--max_queue', metavar='int', type=int, required=False, help='Maximal number of waiting requests', default=64)
+    parser.add_argument('--load_test', metavar='str', required=False, help='Load test with the model inputs of this embedding csv instead of serving', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+    embeddings = None
+    if args.server_url is not None:
+        from utils.embedding_client import EmbeddingClient
+        embeddings = EmbeddingClient(args.server_url)
+    elif args.backbone is not None:
+        from utils.embedding_server import EmbeddingService
+        embeddings = EmbeddingService(REPO_PATH, args.backbone)
+    service = GeolocationService(REPO_PATH, args.checkpoint, embeddings, max_batch_size=args.max_batch_size,
+                                 max_wait=args.max_wait_ms / 1000, max_queue=args.max_queue)
+
+    if args.load_test is not None:
+        df = pd.read_csv(args.load_test)
+        inputs = np.stack([np.frombuffer(eval(value), dtype=np.float32) for value in df['model_input']])
+        print(json.dumps(load_test(service, inputs), indent=2))
+        sys.exit(0)
+    server = start_server(service, args.port)
+    print(f"Serving geolocation predictions at http://127.0.0.1:{server.server_address[1]}/predict")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
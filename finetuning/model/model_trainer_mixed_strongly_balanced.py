@@ -12,16 +12,11 @@ import os
 from utils import load_dataset, geo_metrics
 from finetuning.model.region_loss import Regional_Loss
 import ast
-import sklearn.model_selection
-from sklearn.metrics import confusion_matrix
-import seaborn as sn
 from torch.utils.data import DataLoader, TensorDataset
-from torch.utils.tensorboard import SummaryWriter
 import torch.nn.functional as F
 import argparse
 import yaml
 import math
-import matplotlib.pyplot as plt
 import random
 import numpy as np
 
@@ -66,6 +61,7 @@ class ModelTrainer():
 
         # self.region_criterion = Regional_Loss(self.country_list, self.region_list)
         self.log_dir=f'finetuning/runs/seed_{seed}/{self.training_dataset_name[:-4]}/starting_regional_loss_portion-{starting_regional_loss_portion}/regional_loss_decline-{regional_loss_decline}/{self.timestamp}'
+        from torch.utils.tensorboard import SummaryWriter
         self.writer = SummaryWriter(log_dir=self.log_dir)
         self.start_training()
 
@@ -288,6 +284,11 @@ class ModelTrainer():
         Returns:
             None
         """
+        # sklearn and the plotting libraries are only imported when the matrices are created
+        from sklearn.metrics import confusion_matrix
+        import seaborn as sn
+        import matplotlib.pyplot as plt
+
         # constant for classes
         classes = self.country_list['Country']
         np_classes = np.array(classes)
@@ -391,12 +392,15 @@ class ModelTrainer():
         return loss
 
 
-def create_and_train_model(REPO_PATH: str, seed: int = 1234):
+def create_and_train_model(REPO_PATH: str, seed: int = 1234, codec: str = None, prompts: str = None):
     """
     Creates and trains a model using the specified repository path.
 
     Args:
         REPO_PATH (str): The path to the repository.
+        codec (str, optional): Read the model inputs from the embedding store encoded with this codec (see utils/embedding_codecs.py). Defaults to None.
+        prompts (str, optional): Assemble the model inputs from the image embeddings with the prompt embeddings saved in this file
+            (see utils/load_dataset.assemble_model_inputs). Defaults to None.
 
     Returns:
         None
@@ -406,8 +410,8 @@ def create_and_train_model(REPO_PATH: str, seed: int = 1234):
     region_list = f'{REPO_PATH}/utils/country_list/UNSD_Methodology.csv'
 
     testing_directory = f'{REPO_PATH}/CLIP_Embeddings/Embeddings/CLIP_Embeddings/Testing'
-    test_df = pd.read_csv(f'{testing_directory}/known_test_data.csv')
-    zeroshot_test_df = pd.read_csv(f'{testing_directory}/zero_shot_test_data.csv')
+    test_df = load_dataset.read_split(f'{testing_directory}/known_test_data.csv', REPO_PATH, codec, prompts)
+    zeroshot_test_df = load_dataset.read_split(f'{testing_directory}/zero_shot_test_data.csv', REPO_PATH, codec, prompts)
     test_dataset = load_dataset.EmbeddingDataset_from_df(
         test_df, "test")
     zeroshot_test_dataset = load_dataset.EmbeddingDataset_from_df(
@@ -419,8 +423,8 @@ def create_and_train_model(REPO_PATH: str, seed: int = 1234):
     ]
 
     for elem in training_datasets:
-        train_df = pd.read_csv(
-            f'{REPO_PATH}/CLIP_Embeddings/Embeddings/CLIP_Embeddings/Training/{elem}')
+        train_df = load_dataset.read_split(
+            f'{REPO_PATH}/CLIP_Embeddings/Embeddings/CLIP_Embeddings/Training/{elem}', REPO_PATH, codec, prompts)
         
         hyperparameters = [
             {'starting_regional_loss_portion': 0.0,
@@ -451,6 +455,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Pretrained Model')
     parser.add_argument('--yaml_path', metavar='str', required=True,
                         help='The path to the yaml file with the stored paths')
+    parser.add_argument('--codec', metavar='str',
+                        required=False, help='Read the model inputs from the embedding store encoded with this codec', default=None)
+    parser.add_argument('--prompts', metavar='str',
+                        required=False, help='Assemble the model inputs with the prompt embeddings saved in this file', default=None)
     # parser.add_argument('--training_dataset_name', metavar='str', required=True, help='the name of the dataset')
     # parser.add_argument('--starting_regional_loss_portion', metavar='float', required=True, help='the starting regional loss portion')
     # parser.add_argument('--regional_loss_decline', metavar='float', required=True, help='the factor with which the regional loss portion is multiplied each epoch')
@@ -459,4 +467,4 @@ if __name__ == "__main__":
     with open(args.yaml_path) as file:
         paths = yaml.safe_load(file)
         REPO_PATH = paths['repo_path']
-        create_and_train_model(REPO_PATH)
+        create_and_train_model(REPO_PATH, codec=args.codec, prompts=args.prompts)
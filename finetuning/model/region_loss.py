@@ -2,7 +2,6 @@ import torch
 import ast
 import torch.nn.functional as F
 import numpy as np
-from sklearn.metrics import precision_recall_fscore_support as score
 
 class Regional_Loss(torch.nn.Module):
     def __init__(self, country_list):
@@ -129,6 +128,7 @@ class Regional_Loss(torch.nn.Module):
         # get the index of the predicted country
         country_predictions_idxs = torch.argmax(outputs, axis=1).tolist()
         # calculate the precision, recall, F1-score, and support of the country predictions
+        from sklearn.metrics import precision_recall_fscore_support as score
         precision, recall, fscore, support = score(target_countries_idxs, country_predictions_idxs, zero_division=0)
         
         country_metrics_index = np.take(self.country_list["Country"].unique(), np.unique(target_countries_idxs))
@@ -157,6 +157,7 @@ class Regional_Loss(torch.nn.Module):
             outputs, self.selective_sum_operator.transpose(0, 1))
         region_predictions_idxs = torch.argmax(region_outputs, axis=1).tolist()
         # calculate the precision, recall, F1-score, and support of the region predictions
+        from sklearn.metrics import precision_recall_fscore_support as score
         precision, recall, fscore, support = score(target_region_idx.tolist(), region_predictions_idxs, zero_division=0)
         all_regions = np.sort(self.country_list["Intermediate Region Name"].unique())
 
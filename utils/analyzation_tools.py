@@ -1,11 +1,8 @@
 import numpy as np
-import scipy.stats as stats
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import glob
 import os
-from tensorflow.python.summary.summary_iterator import summary_iterator
+from utils import statistical_tests
 
 
 def corrected_repeated_kFold_cv_test(data1, data2, n1, n2, alpha):
@@ -29,21 +26,8 @@ def corrected_repeated_kFold_cv_test(data1, data2, n1, n2, alpha):
     n = len(data1)
     if n != len(data2):
         raise ValueError("The datasets must have the same length.")
-    # estimate the mean
-    m = 1 / n * sum([data1[i] - data2[i] for i in range(n)])
-    # estimate the standard deviation
-    stdv_sq = np.sqrt(
-        1 / (n - 1) * sum([(data1[i] - data2[i] - m) ** 2 for i in range(n)])
-    )
-    # calculate the test statistic
-    t = m / np.sqrt((1 / n + n2 / n1) * stdv_sq)
-    # degrees of freedom
-    df = n - 1
-    # calculate the critical value
-    cv = stats.t.ppf(1.0 - alpha, df)
-    # calculate the p-value
-    p = (1.0 - stats.t.cdf(abs(t), df)) * 2.0
-    return df, t, cv, p
+    df, t, cv, p = statistical_tests.corrected_repeated_kfold_cv_test(np.array([data1, data2]), n1, n2, alpha)
+    return df, t[0, 1], cv, p[0, 1]
 
 
 def box_plot_experiments(list_of_df, name, save_path, loss_number=0, dataset_names=None, metric_names=None):
@@ -59,6 +43,10 @@ def box_plot_experiments(list_of_df, name, save_path, loss_number=0, dataset_nam
     Returns:
     pd.DataFrame: A concatenated dataframe containing all data with a coloumn tagging the used Loss.
     """
+    # plotting libraries are only imported when a plot is created
+    import seaborn as sns
+    import matplotlib.pyplot as plt
+
     dataset_to_indices = {'geo_strongly_balanced':0, 'geo_unbalanced':1, 'geo_weakly_balanced':2, 'mixed_strongly_balanced':3, 'mixed_weakly_balanced':4}
     if dataset_names is not None:
         indices = [dataset_to_indices[name] for name in dataset_names]
@@ -109,6 +97,9 @@ def read_event_for_different_seeds(log_dir):
             - country_columns_test: DataFrame containing test metrics for non-region columns.
             - other_columns: DataFrame containing other 
     """
+    # TensorFlow is only needed to read the event files
+    from tensorflow.python.summary.summary_iterator import summary_iterator
+
     # Get a list of file paths that match the pattern in log_dir
     log_files = glob.glob(log_dir + "/*")
     validation_columns = pd.DataFrame([])
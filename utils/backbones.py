@@ -0,0 +1,214 @@
+import sys
+sys.path.append('.')
+import os
+import time
+import argparse
+import warnings
+import yaml
+import torch
+
+# Backbone used by the experiments, the embeddings and the finetuning
+DEFAULT_BACKBONE = 'ViT-B/32'
+
+# Folder of the local weight files, {repo}/models
+DEFAULT_MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'models')
+
+# Loaded backbones and their load statistics of this process, by weight file and device
+_backbones = {}
+_load_stats = {}
+
+
+def weight_file(name: str, model_dir: str = DEFAULT_MODEL_DIR) -> str:
+    """Path of the local weight file of a backbone, e.g. ViT-B/32 -> {model_dir}/ViT-B-32.pt
+
+    Args:
+        name (str): Name of the backbone.
+        model_dir (str, optional): Folder of the weight files. Defaults to DEFAULT_MODEL_DIR.
+
+    Returns:
+        str: path of the weight file
+    """
+    return os.path.join(model_dir, name.replace('/', '-') + '.pt')
+
+
+def available_backbones(model_dir: str = DEFAULT_MODEL_DIR) -> list:
+    """Names of all backbones that can be loaded: the CLIP models and all weight files in model_dir,
+    e.g. other CLIP variants or finetuned CLIP weights saved as state dict.
+
+    Args:
+        model_dir (str, optional): Folder of the weight files. Defaults to DEFAULT_MODEL_DIR.
+
+    Returns:
+        list: names of the backbones
+    """
+    import clip
+    names = list(clip.available_models())
+    if os.path.isdir(model_dir):
+        converted = {weight_file(name, model_dir) for name in names}
+        names += sorted(os.path.splitext(file)[0] for file in os.listdir(model_dir)
+                        if file.endswith('.pt') and os.path.join(model_dir, file) not in converted)
+    return names
+
+
+def convert_clip_checkpoint(name: str, path: str):
+    """Converts a CLIP checkpoint (downloaded by clip.load if necessary) into a float32 state dict, that can be memory-mapped.
+
+    Args:
+        name (str): Name of the CLIP model or path to a CLIP checkpoint.
+        path (str): Path of the weight file.
+    """
+    import clip
+    model, _ = clip.load(name, device='cpu', jit=False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    torch.save(model.state_dict(), path + '.part')
+    os.replace(path + '.part', path)
+
+
+def resolve_backbone(name: str, model_dir: str = DEFAULT_MODEL_DIR) -> str:
+    """Resolves the name of a backbone to its local weight file. CLIP models are converted on first use.
+
+    Args:
+        name (str): Name of the backbone (see available_backbones) or path to a weight file.
+        model_dir (str, optional): Folder of the weight files. Defaults to DEFAULT_MODEL_DIR.
+
+    Raises:
+        ValueError: Unknown backbone
+
+    Returns:
+        str: path of the weight file
+    """
+    import clip
+    if os.path.isfile(name):
+        return os.path.abspath(name)
+    path = weight_file(name, model_dir)
+    if os.path.isfile(path):
+        return path
+    if name in clip.available_models():
+        print(f"Converting {name} into {path}")
+        convert_clip_checkpoint(name, path)
+        return path
+    raise ValueError(f'Unknown backbone {name}, use one of {available_backbones(model_dir)} or the path to a weight file.')
+
+
+def memory_usage() -> dict:
+    """Resident memory of this process in MiB. File-backed pages (e.g. memory-mapped weights) are shared between processes.
+
+    Returns:
+        dict: total, anonymous and file-backed resident memory, None if not available on this platform
+    """
+    usage = {'rss': None, 'rss_anon': None, 'rss_file': None}
+    if os.path.isfile('/proc/self/status'):
+        fields = {'VmRSS:': 'rss', 'RssAnon:': 'rss_anon', 'RssFile:': 'rss_file'}
+        with open('/proc/self/status') as status:
+            for line in status:
+                parts = line.split()
+                if parts and parts[0] in fields:
+                    usage[fields[parts[0]]] = int(parts[1]) / 1024
+    else:
+        import resource
+        # peak resident memory, in bytes on macOS
+        usage['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+    return usage
+
+
+def build_backbone(path: str, device: str = 'cpu') -> tuple:
+    """Builds a CLIP model from a weight file. The weights are memory-mapped instead of read into memory,
+    so all processes loading the same file share its pages and only the accessed pages are read.
+
+    Args:
+        path (str): Path of the weight file (state dict saved with torch.save).
+        device (str, optional): Device of the model. Defaults to 'cpu'.
+
+    Returns:
+        tuple: model and preprocessor, as returned by clip.load
+    """
+    import clip
+    state_dict = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    # build_model infers the architecture from the state dict, on the meta device no memory is allocated for the weights
+    with torch.device('meta'), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        model = clip.model.build_model(dict(state_dict))
+    model.load_state_dict(state_dict, assign=True)
+    # the attention mask of the text transformer is not part of the state dict
+    for block in model.transformer.resblocks:
+        block.attn_mask = model.build_attention_mask()
+    if device != 'cpu':
+        # same precision as clip.load on the GPU
+        model = model.to(device)
+        clip.model.convert_weights(model)
+    return model.eval(), clip.clip._transform(model.visual.input_resolution)
+
+
+def load_backbone(name: str = DEFAULT_BACKBONE, device: str = None, model_dir: str = DEFAULT_MODEL_DIR, quantization: str = None, calibration: torch.Tensor = None) -> tuple:
+    """Drop-in replacement of clip.load. Every backbone is loaded once per process, device and quantization, later calls return the same model.
+
+    Args:
+        name (str, optional): Name of the backbone (see available_backbones) or path to a weight file. Defaults to DEFAULT_BACKBONE.
+        device (str, optional): Device of the model, None uses cuda if available. Defaults to None.
+        model_dir (str, optional): Folder of the weight files. Defaults to DEFAULT_MODEL_DIR.
+        quantization (str, optional): int8 quantization of the image encoder on the CPU, 'dynamic' or 'static' (see utils/quantization.py). Defaults to None.
+        calibration (torch.Tensor, optional): Preprocessed calibration images of the static quantization. Defaults to None.
+
+    Raises:
+        ValueError: Quantization on another device than the CPU.
+
+    Returns:
+        tuple: model and preprocessor
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() and quantization is None else "cpu"
+    if quantization is not None and device != 'cpu':
+        raise ValueError(f'Quantized backbones only run on the cpu, not on {device}.')
+    path = resolve_backbone(name, model_dir)
+    key = (path, device, quantization)
+    if key not in _backbones:
+        before = memory_usage()
+        start = time.perf_counter()
+        _backbones[key] = build_backbone(path, device)
+        if quantization is not None:
+            from utils.quantization import quantize_backbone
+            quantize_backbone(_backbones[key][0], quantization, calibration)
+        after = memory_usage()
+        _load_stats[key] = {
+            'backbone': name,
+            'path': path,
+            'device': device,
+            'quantization': quantization,
+            'load_seconds': time.perf_counter() - start,
+            'rss_mib': after['rss'],
+            'rss_delta_mib': after['rss'] - before['rss'] if after['rss'] is not None else None,
+            'rss_file_mib': after['rss_file'],
+        }
+        print(f"Loaded backbone {name}{' (' + quantization + ' int8)' if quantization else ''} on {device} in {_load_stats[key]['load_seconds']:.2f}s")
+    return _backbones[key]
+
+
+def backbone_report() -> list:
+    """Load time and resident memory after loading, for every backbone loaded by this process.
+
+    Returns:
+        list: one dict per backbone
+    """
+    return list(_load_stats.values())
+
+
+if __name__ == "__main__":
+    """Lists the available backbones, converts them into local weight files and reports load time and memory
+    """
+    parser = argparse.ArgumentParser(description='Backbone registry')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--backbones', metavar='str', nargs='*', required=False, help='The backbones to load', default=[DEFAULT_BACKBONE])
+    parser.add_argument('--device', metavar='str', required=False, help='Device of the models', default=None)
+    parser.add_argument('--list', action='store_true', required=False, help='Only list the available backbones', default=False)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        MODEL_DIR = os.path.join(paths['repo_path'], 'models')
+    if args.list:
+        print('\n'.join(available_backbones(MODEL_DIR)))
+        sys.exit(0)
+    for backbone in args.backbones:
+        load_backbone(backbone, args.device, MODEL_DIR)
+    for stats in backbone_report():
+        print(f"{stats['backbone']:<20} {stats['device']:<5} {stats['load_seconds']:6.2f}s  rss {stats['rss_mib']:.0f} MiB (+{stats['rss_delta_mib']:.0f} MiB, {stats['rss_file_mib'] or 0:.0f} MiB memory-mapped)")
@@ -0,0 +1,109 @@
+import io
+import json
+import base64
+import urllib.request
+import urllib.error
+import numpy as np
+
+
+class EmbeddingClient:
+    """
+    Client of the embedding server (utils/embedding_server.py). Only needs numpy, the model stays in the server process.
+
+    Attributes:
+        url (str): Url of the server, e.g. http://127.0.0.1:8765
+        timeout (float): Timeout of a request in seconds.
+
+    Usage:
+        client = EmbeddingClient('http://127.0.0.1:8765')
+        embeddings = client.encode_image(paths=df['path'].tolist())
+    """
+
+    def __init__(self, url: str, timeout: float = 600, chunk_size: int = 256):
+        """
+        Args:
+            url (str): Url of the server.
+            timeout (float, optional): Timeout of a request in seconds. Defaults to 600.
+            chunk_size (int, optional): Maximal number of images per request, larger lists are split. Defaults to 256.
+        """
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def post(self, endpoint: str, body: dict) -> np.ndarray:
+        """Sends a request to the server.
+
+        Args:
+            endpoint (str): The endpoint, e.g. /embed/image.
+            body (dict): The json body.
+
+        Raises:
+            ValueError: The server rejected the request.
+
+        Returns:
+            np.ndarray: the answer of the server
+        """
+        request = urllib.request.Request(self.url + endpoint, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return np.load(io.BytesIO(response.read()))
+        except urllib.error.HTTPError as e:
+            raise ValueError(f'Embedding server rejected {endpoint}: {e.code} {e.reason}') from e
+
+    def post_images(self, endpoint: str, paths: list = None, images: list = None, **body) -> np.ndarray:
+        """Sends images by path or as encoded files, in requests of at most chunk_size images.
+
+        Args:
+            endpoint (str): The endpoint.
+            paths (list, optional): Paths of the images, readable by the server. Defaults to None.
+            images (list, optional): Encoded image files (bytes). Defaults to None.
+            body: Further fields of the json body.
+
+        Returns:
+            np.ndarray: the concatenated answers of the server
+        """
+        if paths is not None:
+            items, key = [str(path) for path in paths], 'paths'
+        else:
+            items, key = [base64.b64encode(image).decode() for image in images], 'images'
+        results = [self.post(endpoint, dict(body, **{key: items[start:start + self.chunk_size]}))
+                   for start in range(0, max(len(items), 1), self.chunk_size)]
+        return np.concatenate(results)
+
+    def encode_image(self, paths: list = None, images: list = None) -> np.ndarray:
+        """Image embeddings, of images given by path (readable by the server) or as encoded image files (bytes).
+
+        Returns:
+            np.ndarray: float32 embeddings of shape (images, dim)
+        """
+        return self.post_images('/embed/image', paths, images)
+
+    def encode_text(self, texts: list) -> np.ndarray:
+        """Text embeddings, texts are cached by the server.
+
+        Returns:
+            np.ndarray: float32 embeddings of shape (texts, dim)
+        """
+        return self.post('/embed/text', {'texts': list(texts)})
+
+    def model_input(self, paths: list = None, images: list = None) -> np.ndarray:
+        """Model inputs of the finetuned models: image embedding and similarities to the country prompts.
+
+        Returns:
+            np.ndarray: float32 model inputs of shape (images, dim + countries)
+        """
+        return self.post_images('/model_input', paths, images)
+
+    def logits(self, texts: list, paths: list = None, images: list = None) -> np.ndarray:
+        """Logits per image over the texts, as returned by the CLIP model.
+
+        Returns:
+            np.ndarray: float32 logits of shape (images, texts)
+        """
+        return self.post_images('/logits', paths, images, texts=list(texts))
+
+    def stats(self) -> dict:
+        """Statistics of the server, raises an URLError if the server is not running."""
+        with urllib.request.urlopen(self.url + '/health', timeout=self.timeout) as response:
+            return json.loads(response.read())
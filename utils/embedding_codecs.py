@@ -0,0 +1,336 @@
+import sys
+sys.path.append('.')
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import yaml
+
+# Embedding csv files of the store, in store order, as read by finetuning/create_datasets_from_embddings.py
+STORE_PATHS = [
+    "CLIP_Embeddings/Image/geoguessr_embeddings.csv",
+    "CLIP_Embeddings/Image/aerial_embeddings.csv",
+    "CLIP_Embeddings/Image/tourist_embeddings.csv",
+]
+
+# Folder of the encoded stores, one sub folder per codec
+CODEC_FOLDER = 'CLIP_Embeddings/Codecs'
+
+# Columns of the store that are not copied into an encoded store, model_input is encoded and Embedding is its printed image part
+ENCODED_COLUMNS = ['Embedding', 'model_input']
+
+# Encoded stores of this process, by folder
+_codec_stores = {}
+
+
+class Float32Codec:
+    """
+    Stores the model inputs as float32, a binary copy of the csv store. All codecs encode a float32 matrix of model inputs
+    into a uint8 matrix with a fixed number of bytes per row, which is memory-mapped and decoded in batches.
+    """
+    name = 'float32'
+
+    def fit(self, model_inputs: np.ndarray):
+        """Learns the parameters of the codec from the model inputs of shape (rows, dim)."""
+        self.dim = model_inputs.shape[1]
+        return self
+
+    def encode(self, model_inputs: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(model_inputs, dtype=np.float32).view(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(codes).view(np.float32)
+
+    def state(self) -> dict:
+        """Parameters of the codec as numpy arrays, saved with np.savez."""
+        return {'dim': np.array(self.dim)}
+
+    def load_state(self, state: dict):
+        self.dim = int(state['dim'])
+        return self
+
+
+class Float16Codec(Float32Codec):
+    """Stores the model inputs as float16, half the size at a relative error of about 5e-4."""
+    name = 'float16'
+
+    def encode(self, model_inputs: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(model_inputs, dtype=np.float16).view(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(codes).view(np.float16).astype(np.float32)
+
+
+class Int8Codec(Float32Codec):
+    """Stores every dimension as 8 bit integer, scaled between the minimum and the maximum of the dimension, a quarter of the size."""
+    name = 'int8'
+
+    def fit(self, model_inputs: np.ndarray):
+        super().fit(model_inputs)
+        self.offset = model_inputs.min(axis=0).astype(np.float32)
+        self.scale = np.maximum((model_inputs.max(axis=0) - self.offset) / 255, np.finfo(np.float32).tiny).astype(np.float32)
+        return self
+
+    def encode(self, model_inputs: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((model_inputs - self.offset) / self.scale), 0, 255).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes * self.scale + self.offset
+
+    def state(self) -> dict:
+        return dict(super().state(), offset=self.offset, scale=self.scale)
+
+    def load_state(self, state: dict):
+        super().load_state(state)
+        self.offset, self.scale = state['offset'], state['scale']
+        return self
+
+
+class ProductQuantizationCodec(Float32Codec):
+    """
+    Product quantization of the image embedding: its dimensions are split into subspaces and every subspace is stored as index
+    of the nearest of 256 centroids (k-means). The prompt similarities are stored as float16.
+
+    Attributes:
+        image_dim (int): Dimensions of the image embedding at the start of the model inputs.
+        subspaces (int): Number of subspaces, one byte per subspace.
+        centroids (np.ndarray): Centroids of shape (subspaces, 256, image_dim / subspaces).
+    """
+    name = 'pq'
+
+    def __init__(self, image_dim: int = 512, subspaces: int = 64, sample_size: int = 20000, seed: int = 1234):
+        self.image_dim = image_dim
+        self.subspaces = subspaces
+        self.sample_size = sample_size
+        self.seed = seed
+
+    def fit(self, model_inputs: np.ndarray):
+        from sklearn.cluster import KMeans
+        if model_inputs.shape[1] < self.image_dim or self.image_dim % self.subspaces:
+            raise ValueError(f'Product quantization needs model inputs with at least {self.image_dim} dimensions, divisible into {self.subspaces} subspaces.')
+        super().fit(model_inputs)
+        rng = np.random.default_rng(self.seed)
+        sample = model_inputs[rng.permutation(len(model_inputs))[:self.sample_size], :self.image_dim]
+        centroids = min(256, len(sample))
+        self.centroids = np.stack([
+            KMeans(centroids, n_init=1, random_state=self.seed).fit(subspace).cluster_centers_
+            for subspace in np.split(sample.astype(np.float64), self.subspaces, axis=1)
+        ]).astype(np.float32)
+        return self
+
+    def encode(self, model_inputs: np.ndarray) -> np.ndarray:
+        indices = np.empty((len(model_inputs), self.subspaces), dtype=np.uint8)
+        for i, subspace in enumerate(np.split(model_inputs[:, :self.image_dim], self.subspaces, axis=1)):
+            distances = (subspace ** 2).sum(axis=1, keepdims=True) - 2 * subspace @ self.centroids[i].T + (self.centroids[i] ** 2).sum(axis=1)
+            indices[:, i] = distances.argmin(axis=1)
+        similarities = np.ascontiguousarray(model_inputs[:, self.image_dim:], dtype=np.float16).view(np.uint8)
+        return np.concatenate([indices, similarities], axis=1)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        indices = codes[:, :self.subspaces]
+        image = self.centroids[np.arange(self.subspaces), indices].reshape(len(codes), self.image_dim)
+        similarities = np.ascontiguousarray(codes[:, self.subspaces:]).view(np.float16).astype(np.float32)
+        return np.concatenate([image, similarities], axis=1)
+
+    def state(self) -> dict:
+        return dict(super().state(), image_dim=np.array(self.image_dim), subspaces=np.array(self.subspaces), centroids=self.centroids)
+
+    def load_state(self, state: dict):
+        super().load_state(state)
+        self.image_dim, self.subspaces, self.centroids = int(state['image_dim']), int(state['subspaces']), state['centroids']
+        return self
+
+
+CODECS = {codec.name: codec for codec in [Float32Codec, Float16Codec, Int8Codec, ProductQuantizationCodec]}
+
+
+def parse_model_inputs(values) -> np.ndarray:
+    """Parses the model inputs of the csv store (printed bytes) into a float32 matrix."""
+    return np.stack([np.frombuffer(eval(value), dtype=np.float32) for value in values])
+
+
+def codec_dir(REPO_PATH: str, codec: str) -> str:
+    return os.path.join(REPO_PATH, CODEC_FOLDER, codec)
+
+
+def read_store(REPO_PATH: str, store_paths: list = STORE_PATHS) -> tuple:
+    """Reads the embedding csv files of the store.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_paths (list, optional): Embedding csv files of the store, relative to the repository. Defaults to STORE_PATHS.
+
+    Returns:
+        tuple: the concatenated store (pd.DataFrame), its store files as listed in the split manifests and the parsed model inputs
+    """
+    frames = [pd.read_csv(os.path.join(REPO_PATH, path)) for path in store_paths]
+    from utils.load_dataset import store_file_entry
+    store_files = [store_file_entry(REPO_PATH, path, len(df)) for path, df in zip(store_paths, frames)]
+    store = pd.concat(frames, ignore_index=True)
+    return store, store_files, parse_model_inputs(store['model_input'])
+
+
+def encode_store(REPO_PATH: str, codec: str, store_paths: list = STORE_PATHS) -> dict:
+    """Encodes the model inputs of the embedding store with a codec and saves them into CLIP_Embeddings/Codecs/{codec}:
+    codes.npy (uint8, one row per store row), params.npz (parameters of the codec), rows.csv (all other columns of the store
+    except Embedding) and store.json (the store files it was encoded from, as listed in the split manifests).
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        codec (str): Name of the codec, see CODECS.
+        store_paths (list, optional): Embedding csv files of the store, relative to the repository. Defaults to STORE_PATHS.
+
+    Returns:
+        dict: the store files
+    """
+    store, store_files, model_inputs = read_store(REPO_PATH, store_paths)
+    encoder = CODECS[codec]().fit(model_inputs)
+    folder = codec_dir(REPO_PATH, codec)
+    os.makedirs(folder, exist_ok=True)
+    # store.json is written last, an interrupted encoding is not used
+    if os.path.isfile(os.path.join(folder, 'store.json')):
+        os.remove(os.path.join(folder, 'store.json'))
+    np.save(os.path.join(folder, 'codes.npy'), encoder.encode(model_inputs))
+    np.savez(os.path.join(folder, 'params.npz'), **encoder.state())
+    store.drop(columns=ENCODED_COLUMNS).to_csv(os.path.join(folder, 'rows.csv'), index=False)
+    with open(os.path.join(folder, 'store.json'), 'w') as handler:
+        json.dump({'codec': codec, 'store': store_files}, handler)
+    return store_files
+
+
+def load_codec_store(REPO_PATH: str, store_files: list, codec: str) -> tuple:
+    """Loads an encoded store, once per process. The codes are memory-mapped.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_files (list): Entries of the store of a split manifest.
+        codec (str): Name of the codec.
+
+    Raises:
+        ValueError: If there is no encoded store of the codec or it was encoded from other store files.
+
+    Returns:
+        tuple: rows (pd.DataFrame), codes (np.memmap) and the codec
+    """
+    folder = codec_dir(REPO_PATH, codec)
+    if folder not in _codec_stores:
+        if not os.path.isfile(os.path.join(folder, 'store.json')):
+            raise ValueError(f'No {codec} store in {folder}, run python utils/embedding_codecs.py --codecs {codec}.')
+        with open(os.path.join(folder, 'store.json')) as handler:
+            encoded = json.load(handler)
+        with np.load(os.path.join(folder, 'params.npz')) as params:
+            decoder = CODECS[codec]().load_state(dict(params))
+        _codec_stores[folder] = (encoded['store'], pd.read_csv(os.path.join(folder, 'rows.csv')),
+                                 np.load(os.path.join(folder, 'codes.npy'), mmap_mode='r'), decoder)
+    encoded_files, rows, codes, decoder = _codec_stores[folder]
+    if json.dumps(encoded_files, sort_keys=True) != json.dumps(store_files, sort_keys=True):
+        raise ValueError(f'The {codec} store in {folder} was encoded from other embedding files, run python utils/embedding_codecs.py --codecs {codec} again.')
+    return rows, codes, decoder
+
+
+def decode_rows(codes: np.ndarray, decoder, positions, batch_size: int = 8192) -> np.ndarray:
+    """Decodes the model inputs of rows of an encoded store in batches.
+
+    Args:
+        codes (np.ndarray): The codes of the store.
+        decoder (Float32Codec): The codec.
+        positions (list): Positions of the rows.
+        batch_size (int, optional): Number of rows decoded at once. Defaults to 8192.
+
+    Returns:
+        np.ndarray: float32 model inputs of shape (rows, dim)
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    model_inputs = np.empty((len(positions), decoder.dim), dtype=np.float32)
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        # reading the memory-mapped codes in store order touches every page once
+        order = np.argsort(batch, kind='stable')
+        model_inputs[start + order] = decoder.decode(codes[batch[order]])
+    return model_inputs
+
+
+def codec_report(REPO_PATH: str, codecs: list, split: str, checkpoint: str = None) -> pd.DataFrame:
+    """Compares the codecs with the csv store on a split: size of the store, load time of the split (parsing or decoding
+    the model inputs), reconstruction error and the accuracy of a trained FinetunedClip.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        codecs (list): Names of the codecs, their stores have to be encoded.
+        split (str): Path of the split, e.g. CLIP_Embeddings/Testing/known_test_data.csv.
+        checkpoint (str, optional): State dict of a trained FinetunedClip, None skips the accuracy. Defaults to None.
+
+    Returns:
+        pd.DataFrame: one row for the csv store and one per codec
+    """
+    import torch
+    from utils import load_dataset
+
+    def load(codec):
+        load_dataset._embedding_stores.clear()
+        _codec_stores.clear()
+        start = time.perf_counter()
+        dataset = load_dataset.EmbeddingDataset_from_df(load_dataset.read_split(split, REPO_PATH, codec), 'test')
+        return dataset, time.perf_counter() - start
+
+    head = None
+    if checkpoint is not None:
+        from finetuning.model import nn
+        head = nn.FinetunedClip()
+        head.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        head.eval()
+        countries = np.array(pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')['Country'])
+
+    rows = []
+    reference = None
+    for codec in [None] + list(codecs):
+        dataset, seconds = load(codec)
+        model_inputs = dataset.model_inputs.cpu().numpy()
+        if codec is None:
+            reference = model_inputs
+            size = sum(os.path.getsize(os.path.join(REPO_PATH, path)) for path in STORE_PATHS)
+        else:
+            folder = codec_dir(REPO_PATH, codec)
+            size = sum(os.path.getsize(os.path.join(folder, file)) for file in ['codes.npy', 'params.npz', 'rows.csv'])
+        image, reference_image = model_inputs[:, :512], reference[:, :512]
+        row = {
+            'store': codec or 'csv',
+            'size_mib': size / 2**20,
+            'load_seconds': seconds,
+            'max_abs_error': float(np.abs(model_inputs - reference).max()),
+            'min_image_cosine': float(((image * reference_image).sum(axis=1) / np.linalg.norm(image, axis=1) / np.linalg.norm(reference_image, axis=1)).min()),
+        }
+        if head is not None:
+            with torch.no_grad():
+                predictions = countries[head(torch.from_numpy(model_inputs)).argmax(dim=1).numpy()]
+            row['accuracy'] = float(np.mean(predictions == np.array(dataset.labels)))
+        rows.append(row)
+    result = pd.DataFrame(rows)
+    if head is not None:
+        result['accuracy_change'] = result['accuracy'] - result['accuracy'].iloc[0]
+    return result
+
+
+if __name__ == "__main__":
+    """Encodes the embedding store with the codecs and reports size, load time and accuracy against the csv store
+    """
+    parser = argparse.ArgumentParser(description='Embedding codecs')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--codecs', metavar='str', nargs='*', choices=list(CODECS), required=False, help='The codecs', default=list(CODECS))
+    parser.add_argument('--report_only', action='store_true', required=False, help='Only report, the stores are already encoded', default=False)
+    parser.add_argument('--split', metavar='str', required=False, help='Split of the report, defaults to CLIP_Embeddings/Testing/known_test_data.csv', default=None)
+    parser.add_argument('--checkpoint', metavar='str', required=False, help='State dict of a trained FinetunedClip for the accuracy', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+    if not args.report_only:
+        for codec in args.codecs:
+            start = time.perf_counter()
+            encode_store(REPO_PATH, codec)
+            print(f"Encoded the store with {codec} in {time.perf_counter() - start:.1f}s")
+    split = args.split or f'{REPO_PATH}/CLIP_Embeddings/Testing/known_test_data.csv'
+    print(codec_report(REPO_PATH, args.codecs, split, args.checkpoint).to_string(index=False))
@@ -0,0 +1,298 @@
+import sys
+sys.path.append('.')
+import io
+import os
+import json
+import time
+import base64
+import queue
+import argparse
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import yaml
+import torch
+from PIL import Image
+from utils import backbones, features
+
+
+class MicroBatcher:
+    """
+    Collects the inputs of concurrent requests into batches for a single worker thread. The worker takes the first waiting
+    request and adds further requests until max_batch_size inputs are collected or max_wait seconds have passed.
+
+    Attributes:
+        function (Callable): Function applied to a batch, maps a tensor of inputs to a tensor of outputs of the same length.
+        max_batch_size (int): Maximal number of inputs per batch (a larger single request is processed as one batch).
+        max_wait (float): Maximal time in seconds to wait for further requests.
+        requests (queue.Queue): Waiting requests, bounded by max_queue (0 is unbounded).
+        batches (int): Number of processed batches.
+        items (int): Number of processed inputs.
+    """
+
+    def __init__(self, function, max_batch_size: int = 64, max_wait: float = 0.005, max_queue: int = 0):
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue(max_queue)
+        self.batches = 0
+        self.items = 0
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, inputs: torch.Tensor, timeout: float = None) -> Future:
+        """Queues the inputs of a request. If the queue is full, waits at most timeout seconds for a free place.
+
+        Args:
+            inputs (torch.Tensor): Inputs of the request, first dimension is the batch.
+            timeout (float, optional): Maximal waiting time for a free place in the queue, None waits until there is one. Defaults to None.
+
+        Raises:
+            queue.Full: The queue is still full after timeout seconds.
+
+        Returns:
+            Future: resolves to the outputs of the inputs
+        """
+        future = Future()
+        self.requests.put((inputs, future), timeout=timeout)
+        return future
+
+    def run(self):
+        """Worker loop, collects and processes the batches."""
+        pending = None
+        while True:
+            batch = [pending or self.requests.get()]
+            pending = None
+            size = len(batch[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if size + len(request[0]) > self.max_batch_size:
+                    pending = request
+                    break
+                batch.append(request)
+                size += len(request[0])
+            try:
+                outputs = self.function(torch.cat([inputs for inputs, _ in batch]))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += size
+            start = 0
+            for inputs, future in batch:
+                future.set_result(outputs[start:start + len(inputs)])
+                start += len(inputs)
+
+
+class EmbeddingService:
+    """
+    Keeps a CLIP backbone and the embeddings of all encoded texts resident. Images of concurrent requests are encoded in micro-batches.
+
+    Attributes:
+        model (torch.nn.Module): The CLIP model.
+        preprocessor (Callable): The CLIP preprocessor.
+        device (str): Device of the model.
+        prompts (list): The country prompts, the model inputs contain the similarities to their embeddings.
+        text_cache (dict): Embedding of every encoded text.
+    """
+
+    def __init__(self, REPO_PATH: str, backbone: str = backbones.DEFAULT_BACKBONE, device: str = None, max_batch_size: int = 64, max_wait: float = 0.005):
+        """
+        Args:
+            REPO_PATH (str): path to the repo folder.
+            backbone (str, optional): The CLIP backbone, see utils/backbones.py. Defaults to backbones.DEFAULT_BACKBONE.
+            device (str, optional): Device of the model, None uses cuda if available. Defaults to None.
+            max_batch_size (int, optional): Maximal number of images per forward pass. Defaults to 64.
+            max_wait (float, optional): Maximal time in seconds to wait for further requests of a batch. Defaults to 0.005.
+        """
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.backbone = backbone
+        self.model, self.preprocessor = backbones.load_backbone(backbone, self.device, os.path.join(REPO_PATH, 'models'))
+        self.model_lock = threading.Lock()
+        self.image_batcher = MicroBatcher(self.encode_image_batch, max_batch_size, max_wait)
+        self.text_cache = {}
+        self.text_lock = threading.Lock()
+        self.prompts = features.country_prompts(REPO_PATH)
+        # warm up: the prompt embeddings of the model inputs are computed once
+        self.prompt_embeddings = self.encode_text(self.prompts)
+
+    def encode_image_batch(self, images: torch.Tensor) -> torch.Tensor:
+        """Embeddings of a batch of preprocessed images, called by the micro-batcher."""
+        with self.model_lock, torch.no_grad():
+            return self.model.encode_image(images.to(self.device)).float().cpu()
+
+    def encode_text(self, texts: list) -> np.ndarray:
+        """Embeddings of texts, only texts that were not encoded before are passed through the model.
+
+        Args:
+            texts (list): The texts.
+
+        Returns:
+            np.ndarray: float32 embeddings of shape (texts, dim)
+        """
+        import clip
+        with self.text_lock:
+            missing = list(dict.fromkeys(text for text in texts if text not in self.text_cache))
+            if missing:
+                with self.model_lock, torch.no_grad():
+                    embeddings = self.model.encode_text(clip.tokenize(missing).to(self.device)).float().cpu().numpy()
+                self.text_cache.update(zip(missing, embeddings))
+            return np.stack([self.text_cache[text] for text in texts])
+
+    def encode_image(self, paths: list = None, images: list = None) -> np.ndarray:
+        """Embeddings of images, given by path or as encoded image files. The images are preprocessed in the calling thread.
+
+        Args:
+            paths (list, optional): Paths of the images. Defaults to None.
+            images (list, optional): Encoded image files (bytes). Defaults to None.
+
+        Returns:
+            np.ndarray: float32 embeddings of shape (images, dim)
+        """
+        sources = paths if paths is not None else [io.BytesIO(image) for image in images]
+        tensors = []
+        for source in sources:
+            with Image.open(source) as image:
+                tensors.append(self.preprocessor(image))
+        if not tensors:
+            return np.zeros((0, self.model.visual.output_dim), dtype=np.float32)
+        return self.image_batcher.submit(torch.stack(tensors)).result().numpy()
+
+    def model_input(self, paths: list = None, images: list = None) -> np.ndarray:
+        """Model inputs of the finetuned models: image embedding and similarities to the country prompts (see utils/features.py).
+
+        Args:
+            paths (list, optional): Paths of the images. Defaults to None.
+            images (list, optional): Encoded image files (bytes). Defaults to None.
+
+        Returns:
+            np.ndarray: float32 model inputs of shape (images, dim + countries)
+        """
+        return features.model_inputs(self.encode_image(paths, images), self.prompt_embeddings)
+
+    def logits(self, texts: list, paths: list = None, images: list = None) -> np.ndarray:
+        """Logits per image over the texts, as returned by the CLIP model.
+
+        Args:
+            texts (list): The texts.
+            paths (list, optional): Paths of the images. Defaults to None.
+            images (list, optional): Encoded image files (bytes). Defaults to None.
+
+        Returns:
+            np.ndarray: float32 logits of shape (images, texts)
+        """
+        image_embeddings = torch.from_numpy(self.encode_image(paths, images))
+        text_embeddings = torch.from_numpy(self.encode_text(texts))
+        image_embeddings = image_embeddings / image_embeddings.norm(dim=1, keepdim=True)
+        text_embeddings = text_embeddings / text_embeddings.norm(dim=1, keepdim=True)
+        with torch.no_grad():
+            logit_scale = self.model.logit_scale.exp().float().cpu()
+        return (logit_scale * image_embeddings @ text_embeddings.t()).numpy()
+
+    def stats(self) -> dict:
+        """Backbone, number of processed batches and images and number of cached texts."""
+        return {
+            'backbone': self.backbone,
+            'device': self.device,
+            'image_batches': self.image_batcher.batches,
+            'images': self.image_batcher.items,
+            'cached_texts': len(self.text_cache),
+        }
+
+
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Serves the EmbeddingService of the server. Every endpoint takes a json body with either "paths" (image paths readable
+    by the server) or "images" (base64 encoded image files) and answers with a numpy array in .npy format:
+    POST /embed/image, POST /embed/text ({"texts": [...]}), POST /model_input, POST /logits ({"texts": [...], "paths": [...]}).
+    GET /health returns the statistics of the service as json.
+    """
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_bytes(json.dumps(self.server.service.stats()).encode(), 'application/json')
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        service = self.server.service
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            paths = request.get('paths')
+            images = [base64.b64decode(image) for image in request['images']] if 'images' in request else None
+            if self.path == '/embed/image':
+                result = service.encode_image(paths, images)
+            elif self.path == '/embed/text':
+                result = service.encode_text(request['texts'])
+            elif self.path == '/model_input':
+                result = service.model_input(paths, images)
+            elif self.path == '/logits':
+                result = service.logits(request['texts'], paths, images)
+            else:
+                self.send_error(404)
+                return
+        except (ValueError, KeyError, OSError) as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, result)
+        self.send_bytes(buffer.getvalue(), 'application/octet-stream')
+
+    def send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_server(service: EmbeddingService, port: int = 0):
+    """Starts the embedding server in a background thread
+
+    Args:
+        service (EmbeddingService): The service to serve.
+        port (int, optional): Port of the server, 0 selects a free port. Defaults to 0.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its url is http://127.0.0.1:{server.server_address[1]}
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), EmbeddingHandler)
+    server.daemon_threads = True
+    server.service = service
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    """Keeps a CLIP backbone loaded and serves image and text embeddings, pass --server_url http://127.0.0.1:{port} to the scripts to use it
+    """
+    parser = argparse.ArgumentParser(description='Embedding server')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--port', metavar='int', type=int, required=False, help='Port of the server', default=8765)
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--device', metavar='str', required=False, help='Device of the model', default=None)
+    parser.add_argument('--max_batch_size', metavar='int', type=int, required=False, help='Maximal number of images per forward pass', default=64)
+    parser.add_argument('--max_wait_ms', metavar='float', type=float, required=False, help='Maximal time to wait for further requests of a batch', default=5.0)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+    service = EmbeddingService(REPO_PATH, args.backbone, args.device, args.max_batch_size, args.max_wait_ms / 1000)
+    server = start_server(service, args.port)
+    print(f"Serving {args.backbone} embeddings at http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
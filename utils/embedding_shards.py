@@ -0,0 +1,181 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import pandas as pd
+
+# Folder of the shards in CLIP_Embeddings, one sub folder {i}-of-{n} per shard
+SHARD_FOLDER = 'Shards'
+
+# Columns computed by the embedding generation, all other columns of the store come from the dataset
+EMBEDDING_COLUMNS = ['Embedding', 'model_input']
+
+
+def parse_shard(shard: str) -> tuple:
+    """Parses a shard given as i/n, e.g. 0/4 is the first of 4 shards.
+
+    Args:
+        shard (str): The shard.
+
+    Raises:
+        ValueError: Malformed shard or i not in 0..n-1.
+
+    Returns:
+        tuple: (i, n)
+    """
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise ValueError(f'Malformed shard {shard}, expected i/n, e.g. 0/4.')
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Shard {shard} does not exist, i has to be in 0..n-1.')
+    return index, count
+
+
+def relative_paths(df: pd.DataFrame, dataset_path: str) -> pd.Series:
+    """Paths of the images relative to the dataset folder, the same on every machine."""
+    return df['path'].map(lambda path: os.path.relpath(path, dataset_path).replace(os.sep, '/'))
+
+
+def select_shard(df: pd.DataFrame, dataset_path: str, index: int, count: int) -> pd.DataFrame:
+    """Rows of a shard: the images are sorted by their relative path, which does not depend on the order of the folder listing
+    or on the machine, and the shards are contiguous ranges of equal size.
+
+    Args:
+        df (pd.DataFrame): The dataset, as returned by load_data.
+        dataset_path (str): Folder of the dataset.
+        index (int): Index of the shard.
+        count (int): Number of shards.
+
+    Returns:
+        pd.DataFrame: the rows of the shard, in the order of df
+    """
+    order = relative_paths(df, dataset_path).sort_values(kind='stable').index
+    return df[df.index.isin(order[index * len(order) // count:(index + 1) * len(order) // count])]
+
+
+def checksum(path: str) -> str:
+    """sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def shard_dir(REPO_PATH: str, index: int, count: int) -> str:
+    """Folder of a shard, CLIP_Embeddings/Shards/{i}-of-{n}"""
+    return os.path.join(REPO_PATH, 'CLIP_Embeddings', SHARD_FOLDER, f'{index}-of-{count}')
+
+
+def write_shard_index(folder: str, index: int, count: int, backbone: str, datasets: dict, prompt_files: list):
+    """Writes shard.json, which records the rows and the checksums of all files of the shard. It is written last,
+    so a shard without shard.json is incomplete.
+
+    Args:
+        folder (str): Folder of the shard.
+        index (int): Index of the shard.
+        count (int): Number of shards.
+        backbone (str): The backbone of the embeddings.
+        datasets (dict): Relative image paths of the rows of every dataset, in the order of the rows of its csv file. Datasets without rows
+            in the shard have no csv file and are left out of the index.
+        prompt_files (list): File names of the prompt embeddings.
+    """
+    shard = {
+        'shard': index,
+        'shards': count,
+        'backbone': backbone,
+        'datasets': {name: {'file': f'{name}_embeddings.csv', 'sha256': checksum(os.path.join(folder, f'{name}_embeddings.csv')), 'rows': rows}
+                     for name, rows in datasets.items() if len(rows) > 0},
+        'prompts': {file: checksum(os.path.join(folder, file)) for file in prompt_files},
+    }
+    with open(os.path.join(folder, 'shard.json.part'), 'w') as handler:
+        json.dump(shard, handler)
+    os.replace(os.path.join(folder, 'shard.json.part'), os.path.join(folder, 'shard.json'))
+
+
+def load_shard_indices(REPO_PATH: str) -> list:
+    """Reads and validates the shard.json of all shards: one complete set of shards of the same backbone, files matching their checksums,
+    the same prompt embeddings in every shard.
+
+    Args:
+        REPO_PATH (str): The path to the repository.
+
+    Raises:
+        ValueError: Missing, incomplete or inconsistent shards.
+
+    Returns:
+        list: the shard indices ordered by shard, with the folder of the shard in 'folder'
+    """
+    shards = []
+    for path in glob.glob(os.path.join(REPO_PATH, 'CLIP_Embeddings', SHARD_FOLDER, '*', 'shard.json')):
+        with open(path) as handler:
+            shards.append(dict(json.load(handler), folder=os.path.dirname(path)))
+    if not shards:
+        raise ValueError(f"No shards in {os.path.join(REPO_PATH, 'CLIP_Embeddings', SHARD_FOLDER)}, run generate_embeddings.py with --shard i/n.")
+    counts = {shard['shards'] for shard in shards}
+    if len(counts) != 1:
+        raise ValueError(f'Shards of different partitions {sorted(counts)}, remove the outdated shard folders.')
+    count = counts.pop()
+    missing = sorted(set(range(count)) - {shard['shard'] for shard in shards})
+    if missing:
+        raise ValueError(f'Shards {missing} of {count} are missing or incomplete.')
+    shards = sorted(shards, key=lambda shard: shard['shard'])
+    for shard in shards:
+        if shard['backbone'] != shards[0]['backbone']:
+            raise ValueError(f"Shard {shard['shard']} was generated with {shard['backbone']}, shard 0 with {shards[0]['backbone']}.")
+        if shard['prompts'] != shards[0]['prompts']:
+            # the model inputs contain the similarities to the prompt embeddings, they have to be the same in all shards
+            raise ValueError(f"The prompt embeddings of shard {shard['shard']} differ from shard 0, generate all shards with the same backbone and precision.")
+        files = [(entry['file'], entry['sha256']) for entry in shard['datasets'].values()] + list(shard['prompts'].items())
+        for file, expected in files:
+            if checksum(os.path.join(shard['folder'], file)) != expected:
+                raise ValueError(f"{os.path.join(shard['folder'], file)} does not match its checksum, generate shard {shard['shard']} again.")
+    return shards
+
+
+def merge_dataset(shards: list, name: str, df: pd.DataFrame, dataset_path: str) -> pd.DataFrame:
+    """Assembles the embeddings of a dataset from the shards, in the order of df. Every image of df has to be in exactly one shard.
+
+    Args:
+        shards (list): Validated shard indices, see load_shard_indices.
+        name (str): Name of the dataset.
+        df (pd.DataFrame): The dataset, as returned by load_data.
+        dataset_path (str): Folder of the dataset.
+
+    Raises:
+        ValueError: Images that are missing, in several shards or not in the dataset.
+
+    Returns:
+        pd.DataFrame: df with the embedding columns
+    """
+    frames = []
+    for shard in shards:
+        # shards without rows of the dataset do not list it
+        if name not in shard['datasets']:
+            continue
+        entry = shard['datasets'][name]
+        # the embeddings are kept as written, so the merged csv files equal those of a single process
+        frame = pd.read_csv(os.path.join(shard['folder'], entry['file']), usecols=EMBEDDING_COLUMNS, dtype=str, keep_default_na=False)
+        if len(frame) != len(entry['rows']):
+            raise ValueError(f"Shard {shard['shard']} has {len(frame)} rows of {name}, but lists {len(entry['rows'])}.")
+        frames.append(frame.set_axis(entry['rows']))
+    embeddings = pd.concat(frames) if frames else pd.DataFrame(columns=EMBEDDING_COLUMNS)
+    duplicates = embeddings.index[embeddings.index.duplicated()].unique().tolist()
+    keys = relative_paths(df, dataset_path)
+    missing = sorted(set(keys) - set(embeddings.index))
+    extra = sorted(set(embeddings.index) - set(keys))
+    if duplicates or missing or extra:
+        raise ValueError(f'The shards do not cover {name}: {len(missing)} images missing (e.g. {missing[:3]}), {len(duplicates)} in several shards '
+                         f'(e.g. {duplicates[:3]}), {len(extra)} not in the dataset (e.g. {extra[:3]}).')
+    merged = df.copy()
+    for column in EMBEDDING_COLUMNS:
+        merged[column] = embeddings.loc[keys, column].to_numpy()
+    return merged
+
+
+def copy_prompts(shards: list, prompt_dir: str):
+    """Copies the prompt embeddings of shard 0, which are the same in all shards, to the prompt folder."""
+    for file in shards[0]['prompts']:
+        shutil.copyfile(os.path.join(shards[0]['folder'], file), os.path.join(prompt_dir, file))
@@ -0,0 +1,143 @@
+import os
+import json
+import queue
+import threading
+import pandas as pd
+
+# Folder next to the csv files that holds the progress and the incomplete files, so readers of the csv folder never see them
+PROGRESS_FOLDER = '.progress'
+
+class EmbeddingWriter:
+    """
+    Append-only csv writer of the embedding generation. Rows are appended in row groups (one per encoded batch), every row group
+    is flushed to disk and recorded in a progress file, so memory does not grow with the dataset and an interrupted run resumes
+    after the last complete row group. Files are written as {PROGRESS_FOLDER}/{file}.part and moved next to the finished files
+    once they are complete.
+
+    Attributes:
+        base_filename (str): Files are named {base_filename}_{i}.csv, or {base_filename}.csv if rows_per_file is None.
+        rows_per_file (int): Rows per csv file, None writes a single file.
+        fingerprint (str): Identifies the rows to write (e.g. image paths and backbone), progress of other rows is discarded.
+        rows (int): Number of written rows, including the rows of the resumed run.
+
+    Usage:
+        writer = EmbeddingWriter(f"{REPO_PATH}/CLIP_Embeddings/Image/geoguessr_embeddings", 2000, fingerprint)
+        for start in range(writer.rows, len(df), batch_size):
+            writer.write(rows_of_batch)
+        writer.close()
+    """
+
+    def __init__(self, base_filename: str, rows_per_file: int = 2000, fingerprint: str = ''):
+        self.base_filename = base_filename
+        self.rows_per_file = rows_per_file
+        self.fingerprint = fingerprint
+        self.progress_dir = os.path.join(os.path.dirname(base_filename), PROGRESS_FOLDER)
+        self.progress_path = os.path.join(self.progress_dir, f'{os.path.basename(base_filename)}.progress.json')
+        self.rows, self.file, self.file_rows, offset = 0, 0, 0, 0
+        if os.path.isfile(self.progress_path):
+            with open(self.progress_path) as handler:
+                progress = json.load(handler)
+            if progress['fingerprint'] == fingerprint and progress['rows_per_file'] == rows_per_file and \
+                    (progress['offset'] == 0 or os.path.isfile(self.part_filename(progress['file']))):
+                self.rows, self.file, self.file_rows, offset = progress['rows'], progress['file'], progress['file_rows'], progress['offset']
+                print(f"Resuming {os.path.basename(base_filename)} after {self.rows} rows")
+        self.handle = None
+        if offset > 0:
+            # drops a row group that was written after the last progress update
+            self.handle = open(self.part_filename(self.file), 'r+b')
+            self.handle.truncate(offset)
+            self.handle.seek(offset)
+
+    def filename(self, index: int) -> str:
+        """Name of the i-th csv file."""
+        return f'{self.base_filename}_{index}.csv' if self.rows_per_file is not None else f'{self.base_filename}.csv'
+
+    def part_filename(self, index: int) -> str:
+        """Name of the i-th csv file while it is written."""
+        return os.path.join(self.progress_dir, os.path.basename(self.filename(index)) + '.part')
+
+    def write(self, rows: pd.DataFrame):
+        """Appends a row group, split over files at rows_per_file rows, and flushes it to disk.
+
+        Args:
+            rows (pd.DataFrame): The rows, in the format of the csv files.
+        """
+        while len(rows) > 0:
+            if self.handle is None:
+                os.makedirs(self.progress_dir, exist_ok=True)
+                self.handle = open(self.part_filename(self.file), 'wb')
+            count = len(rows) if self.rows_per_file is None else min(len(rows), self.rows_per_file - self.file_rows)
+            self.handle.write(rows.iloc[:count].to_csv(header=self.file_rows == 0, index=False).encode())
+            self.file_rows += count
+            self.rows += count
+            rows = rows.iloc[count:]
+            if self.rows_per_file is not None and self.file_rows == self.rows_per_file:
+                self.finish_file()
+        if self.handle is not None:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+        self.save_progress()
+
+    def finish_file(self):
+        """Closes the current file and renames it to its final name."""
+        self.handle.close()
+        self.handle = None
+        os.replace(self.part_filename(self.file), self.filename(self.file))
+        self.file += 1
+        self.file_rows = 0
+
+    def save_progress(self):
+        progress = {'fingerprint': self.fingerprint, 'rows_per_file': self.rows_per_file, 'rows': self.rows, 'file': self.file,
+                    'file_rows': self.file_rows, 'offset': self.handle.tell() if self.handle is not None else 0}
+        os.makedirs(self.progress_dir, exist_ok=True)
+        with open(self.progress_path + '.part', 'w') as handler:
+            json.dump(progress, handler)
+        os.replace(self.progress_path + '.part', self.progress_path)
+
+    def close(self):
+        """Completes the last file and removes the progress file, and the progress folder once no other writer uses it."""
+        if self.handle is not None:
+            self.finish_file()
+        if os.path.isfile(self.progress_path):
+            os.remove(self.progress_path)
+        try:
+            os.rmdir(self.progress_dir)
+        except OSError:
+            pass
+
+
+def run_pipeline(batches, consume, queue_size: int = 4):
+    """Passes the batches of a producer (iterated in the calling thread) to a consumer thread through a bounded queue,
+    so at most queue_size batches are held between the two. An exception of the consumer stops the producer and is raised.
+
+    Args:
+        batches (Iterable): The batches, e.g. encoded images.
+        consume (Callable): Called with every batch in order, e.g. builds the features and writes them.
+        queue_size (int, optional): Maximal number of waiting batches. Defaults to 4.
+    """
+    pending = queue.Queue(queue_size)
+    errors = []
+
+    def worker():
+        while True:
+            batch = pending.get()
+            if batch is None:
+                return
+            if not errors:
+                try:
+                    consume(batch)
+                except Exception as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            pending.put(batch)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
@@ -0,0 +1,35 @@
+import numpy as np
+import pandas as pd
+
+# Prompt of the prompt embeddings, that the image embeddings are compared to in the model inputs
+COUNTRY_PROMPT = "This image shows the country {}"
+
+
+def country_prompts(REPO_PATH: str) -> list:
+    """The prompts of all countries, in the order of the country list.
+
+    Args:
+        REPO_PATH (str): path to the repo folder.
+
+    Returns:
+        list: one prompt per country
+    """
+    country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')["Country"].to_list()
+    return [COUNTRY_PROMPT.format(country) for country in country_list]
+
+
+def model_inputs(image_embeddings: np.ndarray, prompt_embeddings: np.ndarray) -> np.ndarray:
+    """Batch version of calculate_distances in CLIP_Embeddings/generate_embeddings.py: every image embedding is
+    extended by its cosine similarities to all prompt embeddings, computed in float64 and returned as float32.
+
+    Args:
+        image_embeddings (np.ndarray): Image embeddings of shape (images, dim).
+        prompt_embeddings (np.ndarray): Prompt embeddings of shape (prompts, dim).
+
+    Returns:
+        np.ndarray: float32 model inputs of shape (images, dim + prompts)
+    """
+    from sklearn.metrics.pairwise import cosine_similarity
+    image_embeddings = np.asarray(image_embeddings, dtype=np.float64)
+    similarities = cosine_similarity(image_embeddings, np.asarray(prompt_embeddings, dtype=np.float64))
+    return np.concatenate((image_embeddings, similarities), axis=1).astype(np.float32)
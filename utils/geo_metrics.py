@@ -1,13 +1,19 @@
-from typing import List
+from typing import List, TYPE_CHECKING
 import pandas as pd
 import numpy as np
-import torch
 import os
-from sklearn import metrics
 import ast
 import sys
 sys.path.append('.')
 
+if TYPE_CHECKING:
+    import torch
+
+def accuracy_score(y_true: list, y_pred: list) -> float:
+    """sklearn.metrics.accuracy_score, sklearn is only imported when a metric is calculated."""
+    from sklearn import metrics
+    return metrics.accuracy_score(y_true, y_pred)
+
 def calculate_experiment_country_accuracy(batch_df: pd.DataFrame) -> float:
     """
     Calculate accuracy score based on country labels.
@@ -18,9 +24,9 @@ def calculate_experiment_country_accuracy(batch_df: pd.DataFrame) -> float:
     Returns:
         float: Accuracy score based on country labels.
     """
-    return metrics.accuracy_score(batch_df["label"].tolist(), batch_df["Predicted labels"].tolist())
+    return accuracy_score(batch_df["label"].tolist(), batch_df["Predicted labels"].tolist())
 
-def calculate_country_accuracy(country_list: pd.DataFrame, predictions: torch.Tensor, labels: torch.Tensor ) -> float:
+def calculate_country_accuracy(country_list: pd.DataFrame, predictions: 'torch.Tensor', labels: 'torch.Tensor' ) -> float:
     """
     Calculate accuracy score based on country labels.
 
@@ -32,9 +38,10 @@ def calculate_country_accuracy(country_list: pd.DataFrame, predictions: torch.Te
     Returns:
         float: Accuracy score based on country labels.
     """
+    import torch
     index_predictions = torch.argmax(predictions, dim=1)
     predictions = country_list['Country'].iloc[index_predictions].tolist()
-    return metrics.accuracy_score(labels, predictions)
+    return accuracy_score(labels, predictions)
 
 def calculate_experiment_region_accuracy(country_list: pd.DataFrame, batch_df: pd.DataFrame) -> float:
     """
@@ -54,9 +61,9 @@ def calculate_experiment_region_accuracy(country_list: pd.DataFrame, batch_df: p
     merged_df = pd.merge(merged_df, country_list, left_on='label', right_on='Country', how='inner')
     merged_df = merged_df.rename(columns={'Intermediate Region Name': 'reference_region'})
     del merged_df['Country']
-    return metrics.accuracy_score(merged_df["reference_region"].tolist(), merged_df["predicted_region"].tolist())
+    return accuracy_score(merged_df["reference_region"].tolist(), merged_df["predicted_region"].tolist())
 
-def calculate_region_accuracy(country_list: pd.DataFrame, predictions: torch.Tensor, labels: torch.Tensor) -> float:
+def calculate_region_accuracy(country_list: pd.DataFrame, predictions: 'torch.Tensor', labels: 'torch.Tensor') -> float:
     """
     Calculate accuracy score based on region labels.
 
@@ -68,11 +75,12 @@ def calculate_region_accuracy(country_list: pd.DataFrame, predictions: torch.Ten
     Returns:
         float: Accuracy score based on region labels.
     """
+    import torch
     index_predictions = [torch.argmax(prediciton) for prediciton in predictions]
     region_prediciotn = [country_list['Intermediate Region Name'].iloc[index.item()] for index in index_predictions]
     region_label = [country_list['Intermediate Region Name'].loc[country_list['Country'] ==index] for index in labels]
 
-    return np.mean(metrics.accuracy_score(region_label, region_prediciotn))
+    return np.mean(accuracy_score(region_label, region_prediciotn))
 
 
 def calculate_metric(repo_path: str, batch_df: pd.DataFrame, metric_name: str) -> float:
@@ -102,23 +110,29 @@ def calculate_metric(repo_path: str, batch_df: pd.DataFrame, metric_name: str) -
     
 def calculate_experiment_metric(repo_path: str, exp_dir:str, metric_name: str) -> list:
     """
-    Calculate metric for each experiment directory.
+    Calculate metric for each evaluation group of an experiment directory. Results with a group column (see ModelTester in
+    CLIP_Experiment/run_datasets_and_prompts.py) are grouped by it, ordered by group; otherwise every batch file is one group.
 
     Args:
         repo_path (str): Path to repository.
-        exp_dirs (List[str]): List of experiment directories.
-        exp_names (List[str]): List of experiment names.
+        exp_dir (str): The experiment directory with the batch files.
         metric_name (str): Name of the metric to be calculated ('country_acc', 'region_acc' or 'mixed').
 
+    Raises:
+        ValueError: If only some batch files have a group column, e.g. results of several runs in the same directory.
+
     Returns:
-        dict: Dictionary with experiment names as keys and corresponding metric values as lists.
+        np.ndarray: The metric of every group.
     """
-    exp_metric = []
-    for batch_file in os.listdir(exp_dir):
-        if not os.path.isdir(os.path.join(exp_dir, batch_file)):
-            batch_df = pd.read_csv(os.path.join(exp_dir, batch_file))
-            exp_metric.append(calculate_metric(repo_path, batch_df, metric_name))
-    return np.array(exp_metric)
+    batch_dfs = [pd.read_csv(os.path.join(exp_dir, batch_file)) for batch_file in os.listdir(exp_dir)
+                 if not os.path.isdir(os.path.join(exp_dir, batch_file))]
+    grouped = ['group' in batch_df.columns for batch_df in batch_dfs]
+    if any(grouped) and not all(grouped):
+        raise ValueError(f"{exp_dir} mixes results with and without evaluation groups, remove the results of older runs.")
+    if batch_dfs and all(grouped):
+        results = pd.concat(batch_dfs, ignore_index=True)
+        batch_dfs = [group_df.reset_index(drop=True) for _, group_df in results.groupby('group', sort=True)]
+    return np.array([calculate_metric(repo_path, batch_df, metric_name) for batch_df in batch_dfs])
 
 def calculate_mixed_metric(repo_path: str, batch_df:object):
     country_list = pd.read_csv(f'{repo_path}/utils/country_list/country_list_region_and_continent.csv')
@@ -0,0 +1,189 @@
+import sys
+sys.path.append('.')
+import os
+import math
+import argparse
+import yaml
+import numpy as np
+import torch
+import PIL
+from PIL import Image
+from torch.utils.data import DataLoader
+
+# Normalization of the CLIP preprocessor (clip.clip._transform)
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+class FastPreprocessor:
+    """
+    Fast replacement of the CLIP preprocessor (Resize(n_px, BICUBIC), CenterCrop(n_px), RGB, ToTensor, Normalize).
+    JPEG images are decoded in draft mode, i.e. scaled by 1/2, 1/4 or 1/8 while decoding, as long as the shorter
+    side stays at least n_px. The resize and crop return a uint8 tensor per image, the conversion to float and the
+    normalization are done for the whole batch in collate.
+
+    Attributes:
+        n_px (int): Size of the square output images.
+        mean (torch.Tensor): Mean of the normalization, shape (3, 1, 1).
+        std (torch.Tensor): Standard deviation of the normalization, shape (3, 1, 1).
+        draft (bool): Whether JPEGs are decoded in draft mode.
+
+    Usage:
+        fast_preprocessor = FastPreprocessor.from_clip(preprocessor)
+        DataLoader(ImageDataset_from_df(df, fast_preprocessor), batch_size=32, collate_fn=fast_preprocessor.collate)
+    """
+
+    def __init__(self, n_px: int = 224, mean: tuple = CLIP_MEAN, std: tuple = CLIP_STD, draft: bool = True):
+        """
+        Args:
+            n_px (int, optional): Size of the square output images. Defaults to 224.
+            mean (tuple, optional): Mean of the normalization. Defaults to CLIP_MEAN.
+            std (tuple, optional): Standard deviation of the normalization. Defaults to CLIP_STD.
+            draft (bool, optional): Decode JPEGs in draft mode, without it the output equals the CLIP preprocessor. Defaults to True.
+        """
+        self.n_px = n_px
+        self.draft = draft
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+
+    @classmethod
+    def from_clip(cls, preprocessor, draft: bool = True):
+        """Creates a FastPreprocessor with the output size and normalization of a CLIP preprocessor.
+
+        Args:
+            preprocessor (torchvision.transforms.Compose): The preprocessor returned by clip.load.
+            draft (bool, optional): Decode JPEGs in draft mode. Defaults to True.
+
+        Returns:
+            FastPreprocessor: the fast preprocessor
+        """
+        n_px, mean, std = 224, CLIP_MEAN, CLIP_STD
+        for transform in getattr(preprocessor, 'transforms', []):
+            if type(transform).__name__ == 'CenterCrop':
+                n_px = transform.size[0] if isinstance(transform.size, (tuple, list)) else transform.size
+            elif type(transform).__name__ == 'Normalize':
+                mean, std = tuple(transform.mean), tuple(transform.std)
+        return cls(n_px, mean, std, draft)
+
+    def config(self) -> dict:
+        """The parameters that determine the output of the preprocessor, e.g. as key of a cache.
+
+        Returns:
+            dict: output size, normalization, decode mode and the order of resize and conversion to RGB
+        """
+        return {'n_px': self.n_px, 'mean': self.mean.flatten().tolist(), 'std': self.std.flatten().tolist(), 'draft': self.draft,
+                'convert': 'after_crop'}
+
+    def __call__(self, image: PIL.Image.Image) -> torch.Tensor:
+        """Decodes, resizes and crops an opened (not yet loaded) image.
+
+        Args:
+            image (PIL.Image.Image): The opened image.
+
+        Returns:
+            torch.Tensor: uint8 tensor of shape (3, n_px, n_px)
+        """
+        width, height = image.size
+        scale = self.n_px / min(width, height)
+        if self.draft:
+            image.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+
+        # same output size and crop as torchvision Resize and CenterCrop, in the mode of the image like CLIP
+        # (e.g. palette images are resized with NEAREST by PIL), the conversion to RGB follows the crop
+        width, height = image.size
+        if width <= height:
+            size = (self.n_px, int(self.n_px * height / width))
+        else:
+            size = (int(self.n_px * width / height), self.n_px)
+        image = image.resize(size, Image.BICUBIC)
+        left = int(round((size[0] - self.n_px) / 2.0))
+        top = int(round((size[1] - self.n_px) / 2.0))
+        image = image.crop((left, top, left + self.n_px, top + self.n_px)).convert('RGB')
+        return torch.from_numpy(np.array(image, dtype=np.uint8)).permute(2, 0, 1)
+
+    def normalize(self, images: torch.Tensor) -> torch.Tensor:
+        """Converts a batch of uint8 images to normalized float tensors.
+
+        Args:
+            images (torch.Tensor): uint8 tensor of shape (batch, 3, n_px, n_px)
+
+        Returns:
+            torch.Tensor: float32 tensor of shape (batch, 3, n_px, n_px)
+        """
+        mean, std = self.mean.to(images.device), self.std.to(images.device)
+        return images.to(torch.float32).div_(255).sub_(mean).div_(std)
+
+    def collate(self, batch: list):
+        """collate_fn of a DataLoader over an ImageDataset_from_df with this preprocessor
+
+        Args:
+            batch (list): (image, caption) pairs
+
+        Returns:
+            tuple: normalized images and list of captions
+        """
+        images, captions = zip(*batch)
+        return self.normalize(torch.stack(images)), list(captions)
+
+
+def check_fast_decode(model, preprocessor, paths: list, device: str = 'cpu', batch_size: int = 32, tolerance: float = 0.99) -> dict:
+    """Compares the image embeddings of the fast decode path with the embeddings of the CLIP preprocessor.
+
+    Args:
+        model (torch.nn.Module): The CLIP model.
+        preprocessor (torchvision.transforms.Compose): The preprocessor returned by clip.load.
+        paths (list): Paths of the compared images.
+        device (str, optional): Device of the model. Defaults to 'cpu'.
+        batch_size (int, optional): Batch size. Defaults to 32.
+        tolerance (float, optional): Minimal accepted cosine similarity of the embeddings. Defaults to 0.99.
+
+    Returns:
+        dict: minimal and mean cosine similarity, maximal absolute difference and whether all images are within the tolerance
+    """
+    from utils.load_dataset import ImageDataset_from_df
+    import pandas as pd
+    df = pd.DataFrame({'label': [''] * len(paths), 'path': paths})
+    fast_dataset = ImageDataset_from_df(df, preprocessor, fast_decode=True)
+    loaders = [DataLoader(ImageDataset_from_df(df, preprocessor), batch_size=batch_size),
+               DataLoader(fast_dataset, batch_size=batch_size, collate_fn=fast_dataset.collate_fn)]
+    similarities = []
+    max_difference = 0.0
+    with torch.no_grad():
+        for (images, _), (fast_images, _) in zip(*loaders):
+            embeddings = model.encode_image(images.to(device)).float()
+            fast_embeddings = model.encode_image(fast_images.to(device)).float()
+            similarities.append(torch.nn.functional.cosine_similarity(embeddings, fast_embeddings, dim=1).cpu())
+            max_difference = max(max_difference, (embeddings - fast_embeddings).abs().max().item())
+    similarities = torch.cat(similarities)
+    return {
+        'images': len(similarities),
+        'min_cosine_similarity': similarities.min().item(),
+        'mean_cosine_similarity': similarities.mean().item(),
+        'max_abs_difference': max_difference,
+        'within_tolerance': bool((similarities >= tolerance).all()),
+    }
+
+
+if __name__ == "__main__":
+    """Checks that the fast decode path keeps the image embeddings within tolerance of the CLIP preprocessor
+    """
+    from utils import load_dataset, backbones
+    parser = argparse.ArgumentParser(description='Check fast decode')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--dataset', metavar='str', required=False, help='The dataset to check', default='geoguessr')
+    parser.add_argument('--num_images', metavar='int', type=int, required=False, help='Number of checked images', default=200)
+    parser.add_argument('--tolerance', metavar='float', type=float, required=False, help='Minimal accepted cosine similarity', default=0.99)
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone, see utils/backbones.py', default='ViT-B/32')
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        DATA_PATH = paths['data_path']
+        REPO_PATH = paths['repo_path']
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocessor = backbones.load_backbone(args.backbone, device, os.path.join(REPO_PATH, 'models'))
+    df = load_dataset.load_data(f'{DATA_PATH}/{args.dataset}').head(args.num_images)
+    result = check_fast_decode(model, preprocessor, df['path'].tolist(), device, tolerance=args.tolerance)
+    print(result)
+    if not result['within_tolerance']:
+        sys.exit(1)
@@ -0,0 +1,94 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+import yaml
+
+# Import time budget in seconds and the heavy packages that must not be imported, per module.
+# The heavy packages (torch, clip, sklearn, scipy, seaborn, matplotlib, tensorflow) are imported inside the functions that use them.
+HEAVY = ['torch', 'clip', 'sklearn', 'seaborn', 'matplotlib', 'tensorflow']
+BUDGETS = {
+    'utils.load_dataset': (1.0, HEAVY),
+    'utils.geo_metrics': (1.0, HEAVY),
+    'utils.confusion_matrix': (1.0, HEAVY),
+    'utils.analyzation_tools': (2.5, HEAVY),
+    'finetuning.create_datasets_from_embddings': (1.0, HEAVY),
+    'CLIP_Experiment.evaluate_results_with_metrics': (1.0, HEAVY),
+    'CLIP_Experiment.generate_confusion_matrices': (1.0, HEAVY),
+    'CLIP_Experiment.run_statistical_tests': (2.5, HEAVY),
+    'data_collection.normalize_images': (1.0, HEAVY),
+}
+
+IMPORT_TIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure_import(module: str, repo_path: str) -> tuple:
+    """Imports a module in a fresh interpreter with python -X importtime.
+
+    Args:
+        module (str): Name of the module, relative to the repo.
+        repo_path (str): Path to the repo folder.
+
+    Returns:
+        tuple: total import time in seconds and the set of imported top level packages
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=repo_path, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Unable to import {module}:\n{result.stderr.splitlines()[-1]}')
+    total = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match is None:
+            continue
+        cumulative, indent, name = int(match.group(2)), match.group(3), match.group(4)
+        packages.add(name.split('.')[0])
+        # the cumulative time of the outermost imports contains all nested imports
+        if len(indent) == 1:
+            total += cumulative
+    return total / 1e6, packages
+
+
+def run_benchmark(repo_path: str, modules: list = None, repeat: int = 3) -> bool:
+    """Measures the import time of the modules and checks them against their budgets.
+    The fastest of repeat imports is used, as the first import also fills the file system cache.
+
+    Args:
+        repo_path (str): Path to the repo folder.
+        modules (list, optional): Modules to check, None checks all modules in BUDGETS. Defaults to None.
+        repeat (int, optional): Number of imports per module. Defaults to 3.
+
+    Returns:
+        bool: whether all modules are within their budgets
+    """
+    within_budget = True
+    for module in modules or BUDGETS:
+        budget, forbidden = BUDGETS.get(module, (1.0, HEAVY))
+        seconds, packages = min(measure_import(module, repo_path) for _ in range(repeat))
+        heavy = sorted(packages.intersection(forbidden))
+        status = 'ok'
+        if seconds > budget:
+            status = 'over budget'
+        if heavy:
+            status = f'imports {", ".join(heavy)}'
+        within_budget = within_budget and status == 'ok'
+        print(f'{module:<50} {seconds:6.2f}s / {budget:.1f}s  {status}')
+    return within_budget
+
+
+if __name__ == "__main__":
+    """Checks that the modules stay fast to import, fails if a module is over its budget or imports a heavy package
+    """
+    parser = argparse.ArgumentParser(description='Import time benchmark')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--modules', metavar='str', nargs='+', required=False, help='The modules to check', default=None)
+    parser.add_argument('--repeat', metavar='int', type=int, required=False, help='Number of imports per module', default=3)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+    if not run_benchmark(os.path.abspath(REPO_PATH), args.modules, args.repeat):
+        sys.exit(1)
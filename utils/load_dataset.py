@@ -1,14 +1,13 @@
 import os
-import PIL
-import torch
-import clip
+import json
+import PIL.Image
 import pandas as pd
-import ast
-from torch.utils.data import Dataset
 import random
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np
 
+# Name of the manifest of a normalized dataset, written by data_collection/normalize_images.py
+MANIFEST_NAME = 'manifest.csv'
+
 def filter_min_img_df(df: pd.DataFrame, min_img: int):
     """Filters classes by minimum amount of images
 
@@ -27,6 +26,7 @@ def filter_min_img_df(df: pd.DataFrame, min_img: int):
 
 def load_data(DATA_PATH: str, min_img: int = 0, max_img: int = None, size_constraints: bool = False, debug_data: bool = False, random_seed: int = 1234):
     """Loads data in a dataframe form a given folder, with basic filtering.
+    A normalized dataset is loaded from its manifest.csv without opening the images.
 
     Args:
         DATA_PATH (str): Path to folder containing folders of images.
@@ -40,6 +40,56 @@ def load_data(DATA_PATH: str, min_img: int = 0, max_img: int = None, size_constr
     """
     random.seed(random_seed)
 
+    manifest_path = os.path.join(DATA_PATH, MANIFEST_NAME)
+    if os.path.isfile(manifest_path):
+        df = load_manifest(manifest_path, min_img, max_img)
+    else:
+        df = load_image_folders(DATA_PATH, min_img, max_img)
+    if size_constraints:
+        # normalized datasets keep the size of the original image in source_width
+        df = df.loc[df['source_width' if 'source_width' in df.columns else 'width'] == 1536]
+    if min_img > 0:
+        df = filter_min_img_df(df, min_img)
+    if debug_data:
+        df = df.sample(10)
+    df = df.sample(frac=1,random_state=random_seed).reset_index(drop=True)
+    return df
+
+
+def load_manifest(manifest_path: str, min_img: int = 0, max_img: int = None):
+    """Loads the manifest of a normalized dataset (see data_collection/normalize_images.py) instead of opening every image.
+
+    Args:
+        manifest_path (str): Path to the manifest.csv.
+        min_img (int, optional): Minimal number of images accepted into the dataset. Defaults to 0.
+        max_img (int, optional): Maximal number of images accepted into the dataset. Defaults to None.
+
+    Returns:
+        pd.DataFrame: DataFrame containg label, img widht/hight, format, path to img and the source of the img.
+    """
+    manifest = pd.read_csv(manifest_path)
+    manifest['path'] = [os.path.join(os.path.dirname(manifest_path), label, os.path.basename(path)) for label, path in zip(manifest['label'], manifest['path'])]
+    frames = []
+    for label, files in manifest.groupby('label', sort=False):
+        if len(files) < min_img:
+            continue
+        if (max_img is not None) and (len(files) > max_img):
+            files = files.loc[random.sample(list(files.index), max_img)]
+        frames.append(files)
+    return pd.concat(frames) if frames else manifest.iloc[:0]
+
+
+def load_image_folders(DATA_PATH: str, min_img: int = 0, max_img: int = None):
+    """Opens every image in the folders of a dataset to read its size and format.
+
+    Args:
+        DATA_PATH (str): Path to folder containing folders of images.
+        min_img (int, optional): Minimal number of images accepted into the dataset. Defaults to 0.
+        max_img (int, optional): Maximal number of images accepted into the dataset. Defaults to None.
+
+    Returns:
+        pd.DataFrame: DataFrame containg basic infromation on label, img widht/hight, format, path to img.
+    """
     list_rows = []
     for folder in os.listdir(DATA_PATH):
         files = os.listdir(os.path.join(DATA_PATH, folder))
@@ -60,50 +110,285 @@ def load_data(DATA_PATH: str, min_img: int = 0, max_img: int = None, size_constr
                     'path': os.path.join(DATA_PATH, folder, file)
                 }
                 list_rows.append(temp_dict)
-    df = pd.DataFrame(list_rows)
-    if size_constraints:
-        df = df.loc[df['width'] == 1536]
-    if min_img > 0:
-        df = filter_min_img_df(df, min_img)
-    if debug_data:
-        df = df.sample(10)
-    df = df.sample(frac=1,random_state=random_seed).reset_index(drop=True)
-    return df
+    return pd.DataFrame(list_rows)
+
+
+# Parsed embedding stores of the split manifests, so that all splits of a process parse the store only once
+_embedding_stores = {}
+
+
+def save_split_manifest(path: str, store_files: list, positions, columns: list, **metadata):
+    """Saves a dataset split as rows of the embedding store instead of a copy of the embeddings.
+
+    Args:
+        path (str): Path of the manifest (.json).
+        store_files (list): Entries of every embedding csv of the store in store order, see store_file_entry.
+        positions (np.ndarray): Positions of the rows of the split in the concatenated store.
+        columns (list): Columns of the split.
+        **metadata: Further information on the split, e.g. split, seed and the parameters of the dataset creation.
+    """
+    manifest = dict(metadata, store=store_files, columns=list(columns), rows=[int(position) for position in positions])
+    with open(path + '.part', 'w') as handler:
+        json.dump(manifest, handler)
+    os.replace(path + '.part', path)
+
+
+def store_file_entry(REPO_PATH: str, path: str, rows: int) -> dict:
+    """Entry of an embedding csv in the store of a split manifest: its path (relative to the repository), number of rows,
+    size in bytes and sha256, so that a manifest or an encoded store refuses embedding csv files whose content changed.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        path (str): Path of the embedding csv, relative to the repository.
+        rows (int): Number of rows of the embedding csv.
+
+    Returns:
+        dict: the entry
+    """
+    from utils.embedding_shards import checksum
+    full_path = os.path.join(REPO_PATH, path)
+    return {"path": path, "rows": int(rows), "size": os.path.getsize(full_path), "sha256": checksum(full_path)}
+
+
+def check_store_file(REPO_PATH: str, store_file: dict):
+    """Checks that an embedding csv is unchanged since its entry (see store_file_entry) was recorded.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_file (dict): Entry of the store of a split manifest.
+
+    Raises:
+        ValueError: If the embedding csv changed, or the entry has no checksum.
+    """
+    from utils.embedding_shards import checksum
+    path = os.path.join(REPO_PATH, store_file['path'])
+    if 'sha256' not in store_file:
+        raise ValueError(f"The split manifest has no checksum of {path}, it was created by an older version, create the datasets again.")
+    if os.path.getsize(path) != store_file['size'] or checksum(path) != store_file['sha256']:
+        raise ValueError(f"The embedding store {path} changed since the split manifest was created, create the datasets again.")
+
+
+def load_embedding_store(REPO_PATH: str, store_files: list) -> pd.DataFrame:
+    """Loads the concatenated embedding csv files of a store, each store is parsed only once per process.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_files (list): Entries of the store of a split manifest.
+
+    Raises:
+        ValueError: If an embedding csv changed since the manifest was created.
+
+    Returns:
+        pd.DataFrame: The store.
+    """
+    key = (REPO_PATH, json.dumps(store_files, sort_keys=True))
+    if key not in _embedding_stores:
+        frames = []
+        for store_file in store_files:
+            path = os.path.join(REPO_PATH, store_file['path'])
+            check_store_file(REPO_PATH, store_file)
+            frames.append(pd.read_csv(path))
+            if len(frames[-1]) != store_file['rows']:
+                raise ValueError(f"The embedding store {path} changed since the split manifest was created, create the datasets again.")
+        _embedding_stores[key] = pd.concat(frames, ignore_index=True)
+    return _embedding_stores[key]
+
+
+# Folder of the image embedding store: the image embeddings of the embedding store without the prompt similarities
+IMAGE_EMBEDDING_FOLDER = 'CLIP_Embeddings/Features'
+
+# Prompt embeddings the model inputs of the embedding store were built with, saved by CLIP_Embeddings/generate_embeddings.py
+DEFAULT_PROMPT_EMBEDDINGS = 'CLIP_Embeddings/Prompt/prompt_image_shows_embedding.pt'
+
+# Image embedding stores of this process, by folder
+_image_embedding_stores = {}
+
+
+def save_image_embeddings(REPO_PATH: str, store_paths: list = None) -> list:
+    """Saves the image embeddings of the embedding store separately from the prompt similarities into CLIP_Embeddings/Features:
+    image_embeddings.npy (float32, one row per store row, the image part of the model inputs), rows.csv (all other columns of
+    the store except Embedding and model_input) and store.json (the store files, as listed in the split manifests).
+    assemble_model_inputs builds the model inputs of any prompt embeddings from them without encoding the images again.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_paths (list, optional): Embedding csv files of the store, relative to the repository. Defaults to embedding_codecs.STORE_PATHS.
+
+    Returns:
+        list: the store files
+    """
+    from utils import embedding_codecs
+    store, store_files, model_inputs = embedding_codecs.read_store(REPO_PATH, store_paths or embedding_codecs.STORE_PATHS)
+    # the model inputs end with one similarity per country
+    countries = len(pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv'))
+    folder = os.path.join(REPO_PATH, IMAGE_EMBEDDING_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    # store.json is written last, an interrupted run is not used
+    if os.path.isfile(os.path.join(folder, 'store.json')):
+        os.remove(os.path.join(folder, 'store.json'))
+    np.save(os.path.join(folder, 'image_embeddings.npy'), np.ascontiguousarray(model_inputs[:, :-countries]))
+    store.drop(columns=embedding_codecs.ENCODED_COLUMNS).to_csv(os.path.join(folder, 'rows.csv'), index=False)
+    with open(os.path.join(folder, 'store.json'), 'w') as handler:
+        json.dump({'store': store_files, 'dim': model_inputs.shape[1] - countries}, handler)
+    return store_files
+
+
+def load_image_embedding_store(REPO_PATH: str, store_files: list) -> tuple:
+    """Loads the image embedding store (see save_image_embeddings), once per process. The embeddings are memory-mapped.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_files (list): Entries of the store of a split manifest.
+
+    Raises:
+        ValueError: If there is no image embedding store or it was saved from other store files.
+
+    Returns:
+        tuple: rows (pd.DataFrame) and image embeddings (np.memmap)
+    """
+    folder = os.path.join(REPO_PATH, IMAGE_EMBEDDING_FOLDER)
+    if folder not in _image_embedding_stores:
+        if not os.path.isfile(os.path.join(folder, 'store.json')):
+            raise ValueError(f'No image embedding store in {folder}, run python CLIP_Embeddings/generate_embeddings.py --image_embeddings_only.')
+        with open(os.path.join(folder, 'store.json')) as handler:
+            saved = json.load(handler)
+        _image_embedding_stores[folder] = (saved['store'], pd.read_csv(os.path.join(folder, 'rows.csv')),
+                                           np.load(os.path.join(folder, 'image_embeddings.npy'), mmap_mode='r'))
+    saved_files, rows, embeddings = _image_embedding_stores[folder]
+    if json.dumps(saved_files, sort_keys=True) != json.dumps(store_files, sort_keys=True):
+        raise ValueError(f'The image embedding store in {folder} was saved from other embedding files, run python CLIP_Embeddings/generate_embeddings.py --image_embeddings_only again.')
+    return rows, embeddings
+
+
+def load_prompt_embeddings(REPO_PATH: str, prompts=None) -> np.ndarray:
+    """Loads prompt embeddings, one per country in the order of the country list.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        prompts (str | np.ndarray | torch.Tensor, optional): The prompt embeddings, or the path (absolute or relative to the repository) of a
+            tensor saved with torch.save or an array saved with np.save. Defaults to None, the prompt embeddings of the embedding store.
+
+    Returns:
+        np.ndarray: float32 prompt embeddings of shape (countries, dim)
+    """
+    if prompts is None:
+        prompts = DEFAULT_PROMPT_EMBEDDINGS
+    if isinstance(prompts, str):
+        path = os.path.join(REPO_PATH, prompts)
+        if path.endswith('.npy'):
+            prompts = np.load(path)
+        else:
+            import torch
+            prompts = torch.load(path, map_location='cpu')
+    if hasattr(prompts, 'detach'):
+        prompts = prompts.detach().float().cpu().numpy()
+    return np.asarray(prompts, dtype=np.float32)
+
+
+def assemble_model_inputs(REPO_PATH: str, store_files: list, positions, prompts=None, batch_size: int = 8192) -> np.ndarray:
+    """Builds the model inputs of rows of the store from the image embedding store: the image embeddings extended by their cosine
+    similarities to the prompt embeddings (see utils/features.model_inputs), so other prompts only cost a matrix product instead of
+    encoding every image. With the default prompt embeddings the model inputs equal those of the csv store.
+
+    Args:
+        REPO_PATH (str): Path to the repository.
+        store_files (list): Entries of the store of a split manifest.
+        positions (list): Positions of the rows in the store.
+        prompts (str | np.ndarray | torch.Tensor, optional): The prompt embeddings, see load_prompt_embeddings. Defaults to None.
+        batch_size (int, optional): Number of rows assembled at once. Defaults to 8192.
+
+    Raises:
+        ValueError: If the prompt embeddings do not match the dimension of the image embeddings.
+
+    Returns:
+        np.ndarray: float32 model inputs of shape (rows, dim + countries)
+    """
+    from utils import features
+    embeddings = load_image_embedding_store(REPO_PATH, store_files)[1]
+    prompt_embeddings = load_prompt_embeddings(REPO_PATH, prompts)
+    if prompt_embeddings.ndim != 2 or prompt_embeddings.shape[1] != embeddings.shape[1]:
+        raise ValueError(f'Prompt embeddings of shape {prompt_embeddings.shape} do not match the image embeddings of dimension {embeddings.shape[1]}, use prompt embeddings of the same backbone.')
+    positions = np.asarray(positions, dtype=np.int64)
+    model_inputs = np.empty((len(positions), embeddings.shape[1] + len(prompt_embeddings)), dtype=np.float32)
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        # reading the memory-mapped embeddings in store order touches every page once
+        order = np.argsort(batch, kind='stable')
+        model_inputs[start + order] = features.model_inputs(embeddings[batch[order]], prompt_embeddings)
+    return model_inputs
+
+
+def load_split_manifest(path: str, REPO_PATH: str, codec: str = None, prompts=None) -> pd.DataFrame:
+    """Resolves a split manifest (see save_split_manifest) to the rows of the embedding store.
+
+    Args:
+        path (str): Path of the manifest (.json).
+        REPO_PATH (str): Path to the repository.
+        codec (str, optional): Read the rows from the store encoded with this codec (see utils/embedding_codecs.py) instead of the csv store.
+            The model inputs are decoded into float32 arrays and the Embedding column is left out. Defaults to None.
+        prompts (str | np.ndarray | torch.Tensor, optional): Assemble the model inputs from the image embedding store with these prompt embeddings
+            (see assemble_model_inputs) instead of reading them from the csv store. The model inputs are float32 arrays and the Embedding
+            column is left out. Defaults to None.
+
+    Raises:
+        ValueError: If both a codec and prompts are given.
+
+    Returns:
+        pd.DataFrame: The split, equal to the formerly saved csv copy.
+    """
+    with open(path) as handler:
+        manifest = json.load(handler)
+    if codec is not None and prompts is not None:
+        raise ValueError('The model inputs are either decoded from an encoded store or assembled with prompts, not both.')
+    if prompts is not None:
+        rows = load_image_embedding_store(REPO_PATH, manifest['store'])[0]
+        columns = [column for column in manifest['columns'] if column not in ['Embedding', 'model_input']]
+        split = rows.iloc[manifest['rows']][columns].reset_index(drop=True)
+        if 'model_input' in manifest['columns']:
+            split['model_input'] = list(assemble_model_inputs(REPO_PATH, manifest['store'], manifest['rows'], prompts))
+        return split
+    if codec is not None:
+        from utils import embedding_codecs
+        rows, codes, decoder = embedding_codecs.load_codec_store(REPO_PATH, manifest['store'], codec)
+        columns = [column for column in manifest['columns'] if column not in embedding_codecs.ENCODED_COLUMNS]
+        split = rows.iloc[manifest['rows']][columns].reset_index(drop=True)
+        if 'model_input' in manifest['columns']:
+            split['model_input'] = list(embedding_codecs.decode_rows(codes, decoder, manifest['rows']))
+        return split
+    store = load_embedding_store(REPO_PATH, manifest['store'])
+    return store.iloc[manifest['rows']][manifest['columns']].reset_index(drop=True)
+
+
+def read_split(path: str, REPO_PATH: str, codec: str = None, prompts=None) -> pd.DataFrame:
+    """Reads a dataset split, from its manifest ({name}.json) if it exists and from the csv ({name}.csv) otherwise.
+
+    Args:
+        path (str): Path of the split csv.
+        REPO_PATH (str): Path to the repository.
+        codec (str, optional): Codec of the encoded store the model inputs are read from, see load_split_manifest. Defaults to None.
+        prompts (str | np.ndarray | torch.Tensor, optional): Prompt embeddings the model inputs are assembled with, see load_split_manifest. Defaults to None.
+
+    Raises:
+        ValueError: If a codec or prompts are given for a split without manifest.
+
+    Returns:
+        pd.DataFrame: The split.
+    """
+    manifest_path = os.path.splitext(path)[0] + '.json'
+    if os.path.isfile(manifest_path):
+        return load_split_manifest(manifest_path, REPO_PATH, codec, prompts)
+    if codec is not None or prompts is not None:
+        raise ValueError(f'{path} has no split manifest, encoded stores and image embeddings can only be read through manifests, create the datasets again.')
+    return pd.read_csv(path)
+
+
+# The torch datasets are defined in utils/torch_datasets.py and re-exported here on first access,
+# so that torch is only imported when a dataset is used and the loaders above stay fast to import.
+TORCH_DATASETS = ['ImageDataset_from_df', 'EmbeddingDataset_from_df']
 
 
-class ImageDataset_from_df(Dataset):
-    def __init__(self, df, transform=None, target_transform=None, name='default_data'):
-        self.captions = df["label"].tolist()
-        self.images = df["path"].tolist()
-        self.target_transform = target_transform
-        self.transform = transform
-        self.name = name
-
-    def __len__(self):
-        return len(self.captions)
-
-    def __getitem__(self, idx):
-        image = PIL.Image.open(self.images[idx])
-        if self.transform:
-            image = self.transform(image)
-
-        caption = self.captions[idx]
-        if self.target_transform:
-            caption = self.target_transform(caption)
-
-        return image, caption
-    
-class EmbeddingDataset_from_df(Dataset):
-    def __init__(self, df, name) -> None:
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.labels = df['label'].tolist()
-        self.model_inputs = torch.tensor([np.frombuffer(eval(value),dtype=np.float32) for value in df['model_input']], dtype=torch.float32, device=self.device)
-        self.name = name
-
-    def __len__(self):
-        return len(self.labels)
-    
-    def __getitem__(self, index):
-        label = self.labels[index]
-        model_input = self.model_inputs[index]
-        return model_input, label
\ No newline at end of file
+def __getattr__(name):
+    if name in TORCH_DATASETS:
+        from utils import torch_datasets
+        return getattr(torch_datasets, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,299 @@
+import sys
+sys.path.append('.')
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import yaml
+from utils import backbones
+
+# Named prompt templates, {} is replaced by the country. default_prompt and extended_prompt are the prompts of the CLIP experiments.
+TEMPLATES = {
+    'default_prompt': '{}',
+    'extended_prompt': 'This image shows the country {}',
+    'photo': 'A photo taken in {}',
+    'street_view': 'A street view photo from {}',
+    'aerial': 'An aerial photo of {}',
+    'tourist': 'A tourist photo of a landmark in {}',
+}
+
+# Folder of the cached text embeddings, one sub folder per backbone
+PROMPT_BANK_FOLDER = 'CLIP_Embeddings/Prompt/Bank'
+
+
+class PromptBank:
+    """
+    Named prompt templates and the text embeddings of all countries for every template. The text features (the output of the text encoder,
+    in its precision) are cached on disk in CLIP_Embeddings/Prompt/Bank/{backbone}/{key}.npy, keyed by the backbone, the precision of the
+    text encoder (float16 on the GPU like clip.load, float32 on the CPU) and the template text (and the country list), so a template is only
+    encoded once per backbone and precision. All templates that are not cached yet are tokenized and encoded together in batches.
+    An ensemble is the normalized mean of the normalized embeddings of its templates.
+
+    Attributes:
+        REPO_PATH (str): Path to the repository.
+        backbone (str): The CLIP backbone of the text embeddings.
+        country_list (list): The countries, in the order of the country list.
+        templates (dict): Template of every registered name.
+        ensembles (dict): Names of the templates of every registered ensemble.
+        folder (str): Folder of the cached embeddings of the backbone.
+
+    Usage:
+        bank = PromptBank(REPO_PATH)
+        bank.register('road_signs', 'A photo of the road signs of {}')
+        bank.register_ensemble('all', list(bank.templates))
+        text_embeddings = bank.embeddings('road_signs')
+        print(bank.sweep(image_embeddings, labels))
+    """
+
+    def __init__(self, REPO_PATH: str, backbone: str = backbones.DEFAULT_BACKBONE, model=None, client=None, batch_size: int = 256):
+        """
+        Args:
+            REPO_PATH (str): Path to the repository.
+            backbone (str, optional): The CLIP backbone, see utils/backbones.py. Defaults to backbones.DEFAULT_BACKBONE.
+            model (torch.nn.Module, optional): A loaded CLIP model of the backbone, None loads it when the first template is encoded. Defaults to None.
+            client (EmbeddingClient, optional): Client of an embedding server of the backbone, that encodes the texts instead of a model. Defaults to None.
+            batch_size (int, optional): Number of texts encoded at once. Defaults to 256.
+        """
+        self.REPO_PATH = REPO_PATH
+        self.backbone = backbone
+        self.model = model
+        self.client = client
+        self.batch_size = batch_size
+        self.country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')["Country"].to_list()
+        self.templates = dict(TEMPLATES)
+        self.ensembles = {}
+        self.folder = os.path.join(REPO_PATH, PROMPT_BANK_FOLDER, os.path.splitext(os.path.basename(backbones.weight_file(backbone)))[0])
+        self._features = {}
+        self._precision = None
+
+    def register(self, name: str, template: str):
+        """Registers a template under a name.
+
+        Args:
+            name (str): Name of the template.
+            template (str): The template, {} is replaced by the country.
+
+        Raises:
+            ValueError: If the template has no {} or the name is taken by an ensemble.
+        """
+        if '{}' not in template:
+            raise ValueError(f'The template {template!r} has no {{}} for the country.')
+        if name in self.ensembles:
+            raise ValueError(f'{name} is already registered as ensemble.')
+        self.templates[name] = template
+
+    def register_ensemble(self, name: str, members: list):
+        """Registers the averaged embeddings of several templates under a name.
+
+        Args:
+            name (str): Name of the ensemble.
+            members (list): Names or texts of the templates.
+
+        Raises:
+            ValueError: If the ensemble is empty or the name is taken by a template.
+        """
+        if not members:
+            raise ValueError(f'The ensemble {name} has no templates.')
+        if name in self.templates:
+            raise ValueError(f'{name} is already registered as template.')
+        self.ensembles[name] = list(members)
+
+    def template(self, prompt: str) -> str:
+        """Template of a registered name, or the prompt itself if it is a template text."""
+        if prompt in self.templates:
+            return self.templates[prompt]
+        if '{}' not in prompt:
+            raise ValueError(f'{prompt!r} is neither a registered template or ensemble nor a template text with {{}}.')
+        return prompt
+
+    def texts(self, template: str) -> list:
+        """The prompts of all countries of a template."""
+        return [template.replace('{}', country) for country in self.country_list]
+
+    def precision(self) -> str:
+        """Precision of the text encoder, float16 on the GPU (like clip.load) and float32 on the CPU."""
+        if self._precision is None:
+            if self.model is not None:
+                self._precision = str(self.model.dtype).replace('torch.', '')
+            elif self.client is not None:
+                self._precision = 'float32' if self.client.stats()['device'] == 'cpu' else 'float16'
+            else:
+                import torch
+                # the device load_backbone picks for the model
+                self._precision = 'float16' if torch.cuda.is_available() else 'float32'
+        return self._precision
+
+    def cache_path(self, template: str) -> str:
+        """Path of the cached text features of a template."""
+        key = hashlib.sha256('\n'.join([self.precision(), template] + self.country_list).encode()).hexdigest()[:32]
+        return os.path.join(self.folder, f'{key}.npy')
+
+    def encode(self, templates: list):
+        """Loads the text features of templates from the cache and encodes the missing templates together.
+
+        Args:
+            templates (list): The template texts.
+        """
+        missing = []
+        for template in dict.fromkeys(templates):
+            if template in self._features:
+                continue
+            if os.path.isfile(self.cache_path(template)):
+                self._features[template] = np.load(self.cache_path(template))
+            else:
+                missing.append(template)
+        if not missing:
+            return
+        texts = [text for template in missing for text in self.texts(template)]
+        features = np.concatenate([self.encode_texts(texts[start:start + self.batch_size]) for start in range(0, len(texts), self.batch_size)])
+        os.makedirs(self.folder, exist_ok=True)
+        index = self.index()
+        for i, template in enumerate(missing):
+            self._features[template] = features[i * len(self.country_list):(i + 1) * len(self.country_list)]
+            # written to a temporary file first, a concurrent reader never sees a partial file
+            with open(self.cache_path(template) + '.part', 'wb') as handler:
+                np.save(handler, self._features[template])
+            os.replace(self.cache_path(template) + '.part', self.cache_path(template))
+            index[os.path.basename(self.cache_path(template))] = template
+        with open(os.path.join(self.folder, 'index.json.part'), 'w') as handler:
+            json.dump(index, handler, indent=1)
+        os.replace(os.path.join(self.folder, 'index.json.part'), os.path.join(self.folder, 'index.json'))
+        print(f"Encoded {len(missing)} templates with {self.backbone} ({self.precision()})")
+
+    def encode_texts(self, texts: list) -> np.ndarray:
+        """Text features of the backbone in the precision of its text encoder, by the embedding server if there is a client."""
+        if self.client is not None:
+            return self.client.encode_text(texts)
+        import clip
+        import torch
+        if self.model is None:
+            self.model = backbones.load_backbone(self.backbone, None, os.path.join(self.REPO_PATH, 'models'))[0]
+        with torch.no_grad():
+            return self.model.encode_text(clip.tokenize(texts).to(self.model.logit_scale.device)).cpu().numpy()
+
+    def index(self) -> dict:
+        """Template of every cached file of the backbone."""
+        path = os.path.join(self.folder, 'index.json')
+        if not os.path.isfile(path):
+            return {}
+        with open(path) as handler:
+            return json.load(handler)
+
+    def features(self, prompt: str) -> np.ndarray:
+        """Text features of all countries as returned by the text encoder, in its precision (see precision), of a registered template or
+        a template text. The forward pass of CLIP normalizes them in this precision. An ensemble has no output of the text encoder, its
+        normalized embeddings are returned in the precision of the encoder.
+
+        Args:
+            prompt (str): Name of a template or ensemble, or a template text.
+
+        Returns:
+            np.ndarray: features of shape (countries, dim)
+        """
+        if prompt in self.ensembles:
+            return self.embeddings(prompt).astype(self.precision())
+        template = self.template(prompt)
+        self.encode([template])
+        return self._features[template]
+
+    def embeddings(self, prompt: str) -> np.ndarray:
+        """Normalized text embeddings of all countries of a registered template or ensemble, or of a template text.
+
+        Args:
+            prompt (str): Name of a template or ensemble, or a template text.
+
+        Returns:
+            np.ndarray: float32 embeddings of shape (countries, dim)
+        """
+        if prompt in self.ensembles:
+            templates = [self.template(member) for member in self.ensembles[prompt]]
+            self.encode(templates)
+            mean = np.mean([self.embeddings(template) for template in templates], axis=0, dtype=np.float64)
+            return (mean / np.linalg.norm(mean, axis=1, keepdims=True)).astype(np.float32)
+        features = self.features(prompt).astype(np.float64)
+        return (features / np.linalg.norm(features, axis=1, keepdims=True)).astype(np.float32)
+
+    def sweep(self, image_embeddings: np.ndarray, labels: list, prompts: list = None, batch_size: int = 4096) -> pd.DataFrame:
+        """Zero-shot accuracy of many templates and ensembles on the same image embeddings. All text embeddings are stacked into one matrix,
+        so every batch of images is compared to all prompts in one matrix product.
+
+        Args:
+            image_embeddings (np.ndarray): Image embeddings of the backbone of shape (images, dim), e.g. from load_dataset.load_image_embedding_store.
+            labels (list): Country of every image.
+            prompts (list, optional): Names of templates and ensembles or template texts. Defaults to None, all registered templates and ensembles.
+            batch_size (int, optional): Number of images compared at once. Defaults to 4096.
+
+        Returns:
+            pd.DataFrame: prompt, template, accuracy and top 5 accuracy of every prompt, best first
+        """
+        prompts = list(prompts) if prompts is not None else list(self.templates) + list(self.ensembles)
+        self.encode([self.template(member) for prompt in prompts for member in self.ensembles.get(prompt, [prompt])])
+        text_embeddings = np.stack([self.embeddings(prompt) for prompt in prompts])
+        prompt_count, country_count, dim = text_embeddings.shape
+        stacked = text_embeddings.reshape(prompt_count * country_count, dim).T
+        positions = {country: i for i, country in enumerate(self.country_list)}
+        targets = np.array([positions[label] for label in labels])
+        correct = np.zeros(prompt_count)
+        correct_top_5 = np.zeros(prompt_count)
+        for start in range(0, len(targets), batch_size):
+            images = np.asarray(image_embeddings[start:start + batch_size], dtype=np.float32)
+            images = images / np.linalg.norm(images, axis=1, keepdims=True)
+            similarities = (images @ stacked).reshape(len(images), prompt_count, country_count)
+            target = targets[start:start + batch_size, None]
+            # rank of the label among all countries, per image and prompt
+            rank = (similarities > np.take_along_axis(similarities, np.broadcast_to(target[:, :, None], (len(images), prompt_count, 1)), axis=2)).sum(axis=2)
+            correct += (rank == 0).sum(axis=0)
+            correct_top_5 += (rank < 5).sum(axis=0)
+        result = pd.DataFrame({
+            'prompt': prompts,
+            'template': [' | '.join(self.template(member) for member in self.ensembles[prompt]) if prompt in self.ensembles else self.template(prompt) for prompt in prompts],
+            'accuracy': correct / len(targets),
+            'top_5_accuracy': correct_top_5 / len(targets),
+        })
+        return result.sort_values('accuracy', ascending=False, kind='stable').reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    """Sweeps prompt templates over the image embeddings of a split and reports their zero-shot accuracy
+    """
+    parser = argparse.ArgumentParser(description='Prompt bank')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone of the image embeddings, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--server_url', metavar='str', required=False, help='Url of a running embedding server, e.g. http://127.0.0.1:8765', default=None)
+    parser.add_argument('--templates', metavar='str', nargs='*', required=False, help='Further templates, {} is replaced by the country', default=[])
+    parser.add_argument('--templates_file', metavar='str', required=False, help='Text file with one further template per line', default=None)
+    parser.add_argument('--ensemble', action='store_true', required=False, help='Add the ensemble of all templates', default=False)
+    parser.add_argument('--split', metavar='str', required=False, help='Split of the sweep, defaults to CLIP_Embeddings/Testing/known_test_data.csv', default=None)
+    parser.add_argument('--output', metavar='str', required=False, help='Csv file of the results', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+    from utils import load_dataset
+    client = None
+    if args.server_url is not None:
+        from utils.embedding_client import EmbeddingClient
+        client = EmbeddingClient(args.server_url)
+    bank = PromptBank(REPO_PATH, args.backbone, client=client)
+    templates = list(args.templates)
+    if args.templates_file is not None:
+        with open(args.templates_file) as handler:
+            templates += [line.strip() for line in handler if line.strip()]
+    for template in templates:
+        bank.register(template, template)
+    if args.ensemble:
+        bank.register_ensemble('ensemble', list(bank.templates))
+
+    # the image embeddings of the split, without encoding the images (see load_dataset.save_image_embeddings)
+    split = args.split or f'{REPO_PATH}/CLIP_Embeddings/Testing/known_test_data.csv'
+    with open(os.path.splitext(split)[0] + '.json') as handler:
+        manifest = json.load(handler)
+    rows, image_embeddings = load_dataset.load_image_embedding_store(REPO_PATH, manifest['store'])
+    positions = np.sort(np.asarray(manifest['rows'], dtype=np.int64))
+    result = bank.sweep(image_embeddings[positions], rows['label'].iloc[positions].tolist())
+    print(result.to_string(index=False))
+    if args.output is not None:
+        result.to_csv(args.output, index=False)
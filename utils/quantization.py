@@ -0,0 +1,304 @@
+import sys
+sys.path.append('.')
+import os
+import time
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+import torch
+import yaml
+from utils import backbones, features, load_dataset
+
+# Quantization modes of the image encoder, see quantize_backbone
+QUANTIZATION_MODES = ['dynamic', 'static']
+
+
+class StaticQuantLinear(torch.nn.Module):
+    """
+    Linear layer with int8 weights and int8 activations, the input is quantized with the scale observed during the calibration.
+    Before torch.ao.quantization.convert it is a float layer with observers.
+    """
+
+    def __init__(self, linear: torch.nn.Linear):
+        super().__init__()
+        self.quant = torch.ao.quantization.QuantStub()
+        self.linear = linear
+        self.dequant = torch.ao.quantization.DeQuantStub()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def quantization_engine() -> str:
+    """Selects the quantized kernels of this CPU (x86 on Intel/AMD, qnnpack on ARM).
+
+    Returns:
+        str: the engine
+    """
+    engines = torch.backends.quantized.supported_engines
+    engine = 'x86' if 'x86' in engines else 'qnnpack'
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+def mlp_linears(visual: torch.nn.Module) -> list:
+    """The Linear layers of the MLPs of the image transformer (c_fc and c_proj of every block), about two thirds of its FLOPs.
+    The projections of the attention are called through torch.nn.functional.multi_head_attention_forward and stay float.
+
+    Returns:
+        list: (block.mlp, name) pairs
+    """
+    return [(module, name) for module in visual.modules() if hasattr(module, 'c_fc')
+            for name in ['c_fc', 'c_proj'] if isinstance(getattr(module, name), torch.nn.Linear)]
+
+
+def quantize_dynamic(model: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization of the Linear layers of the image encoder: the weights are stored as int8, the activations
+    are quantized per batch at runtime. The text encoder is not changed, so the text embeddings stay the same.
+
+    Args:
+        model (torch.nn.Module): CLIP model on the CPU, changed in place.
+
+    Returns:
+        torch.nn.Module: the model
+    """
+    quantization_engine()
+    model.visual = torch.ao.quantization.quantize_dynamic(model.visual, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def quantize_static(model: torch.nn.Module, calibration: torch.Tensor, batch_size: int = 32) -> torch.nn.Module:
+    """Static int8 quantization of the MLP Linear layers of the image encoder: the activation scales are fixed by the
+    calibration images, so no scales are computed at runtime. The text encoder is not changed.
+
+    Args:
+        model (torch.nn.Module): CLIP model on the CPU, changed in place.
+        calibration (torch.Tensor): Preprocessed calibration images, see calibration_images.
+        batch_size (int, optional): Batch size of the calibration. Defaults to 32.
+
+    Returns:
+        torch.nn.Module: the model
+    """
+    qconfig = torch.ao.quantization.get_default_qconfig(quantization_engine())
+    for module, name in mlp_linears(model.visual):
+        wrapper = StaticQuantLinear(getattr(module, name))
+        wrapper.qconfig = qconfig
+        setattr(module, name, wrapper)
+    torch.ao.quantization.prepare(model.visual, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(calibration), batch_size):
+            model.visual(calibration[start:start + batch_size])
+    torch.ao.quantization.convert(model.visual, inplace=True)
+    return model
+
+
+def calibration_images(DATA_PATH: str, preprocessor, num_images: int = 256, datasets: list = ('geoguessr', 'tourist', 'aerial'), seed: int = 1234) -> torch.Tensor:
+    """A random sample of our images, equally drawn from the datasets, for the static quantization.
+
+    Args:
+        DATA_PATH (str): path to the data folder.
+        preprocessor (Callable): The CLIP preprocessor.
+        num_images (int, optional): Number of images. Defaults to 256.
+        datasets (list, optional): The datasets. Defaults to ('geoguessr', 'tourist', 'aerial').
+        seed (int, optional): Seed of the sample. Defaults to 1234.
+
+    Returns:
+        torch.Tensor: preprocessed images
+    """
+    frames = [load_dataset.load_data(f'{DATA_PATH}/{dataset}') for dataset in datasets]
+    df = pd.concat([frame.sample(min(len(frame), -(-num_images // len(datasets))), random_state=seed) for frame in frames])
+    images = load_dataset.ImageDataset_from_df(df.head(num_images), preprocessor)
+    return torch.stack([images[i][0] for i in range(len(images))])
+
+
+def quantize_backbone(model: torch.nn.Module, mode: str, calibration: torch.Tensor = None) -> torch.nn.Module:
+    """Quantizes the image encoder of a CLIP model on the CPU.
+
+    Args:
+        model (torch.nn.Module): CLIP model, changed in place.
+        mode (str): 'dynamic' or 'static'.
+        calibration (torch.Tensor, optional): Preprocessed calibration images, required by 'static'. Defaults to None.
+
+    Raises:
+        ValueError: Unknown mode or static quantization without calibration images.
+
+    Returns:
+        torch.nn.Module: the model
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f'Unknown quantization {mode}, use one of {QUANTIZATION_MODES}.')
+    if mode == 'static' and calibration is None:
+        raise ValueError('Static quantization needs calibration images, see calibration_images.')
+    # torch.ao.quantization warns about its deprecation in favour of torchao
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if mode == 'dynamic':
+            return quantize_dynamic(model)
+        return quantize_static(model, calibration)
+
+
+def load_quantized_backbone(name: str, mode: str, DATA_PATH: str = None, model_dir: str = backbones.DEFAULT_MODEL_DIR, num_calibration_images: int = 256) -> tuple:
+    """Loads a backbone with a quantized image encoder on the CPU, the calibration images of 'static' are sampled from DATA_PATH.
+
+    Args:
+        name (str): Name of the backbone, see utils/backbones.py.
+        mode (str): 'dynamic' or 'static'.
+        DATA_PATH (str, optional): path to the data folder, required by 'static'. Defaults to None.
+        model_dir (str, optional): Folder of the weight files. Defaults to backbones.DEFAULT_MODEL_DIR.
+        num_calibration_images (int, optional): Number of calibration images. Defaults to 256.
+
+    Returns:
+        tuple: model and preprocessor
+    """
+    calibration = None
+    if mode == 'static':
+        preprocessor = backbones.load_backbone(name, 'cpu', model_dir)[1]
+        calibration = calibration_images(DATA_PATH, preprocessor, num_calibration_images)
+    return backbones.load_backbone(name, 'cpu', model_dir, mode, calibration)
+
+
+def encode_images(model: torch.nn.Module, images: torch.Tensor, batch_size: int = 32) -> tuple:
+    """Image embeddings and throughput of an image encoder.
+
+    Returns:
+        tuple: float32 embeddings as np.ndarray and images per second
+    """
+    with torch.no_grad():
+        model.encode_image(images[:batch_size])  # warm up
+        start = time.perf_counter()
+        embeddings = torch.cat([model.encode_image(images[i:i + batch_size]).float() for i in range(0, len(images), batch_size)])
+    return embeddings.numpy(), len(images) / (time.perf_counter() - start)
+
+
+def evaluation_images(REPO_PATH: str, DATA_PATH: str, datasets: list, num_images: int, test_split: str = None, seed: int = 1234) -> pd.DataFrame:
+    """The evaluated images: the images of the test split (by default CLIP_Embeddings/Testing/known_test_data.csv),
+    or a random sample of the datasets if there is no test split.
+
+    Returns:
+        pd.DataFrame: path, label and dataset of at most num_images images per dataset
+    """
+    test_split = test_split or f'{REPO_PATH}/CLIP_Embeddings/Testing/known_test_data.csv'
+    split = None
+    if os.path.isfile(test_split) or os.path.isfile(os.path.splitext(test_split)[0] + '.json'):
+        split = load_dataset.read_split(test_split, REPO_PATH)
+    frames = []
+    for dataset in datasets:
+        if split is not None:
+            df = split[split['path'].str.contains(f'/{dataset}/', regex=False)]
+        else:
+            df = load_dataset.load_data(f'{DATA_PATH}/{dataset}')
+        frames.append(df.sample(min(len(df), num_images), random_state=seed)[['path', 'label']].assign(dataset=dataset))
+    return pd.concat(frames, ignore_index=True)
+
+
+def evaluate_quantization(REPO_PATH: str, DATA_PATH: str, backbone: str = backbones.DEFAULT_BACKBONE, modes: list = QUANTIZATION_MODES,
+                          checkpoint: str = None, datasets: list = ('geoguessr', 'tourist', 'aerial'), num_images: int = 500,
+                          num_calibration_images: int = 256, test_split: str = None, batch_size: int = 32) -> pd.DataFrame:
+    """Compares the quantized image encoders with the float encoder on the CPU: throughput, similarity of the embeddings,
+    zero-shot country and region accuracy (prompt "This image shows the country {}") and the accuracy of a FinetunedClip.
+
+    Args:
+        REPO_PATH (str): path to the repo folder.
+        DATA_PATH (str): path to the data folder.
+        backbone (str, optional): The CLIP backbone. Defaults to backbones.DEFAULT_BACKBONE.
+        modes (list, optional): The evaluated quantization modes. Defaults to QUANTIZATION_MODES.
+        checkpoint (str, optional): State dict of a trained FinetunedClip, None skips its accuracy. Defaults to None.
+        datasets (list, optional): The datasets. Defaults to ('geoguessr', 'tourist', 'aerial').
+        num_images (int, optional): Maximal number of evaluated images per dataset. Defaults to 500.
+        num_calibration_images (int, optional): Number of calibration images of the static quantization. Defaults to 256.
+        test_split (str, optional): Split of the evaluated images, see evaluation_images. Defaults to None.
+        batch_size (int, optional): Batch size of the image encoder. Defaults to 32.
+
+    Returns:
+        pd.DataFrame: one row per quantization mode and dataset
+    """
+    model_dir = os.path.join(REPO_PATH, 'models')
+    model, preprocessor = backbones.load_backbone(backbone, 'cpu', model_dir)
+    df = evaluation_images(REPO_PATH, DATA_PATH, datasets, num_images, test_split)
+    dataset_images = load_dataset.ImageDataset_from_df(df, preprocessor)
+    images = torch.stack([dataset_images[i][0] for i in range(len(dataset_images))])
+
+    country_list = pd.read_csv(f'{REPO_PATH}/utils/country_list/country_list_region_and_continent.csv')
+    countries = np.array(country_list['Country'])
+    region_of = dict(zip(country_list['Country'], country_list['Intermediate Region Name']))
+    labels = df['label'].to_numpy()
+    import clip
+    with torch.no_grad():
+        # the text encoder is not quantized, the prompt embeddings are the same for all modes
+        prompt_embeddings = model.encode_text(clip.tokenize(features.country_prompts(REPO_PATH))).float().numpy()
+    head = None
+    if checkpoint is not None:
+        from finetuning.model import nn
+        head = nn.FinetunedClip()
+        head.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        head.eval()
+        # the model inputs of the head are computed with the prompt embeddings it was trained on
+        prompt_path = f'{REPO_PATH}/CLIP_Embeddings/Prompt/prompt_image_shows_embedding.pt'
+        head_prompts = torch.load(prompt_path, map_location='cpu').float().numpy() if os.path.isfile(prompt_path) else prompt_embeddings
+
+    calibration = None
+    if 'static' in modes:
+        calibration = calibration_images(DATA_PATH, preprocessor, num_calibration_images, datasets)
+    rows = []
+    reference = None
+    for mode in [None] + list(modes):
+        encoder = backbones.load_backbone(backbone, 'cpu', model_dir, mode, calibration)[0]
+        embeddings, images_per_second = encode_images(encoder, images, batch_size)
+        if reference is None:
+            reference, reference_speed = embeddings, images_per_second
+        normalized = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        zero_shot = countries[np.argmax(normalized @ (prompt_embeddings / np.linalg.norm(prompt_embeddings, axis=1, keepdims=True)).T, axis=1)]
+        if head is not None:
+            with torch.no_grad():
+                finetuned = countries[head(torch.from_numpy(features.model_inputs(embeddings, head_prompts))).argmax(dim=1).numpy()]
+        cosine = np.sum(normalized * reference / np.linalg.norm(reference, axis=1, keepdims=True), axis=1)
+        for dataset in datasets:
+            selected = (df['dataset'] == dataset).to_numpy()
+            row = {
+                'quantization': mode or 'float32',
+                'dataset': dataset,
+                'images': int(selected.sum()),
+                'images_per_second': images_per_second,
+                'speedup': images_per_second / reference_speed,
+                'min_cosine_to_float32': float(cosine[selected].min()) if selected.any() else None,
+                'zero_shot_country_accuracy': np.mean(zero_shot[selected] == labels[selected]),
+                'zero_shot_region_accuracy': np.mean([region_of.get(p) == region_of.get(l) for p, l in zip(zero_shot[selected], labels[selected])]),
+            }
+            if head is not None:
+                row['finetuned_accuracy'] = np.mean(finetuned[selected] == labels[selected])
+            rows.append(row)
+    result = pd.DataFrame(rows)
+    accuracies = [column for column in result.columns if column.endswith('accuracy')]
+    baseline = result[result['quantization'] == 'float32'].set_index('dataset')[accuracies]
+    for column in accuracies:
+        result[f'{column}_change'] = result[column] - result['dataset'].map(baseline[column])
+    return result
+
+
+if __name__ == "__main__":
+    """Evaluates the int8 quantized image encoders against the float32 encoder on the CPU
+    """
+    parser = argparse.ArgumentParser(description='Evaluate quantization')
+    parser.add_argument('--yaml_path', metavar='str', required=True, help='The path to the yaml file with the stored paths')
+    parser.add_argument('--backbone', metavar='str', required=False, help='The CLIP backbone, see utils/backbones.py', default=backbones.DEFAULT_BACKBONE)
+    parser.add_argument('--modes', metavar='str', nargs='*', choices=QUANTIZATION_MODES, required=False, help='The quantization modes', default=QUANTIZATION_MODES)
+    parser.add_argument('--checkpoint', metavar='str', required=False, help='State dict of a trained FinetunedClip', default=None)
+    parser.add_argument('--test_split', metavar='str', required=False, help='Split of the evaluated images, defaults to CLIP_Embeddings/Testing/known_test_data.csv', default=None)
+    parser.add_argument('--num_images', metavar='int', type=int, required=False, help='Maximal number of images per dataset', default=500)
+    parser.add_argument('--calibration_images', metavar='int', type=int, required=False, help='Number of calibration images of the static quantization', default=256)
+    parser.add_argument('--threads', metavar='int', type=int, required=False, help='Number of torch threads', default=None)
+    parser.add_argument('--output', metavar='str', required=False, help='Csv file of the results', default=None)
+    args = parser.parse_args()
+
+    with open(args.yaml_path) as file:
+        paths = yaml.safe_load(file)
+        REPO_PATH = paths['repo_path']
+        DATA_PATH = paths['data_path']
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    result = evaluate_quantization(REPO_PATH, DATA_PATH, args.backbone, args.modes, args.checkpoint,
+                                   num_images=args.num_images, num_calibration_images=args.calibration_images, test_split=args.test_split)
+    print(result.to_string(index=False))
+    if args.output is not None:
+        result.to_csv(args.output, index=False)
@@ -0,0 +1,271 @@
+import numpy as np
+import scipy.stats as stats
+from concurrent.futures import ProcessPoolExecutor
+
+
+def pairwise_differences(results: np.ndarray):
+    """
+    Compute the fold-wise differences for all pairs of experiments.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+
+    Returns:
+        tuple: The row indices, the column indices (as returned by np.triu_indices)
+            and the differences results[i] - results[j] of shape (pairs, folds).
+    """
+    results = np.asarray(results, dtype=np.float64)
+    if results.ndim != 2:
+        raise ValueError("The results must be a matrix of shape (experiments, folds).")
+    rows, cols = np.triu_indices(results.shape[0], k=1)
+    return rows, cols, results[rows] - results[cols]
+
+
+def pairs_to_matrix(values: np.ndarray, rows: np.ndarray, cols: np.ndarray, num_experiments: int, antisymmetric: bool = True):
+    """
+    Scatter the values computed for the upper triangle pairs into a square matrix.
+
+    Args:
+        values (np.ndarray): One value per pair.
+        rows (np.ndarray): Row indices of the pairs.
+        cols (np.ndarray): Column indices of the pairs.
+        num_experiments (int): Number of experiments.
+        antisymmetric (bool, optional): Negate the values of the lower triangle
+            (used for signed statistics). Defaults to True.
+
+    Returns:
+        np.ndarray: Matrix of shape (experiments, experiments) with a zero diagonal.
+    """
+    matrix = np.zeros((num_experiments, num_experiments), dtype=np.float64)
+    matrix[rows, cols] = values
+    matrix[cols, rows] = -values if antisymmetric else values
+    return matrix
+
+
+def paired_k_fold_cv_t_test(results: np.ndarray, k: int, r: int):
+    """
+    Compute the paired k fold cross validation t-test for all pairs of experiments at once,
+    in accordance with the method described in https://link.springer.com/chapter/10.1007/978-3-540-24775-3_3
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds), with folds == r*k.
+        k (int): Number of cross validation folds
+        r (int): Number of random cross-validation repetitions
+
+    Returns:
+        tuple: Matrices of the t-values and p-values and the degrees of freedom.
+            Entry [i, j] compares experiment i with experiment j.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments, num_folds = results.shape
+    if num_folds != r*k:
+        raise ValueError('The results do not coincide with the r and k values.')
+    rows, cols, differences = pairwise_differences(results)
+    mean = differences.mean(axis=1)
+    variance = differences.var(axis=1, ddof=1)
+    t = mean / np.sqrt(variance/(num_folds + 1/(k-1)))
+    p = stats.t.sf(np.abs(t), num_folds - 1)
+    df = num_folds - 1
+    t_matrix = pairs_to_matrix(t, rows, cols, num_experiments)
+    p_matrix = pairs_to_matrix(p, rows, cols, num_experiments, antisymmetric=False)
+    return t_matrix, p_matrix, df
+
+
+def corrected_repeated_kfold_cv_test(results: np.ndarray, n1: int, n2: int, alpha: float):
+    """
+    Perform the corrected repeated k-fold cross-validation test of Bouckaert et al. (2004)
+    for all pairs of experiments at once.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+        n1 (int): The number of training samples in each fold.
+        n2 (int): The number of test samples ind each fold.
+        alpha (float): The significance level.
+
+    Returns:
+        tuple: The degrees of freedom, the matrix of t-statistics, the critical value and the matrix of p-values.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments, n = results.shape
+    rows, cols, differences = pairwise_differences(results)
+    m = differences.mean(axis=1)
+    stdv_sq = np.sqrt(differences.var(axis=1, ddof=1))
+    t = m / np.sqrt((1 / n + n2 / n1) * stdv_sq)
+    df = n - 1
+    cv = stats.t.ppf(1.0 - alpha, df)
+    p = (1.0 - stats.t.cdf(np.abs(t), df)) * 2.0
+    t_matrix = pairs_to_matrix(t, rows, cols, num_experiments)
+    p_matrix = pairs_to_matrix(p, rows, cols, num_experiments, antisymmetric=False)
+    return df, t_matrix, cv, p_matrix
+
+
+def independent_t_test(results: np.ndarray):
+    """
+    Compute Student's two sample t-test (as scipy.stats.ttest_ind) for all pairs of experiments at once.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+
+    Returns:
+        tuple: Matrices of the t-values and p-values.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments, n = results.shape
+    rows, cols = np.triu_indices(num_experiments, k=1)
+    mean = results.mean(axis=1)
+    variance = results.var(axis=1, ddof=1)
+    pooled_variance = (variance[rows] + variance[cols]) / 2
+    t = (mean[rows] - mean[cols]) / np.sqrt(pooled_variance * 2 / n)
+    p = 2 * stats.t.sf(np.abs(t), 2*n - 2)
+    t_matrix = pairs_to_matrix(t, rows, cols, num_experiments)
+    p_matrix = pairs_to_matrix(p, rows, cols, num_experiments, antisymmetric=False)
+    return t_matrix, p_matrix
+
+
+def effect_sizes(results: np.ndarray, paired: bool = True):
+    """
+    Compute Cohen's d for all pairs of experiments at once.
+    For paired results the mean difference is divided by the standard deviation of the differences,
+    otherwise by the pooled standard deviation.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+        paired (bool, optional): Whether the folds of all experiments are paired. Defaults to True.
+
+    Returns:
+        np.ndarray: Matrix of effect sizes.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments = results.shape[0]
+    rows, cols, differences = pairwise_differences(results)
+    if paired:
+        d = differences.mean(axis=1) / differences.std(axis=1, ddof=1)
+    else:
+        variance = results.var(axis=1, ddof=1)
+        d = differences.mean(axis=1) / np.sqrt((variance[rows] + variance[cols]) / 2)
+    return pairs_to_matrix(d, rows, cols, num_experiments)
+
+
+def bootstrap_test(results: np.ndarray, num_resamples: int = 10000, confidence_level: float = 0.95, seed: int = 1234, chunk_size: int = 1000, paired: bool = True):
+    """
+    Bootstrap the mean fold difference for all pairs of experiments.
+    For paired results all pairs share the same resampled fold indices, otherwise the folds of every
+    experiment are resampled independently. The resamples are drawn in chunks of (chunk_size, folds)
+    so that a single call handles thousands of resamples.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+        num_resamples (int, optional): Number of bootstrap resamples. Defaults to 10000.
+        confidence_level (float, optional): Confidence level of the interval. Defaults to 0.95.
+        seed (int, optional): Random seed. Defaults to 1234.
+        chunk_size (int, optional): Number of resamples evaluated per batch. Defaults to 1000.
+        paired (bool, optional): Whether the folds of all experiments are paired. Defaults to True.
+
+    Returns:
+        tuple: Matrices of the lower and upper confidence bound and of the two-sided p-values.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments, num_folds = results.shape
+    rows, cols, differences = pairwise_differences(results)
+    observed = differences.mean(axis=1)
+    rng = np.random.default_rng(seed)
+
+    bootstrap_means = np.empty((len(rows), num_resamples), dtype=np.float64)
+    for start in range(0, num_resamples, chunk_size):
+        stop = min(start + chunk_size, num_resamples)
+        if paired:
+            indices = rng.integers(0, num_folds, size=(stop - start, num_folds))
+            bootstrap_means[:, start:stop] = differences[:, indices].mean(axis=2)
+        else:
+            indices = rng.integers(0, num_folds, size=(stop - start, num_experiments, num_folds))
+            means = np.take_along_axis(results[None], indices, axis=2).mean(axis=2)
+            bootstrap_means[:, start:stop] = (means[:, rows] - means[:, cols]).T
+    # the null distribution is the bootstrap distribution shifted to a zero mean difference
+    exceedances = (np.abs(bootstrap_means - observed[:, None]) >= np.abs(observed)[:, None]).sum(axis=1)
+
+    tail = (1 - confidence_level) / 2 * 100
+    lower, upper = np.percentile(bootstrap_means, [tail, 100 - tail], axis=1)
+    p = (exceedances + 1) / (num_resamples + 1)
+    lower_matrix = pairs_to_matrix(lower, rows, cols, num_experiments)
+    upper_matrix = pairs_to_matrix(upper, rows, cols, num_experiments)
+    # the interval of (j, i) is the negated interval of (i, j)
+    lower_matrix[cols, rows], upper_matrix[cols, rows] = -upper, -lower
+    p_matrix = pairs_to_matrix(p, rows, cols, num_experiments, antisymmetric=False)
+    return lower_matrix, upper_matrix, p_matrix
+
+
+def permutation_test(results: np.ndarray, num_resamples: int = 10000, seed: int = 1234, chunk_size: int = 1000, paired: bool = True):
+    """
+    Permutation test of the mean fold difference for all pairs of experiments.
+    Paired results are tested with random sign flips of the fold differences, otherwise the folds of both
+    experiments are pooled and their experiment labels are shuffled. The random sign or label matrices
+    of shape (chunk_size, folds) are shared across all pairs.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+        num_resamples (int, optional): Number of permutations. Defaults to 10000.
+        seed (int, optional): Random seed. Defaults to 1234.
+        chunk_size (int, optional): Number of permutations evaluated per batch. Defaults to 1000.
+        paired (bool, optional): Whether the folds of all experiments are paired. Defaults to True.
+
+    Returns:
+        np.ndarray: Matrix of two-sided p-values.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments, num_folds = results.shape
+    rows, cols, differences = pairwise_differences(results)
+    observed = np.abs(differences.mean(axis=1))
+    rng = np.random.default_rng(seed)
+    if paired:
+        values, labels = differences, np.array([-1.0, 1.0])
+    else:
+        # the mean difference of a labelling is the pooled folds weighted by +1 / folds or -1 / folds
+        values, labels = np.hstack([results[rows], results[cols]]), np.repeat([1.0, -1.0], num_folds)
+
+    exceedances = np.zeros(len(rows), dtype=np.int64)
+    for start in range(0, num_resamples, chunk_size):
+        stop = min(start + chunk_size, num_resamples)
+        if paired:
+            signs = rng.choice(labels, size=(stop - start, num_folds))
+        else:
+            signs = rng.permuted(np.tile(labels, (stop - start, 1)), axis=1)
+        permuted_means = values @ signs.T / num_folds
+        exceedances += (np.abs(permuted_means) >= observed[:, None]).sum(axis=1)
+
+    p = (exceedances + 1) / (num_resamples + 1)
+    return pairs_to_matrix(p, rows, cols, num_experiments, antisymmetric=False)
+
+
+def _aso_pair(arguments):
+    """Run a single ASO comparison, used as worker function of the process pool."""
+    from deepsig import aso
+    scores_a, scores_b, confidence_level, num_comparisons, seed = arguments
+    return aso(scores_a, scores_b, confidence_level=confidence_level, num_comparisons=num_comparisons, seed=seed, show_progress=False)
+
+
+def aso_test(results: np.ndarray, confidence_level: float = 0.95, seed: int = 1234, num_workers: int = None):
+    """
+    Run the Almost Stochastic Order test of deepsig for all ordered pairs of experiments in a process pool.
+
+    Args:
+        results (np.ndarray): Matrix of shape (experiments, folds).
+        confidence_level (float, optional): Confidence level of the test. Defaults to 0.95.
+        seed (int, optional): Random seed. Defaults to 1234.
+        num_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        np.ndarray: Matrix of epsilon_min values, entry [i, j] tests whether experiment i is stochastically dominant over j.
+    """
+    results = np.asarray(results, dtype=np.float64)
+    num_experiments = results.shape[0]
+    pairs = [(i, j) for i in range(num_experiments) for j in range(num_experiments) if i != j]
+    # Bonferroni correction over all comparisons as recommended by deepsig
+    arguments = [(results[i], results[j], confidence_level, len(pairs), seed) for i, j in pairs]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        epsilons = list(executor.map(_aso_pair, arguments))
+
+    matrix = np.zeros((num_experiments, num_experiments), dtype=np.float64)
+    for (i, j), epsilon in zip(pairs, epsilons):
+        matrix[i, j] = epsilon
+    return matrix
@@ -0,0 +1,199 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.utils.data
+
+
+class PreprocessedTensorCache:
+    """
+    Persistent cache of preprocessed images, stored as uint8 tensors of shape (3, n_px, n_px) in memory-mapped shard files.
+    Every preprocessor config gets its own folder {cache_dir}/{config hash}. An image is identified by its path, file size
+    and modification time, so a replaced file is preprocessed again. If the cache is full, the least recently used images are evicted.
+
+    Every slot stores the digest of its key next to the tensor, so a slot that was overwritten after the index was last
+    flushed is detected as a miss instead of returning a wrong image.
+
+    The cache is written by a single process. The first cache of a folder holds an exclusive lock on it, caches of the folder in
+    other processes only read while it is held. Images preprocessed in DataLoader worker processes are not added either, as
+    every worker only has a copy of the index; with num_workers > 0 the cache is only read.
+
+    Attributes:
+        directory (str): Folder of the shards and the index of this preprocessor config.
+        slot_shape (tuple): Shape of a cached tensor.
+        capacity (int): Maximal number of cached tensors.
+        shard_slots (int): Number of tensors per shard file.
+        entries (OrderedDict): Slot of every cached key, ordered from least to most recently used.
+        writable (bool): Whether this process holds the lock of the folder and adds images.
+        hits (int): Number of images read from the cache.
+        misses (int): Number of images not found in the cache.
+
+    Usage:
+        cache = PreprocessedTensorCache(cache_dir, fast_preprocessor.config(), max_bytes=8 * 2**30)
+        dataset = ImageDataset_from_df(df, preprocessor, cache=cache)
+        ...
+        cache.flush()
+    """
+    index_name = 'index.json'
+
+    def __init__(self, cache_dir: str, config: dict, max_bytes: int = 8 * 2**30, shard_slots: int = 1024):
+        """
+        Args:
+            cache_dir (str): Folder of the cache, it is created if it does not exist.
+            config (dict): Config of the preprocessor (see FastPreprocessor.config), must contain n_px.
+            max_bytes (int, optional): Maximal size of the cached tensors in bytes. Defaults to 8 GiB.
+            shard_slots (int, optional): Number of tensors per shard file. Defaults to 1024.
+        """
+        config_hash = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+        self.directory = os.path.join(cache_dir, config_hash)
+        os.makedirs(self.directory, exist_ok=True)
+        self.slot_shape = (3, config['n_px'], config['n_px'])
+        slot_bytes = int(np.prod(self.slot_shape))
+        self.capacity = max(1, max_bytes // slot_bytes)
+        self.shard_slots = min(shard_slots, self.capacity)
+        self.entries = OrderedDict()
+        self.shards = {}
+        self.hits = 0
+        self.misses = 0
+        self.writable = self.lock()
+
+        index_path = os.path.join(self.directory, self.index_name)
+        if os.path.isfile(index_path):
+            with open(index_path) as handler:
+                index = json.load(handler)
+            if index['shard_slots'] == self.shard_slots:
+                # entries beyond a reduced capacity are dropped
+                self.entries = OrderedDict((key, slot) for key, slot in index['entries'] if slot < self.capacity)
+        elif self.writable:
+            with open(os.path.join(self.directory, 'config.json'), 'w') as handler:
+                json.dump(config, handler)
+        used_slots = set(self.entries.values())
+        self.next_slot = max(used_slots) + 1 if used_slots else 0
+        self.free_slots = sorted(set(range(self.next_slot)) - used_slots, reverse=True)
+
+    def lock(self) -> bool:
+        """Takes the exclusive lock of the folder, which is held until the process exits.
+
+        Returns:
+            bool: False if another process holds the lock, True otherwise (also where file locks are not available)
+        """
+        try:
+            import fcntl
+        except ImportError:
+            return True
+        self.lock_file = open(os.path.join(self.directory, 'lock'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            print(f"The tensor cache {self.directory} is used by another process, it is only read")
+            return False
+        return True
+
+    @staticmethod
+    def key(path: str) -> str:
+        """Key of an image: absolute path, file size and modification time.
+
+        Args:
+            path (str): Path of the image.
+
+        Returns:
+            str: the key
+        """
+        stat = os.stat(path)
+        return '{}|{}|{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def digest(key: str) -> np.ndarray:
+        """16 byte digest of a key, stored next to the cached tensor."""
+        return np.frombuffer(hashlib.md5(key.encode()).digest(), dtype=np.uint8)
+
+    def shard(self, index: int) -> tuple:
+        """Memory maps a shard file and the digests of its slots, the files are created on first use.
+
+        Args:
+            index (int): Index of the shard.
+
+        Returns:
+            tuple: (tensors, digests) memory maps
+        """
+        if index not in self.shards:
+            shard_path = os.path.join(self.directory, 'shard_{}.npy'.format(index))
+            digest_path = os.path.join(self.directory, 'shard_{}_keys.npy'.format(index))
+            mode = 'r+' if self.writable else 'r'
+            if os.path.isfile(shard_path) and os.path.isfile(digest_path):
+                self.shards[index] = (np.load(shard_path, mmap_mode=mode), np.load(digest_path, mmap_mode=mode))
+            if index not in self.shards or self.shards[index][0].shape[0] != self.shard_slots:
+                tensors = np.lib.format.open_memmap(shard_path, mode='w+', dtype=np.uint8, shape=(self.shard_slots,) + self.slot_shape)
+                digests = np.lib.format.open_memmap(digest_path, mode='w+', dtype=np.uint8, shape=(self.shard_slots, 16))
+                self.shards[index] = (tensors, digests)
+        return self.shards[index]
+
+    def get(self, path: str) -> torch.Tensor:
+        """Reads the cached tensor of an image.
+
+        Args:
+            path (str): Path of the image.
+
+        Returns:
+            torch.Tensor: uint8 tensor of shape (3, n_px, n_px), None if the image is not cached
+        """
+        key = self.key(path)
+        slot = self.entries.get(key)
+        if slot is not None:
+            tensors, digests = self.shard(slot // self.shard_slots)
+            if np.array_equal(digests[slot % self.shard_slots], self.digest(key)):
+                tensor = np.array(tensors[slot % self.shard_slots])
+                # the writing process may have replaced the slot while it was copied
+                if np.array_equal(digests[slot % self.shard_slots], self.digest(key)):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return torch.from_numpy(tensor)
+            del self.entries[key]
+            self.free_slots.append(slot)
+        self.misses += 1
+        return None
+
+    def put(self, path: str, tensor: torch.Tensor):
+        """Adds the tensor of an image, evicting the least recently used image if the cache is full.
+        Nothing is added if the cache is only read or if it is called in a DataLoader worker process.
+
+        Args:
+            path (str): Path of the image.
+            tensor (torch.Tensor): uint8 tensor of shape (3, n_px, n_px).
+        """
+        if not self.writable or torch.utils.data.get_worker_info() is not None:
+            return
+        key = self.key(path)
+        if key in self.entries:
+            return
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        elif self.next_slot < self.capacity:
+            slot = self.next_slot
+            self.next_slot += 1
+        else:
+            _, slot = self.entries.popitem(last=False)
+        tensors, digests = self.shard(slot // self.shard_slots)
+        # the digest is cleared first, so readers never match a partially written tensor
+        digests[slot % self.shard_slots] = 0
+        tensors[slot % self.shard_slots] = tensor.numpy()
+        digests[slot % self.shard_slots] = self.digest(key)
+        self.entries[key] = slot
+
+    def flush(self):
+        """Writes the shards to disk and saves the index (atomically), if the cache is written by this process."""
+        if not self.writable:
+            return
+        for tensors, digests in self.shards.values():
+            tensors.flush()
+            digests.flush()
+        index_path = os.path.join(self.directory, self.index_name)
+        with open(index_path + '.part', 'w') as handler:
+            json.dump({'shard_slots': self.shard_slots, 'entries': list(self.entries.items())}, handler)
+        os.replace(index_path + '.part', index_path)
+
+    def size_bytes(self) -> int:
+        """Size of the cached tensors in bytes."""
+        return len(self.entries) * int(np.prod(self.slot_shape))
@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+
+class ImageDataset_from_df(Dataset):
+    def __init__(self, df, transform=None, target_transform=None, name='default_data', fast_decode=False, cache=None):
+        """
+        Args:
+            df (pd.DataFrame): DataFrame with the columns label and path.
+            transform (Callable, optional): Transformation of the images, e.g. the CLIP preprocessor. Defaults to None.
+            target_transform (Callable, optional): Transformation of the labels. Defaults to None.
+            name (str, optional): Name of the dataset. Defaults to 'default_data'.
+            fast_decode (bool, optional): Replace the CLIP preprocessor by a FastPreprocessor (draft mode decoding, batched normalization).
+                The DataLoader has to use the collate_fn of the dataset. Defaults to False.
+            cache (PreprocessedTensorCache, optional): Cache of the preprocessed images, created with the config of
+                FastPreprocessor.from_clip(transform, fast_decode). The DataLoader has to use the collate_fn of the dataset. Defaults to None.
+        """
+        self.captions = df["label"].tolist()
+        self.images = df["path"].tolist()
+        self.target_transform = target_transform
+        if fast_decode or cache is not None:
+            from utils.image_preprocessing import FastPreprocessor
+            self.transform = FastPreprocessor.from_clip(transform, draft=fast_decode)
+            self.collate_fn = self.transform.collate
+        else:
+            self.transform = transform
+            self.collate_fn = None
+        self.cache = cache
+        self.name = name
+
+    def __len__(self):
+        return len(self.captions)
+
+    def __getitem__(self, idx):
+        image = self.cache.get(self.images[idx]) if self.cache is not None else None
+        if image is None:
+            # the file is closed as soon as the image is decoded
+            with Image.open(self.images[idx]) as image:
+                if self.transform:
+                    image = self.transform(image)
+                else:
+                    image = image.copy()
+            if self.cache is not None:
+                self.cache.put(self.images[idx], image)
+
+        caption = self.captions[idx]
+        if self.target_transform:
+            caption = self.target_transform(caption)
+
+        return image, caption
+    
+class EmbeddingDataset_from_df(Dataset):
+    def __init__(self, df, name) -> None:
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.labels = df['label'].tolist()
+        values = df['model_input'].tolist()
+        if values and isinstance(values[0], np.ndarray):
+            # model inputs decoded from an encoded store or assembled from image embeddings (see read_split)
+            self.model_inputs = torch.from_numpy(np.stack(values)).to(self.device)
+        else:
+            self.model_inputs = torch.tensor([np.frombuffer(eval(value),dtype=np.float32) for value in values], dtype=torch.float32, device=self.device)
+        self.name = name
+
+    def __len__(self):
+        return len(self.labels)
+    
+    def __getitem__(self, index):
+        label = self.labels[index]
+        model_input = self.model_inputs[index]
+        return model_input, label
\ No newline at end of file